@@ -45,7 +45,7 @@ class CLIP(nn.Module):
         ctx_dim = self.clip_model.ln_final.weight.shape[0]
 
         # clip adapter
-        self.adapter = Adapter(ctx_dim, 4).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)
+        self.adapter = Adapter(ctx_dim, 4).to(self.args.device).type(self.clip_model.dtype)
         # prompt templaates
         self.temp = temp if temp is not None else ["A photo of a"]
         self.text_features = self.get_text_features()
@@ -55,7 +55,7 @@ class CLIP(nn.Module):
         self.text_features = []
         with torch.no_grad():
             for per_cls_prompts in prompts:
-                per_cls_prompt_embs = tokenize(per_cls_prompts).cuda(device=self.args.default_gpu)
+                per_cls_prompt_embs = tokenize(per_cls_prompts).to(self.args.device)
                 text_features = self.clip_model.encode_text(per_cls_prompt_embs)
                 text_features = text_features / text_features.norm(dim=-1, keepdim=True)
                 text_features = text_features.mean(dim=0)
@@ -111,7 +111,7 @@ class ClipAdapter(Evaluator):
     def __init__(self, args, use_float32=False, use_grad_checkpoint=False):
         super().__init__(args)
         self.args = args
-        clip_model, _ = load(args.ckpt_path, device=f"cuda:{args.default_gpu}")
+        clip_model, _ = load(args.ckpt_path, device=args.device)
         clip_model.eval()
         if use_float32:
             clip_model.float()
@@ -148,9 +148,9 @@ class ClipAdapter(Evaluator):
                     self.cur_iter_idx = cur_iter_idx
                     self.scheduler.step(cur_iter_idx)
 
-                    output = self.model(x.cuda(device=self.args.default_gpu))
+                    output = self.model(x.to(self.args.device))
                     # pdb.set_trace()
-                    loss = F.cross_entropy(output, y.cuda(device=self.args.default_gpu))
+                    loss = F.cross_entropy(output, y.to(self.args.device))
                     self.optimizer.zero_grad()
                     loss.backward()
                     self.optimizer.step()
@@ -181,9 +181,9 @@ class ClipAdapter(Evaluator):
                 self.cur_iter_idx = cur_iter_idx
                 self.scheduler.step(cur_iter_idx)
 
-                output = self.model(x.cuda(device=self.args.default_gpu))
+                output = self.model(x.to(self.args.device))
                 # pdb.set_trace()
-                loss = F.cross_entropy(output, y.cuda(device=self.args.default_gpu))
+                loss = F.cross_entropy(output, y.to(self.args.device))
                 self.optimizer.zero_grad()
                 loss.backward()
                 self.optimizer.step()
@@ -6,11 +6,11 @@ from tqdm import tqdm
 from copy import deepcopy
 import numpy as np
 
-from clip.clip import load, tokenize
+from clip.clip import load, tokenize, model_key
 from clip.simple_tokenizer import SimpleTokenizer as _Tokenizer
 _tokenizer = _Tokenizer()
 
-from .utils import build_cosine_scheduler, freeze_parameters
+from .utils import build_cosine_scheduler, freeze_parameters, build_task_attention_mask
 import pdb
 import time
 from .utils import get_context_indices
@@ -19,6 +19,8 @@ from torch.distributions.kl import kl_divergence
 import time 
 
 from .evaluator import Evaluator
+from .feature_store import ImageFeatureStore, TextFeatureCache
+from utils.profiler import StageProfiler
 
 class Adapter(nn.Module):
     def __init__(self, in_dim, out_dim, sigma=False, layer_num=1):
@@ -101,13 +103,13 @@ class CLIP(nn.Module):
                  mu_adapters=None, sigma_adapters=None, task_tokens=None, 
                  task_to_cls_num=None, prompt_templates=None, previous_components=None,
                  task_to_distribution=None, mu_global_adapter=None, sigma_global_adapter=None,
-                  global_vga=None):
+                  global_vga=None, feature_store=None, text_feature_cache=None):
         super().__init__()
         self.n_class = len(class_names)
         self.args = args
         # text enoder
         self.text_encoder = TextEncoder(clip_model)
-        if torch.cuda.device_count() > 1:
+        if args.device.type == 'cuda' and torch.cuda.device_count() > 1:
             self.text_encoder = nn.DataParallel(self.text_encoder, device_ids=args.gpus)
 
         self.current_class_names = class_names
@@ -119,6 +121,7 @@ class CLIP(nn.Module):
 
         # image encoder
         self.image_encoder = clip_model.visual
+        self.feature_store = feature_store
         self.vga = vga 
         self.vga_global = global_vga
         self.logit_scale = clip_model.logit_scale
@@ -134,9 +137,12 @@ class CLIP(nn.Module):
         self.task_tokens = task_tokens
         self.task_to_cls_num = task_to_cls_num
         self.prompt_templates = prompt_templates
-        self.pretrained_text_encoder = clip_model.encode_text
+        if text_feature_cache is None:
+            text_feature_cache = TextFeatureCache(clip_model.encode_text, model_key(args.arch), args.device)
+        self.text_feature_cache = text_feature_cache
         self.prior_text_features()
         self.class_to_task_mapping = {} # for faster indexing to get task ids
+        self.attn_mask_cache = {}
         self.classwise_centroids = {}
         self.task_to_distribution = task_to_distribution
         self.init_new_heads()
@@ -171,18 +177,8 @@ class CLIP(nn.Module):
 
     @torch.no_grad()
     def prior_text_features(self):
-        prompts = [[temp.format(c.replace("_", " ")) for temp in self.prompt_templates] for c in self.current_class_names]
-        text_features_, text_features_per_prompt = [], []
-        for per_cls_prompts in prompts:
-            per_cls_prompt_embs = tokenize(per_cls_prompts).cuda(device=self.args.default_gpu)
-            text_features = self.pretrained_text_encoder(per_cls_prompt_embs)
-            text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-            text_features_per_prompt.append(text_features)
-            text_features = text_features.mean(dim=0)
-            text_features = text_features / text_features.norm()
-            text_features_.append(text_features)
-        self.frozen_text_features = torch.stack(text_features_, dim=0)
-        self.frozen_text_features_individual = torch.stack(text_features_per_prompt, dim=0)
+        # only classes new to the cache are encoded, earlier tasks are reused
+        self.frozen_text_features, self.frozen_text_features_individual = self.text_feature_cache(self.current_class_names, self.prompt_templates)
     
     def get_variational_adapter_features(self, x, i=None, distill=False, global_adapter=False):
         if global_adapter:
@@ -196,6 +192,47 @@ class CLIP(nn.Module):
         dist = Normal(mu, sigma)
         return dist
     
+    def get_class_task_ids(self, nb_tasks):
+        cls_nums = torch.tensor([self.task_to_cls_num[i] for i in range(nb_tasks)])
+        return torch.repeat_interleave(torch.arange(nb_tasks), cls_nums).to(self.args.device)
+
+    def get_vga_conditioned_features(self, text_features, vga_features=None):
+        """Add the VGA output (and its task token) to the text feature of every class."""
+        if vga_features is None:
+            return text_features
+        n_query = text_features.shape[0]
+        text_features_ = text_features + vga_features[:n_query]
+        if self.args.expandable_tokens:
+            text_features_ = text_features_ + vga_features[n_query + self.get_class_task_ids(self.args.sess+1)]
+        return text_features_
+
+    @staticmethod
+    def batched_linear(adapters, x):
+        weight = torch.stack([adapter.fc[0].weight for adapter in adapters])
+        bias = torch.stack([adapter.fc[0].bias for adapter in adapters])
+        return torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2))
+
+    def get_batched_adapter_features(self, x, first_task=0):
+        """Posterior over the classes of tasks ``first_task..sess``, each class going through
+        the adapter of its own task.
+
+        With equally sized tasks the per-task adapter weights are stacked and applied
+        with one batched matmul; otherwise (e.g. fscil) the adapters run per task.
+        """
+        tasks = range(first_task, self.args.sess + 1)
+        if not self.args.expandable_adapter:
+            return self.get_variational_adapter_features(x, 0)
+        cls_nums = [self.task_to_cls_num[i] for i in tasks]
+        if len(set(cls_nums)) == 1:
+            x_ = x.view(len(tasks), cls_nums[0], -1)
+            mu = self.batched_linear(self.mu_adapters[first_task:self.args.sess+1], x_).flatten(0, 1)
+            sigma = F.softplus(self.batched_linear(self.sigma_adapters[first_task:self.args.sess+1], x_)).flatten(0, 1) * 0.999 + 0.001
+        else:
+            x_ = x.split(cls_nums)
+            mu = torch.cat([self.mu_adapters[i](x_[j]) for j, i in enumerate(tasks)])
+            sigma = torch.cat([self.sigma_adapters[i](x_[j]) for j, i in enumerate(tasks)])
+        return Normal(mu, sigma)
+
     def get_prior_from_memory(self, x_for_prior, text_features, task_num):
         with torch.no_grad():
             n_class = self.n_class
@@ -248,26 +285,13 @@ class CLIP(nn.Module):
         False True False False False
         True False False False False
         """
-        mask = torch.zeros(attn_shape, dtype=torch.bool).cuda(device=self.args.default_gpu)
-        if self.args.expandable_tokens:
-            for i in range(nb_task_tokens):
-                mask[original_query_num+i, original_query_num:original_query_num+i] = True
-                mask[original_query_num+i, original_query_num+i+1:original_query_num+nb_task_tokens] = True
-
-        start_cls_idx, end_cls_idx = 0, 0 
-        for i in range(nb_task_tokens):
-            start_cls_idx = end_cls_idx
-            end_cls_idx += self.task_to_cls_num[i]
-            curr_class_indices = np.arange(start_cls_idx, end_cls_idx)
-            for cls in curr_class_indices:
-                mask[cls][:start_cls_idx] = True 
-                mask[cls][end_cls_idx:] = True
-                if self.args.expandable_tokens:
-                    mask[cls][original_query_num+i] = False
-            if self.args.expandable_tokens:
-                mask[original_query_num+i, :start_cls_idx] = True 
-                mask[original_query_num+i, end_cls_idx:original_query_num] = True
-        return mask
+        key = (tuple(attn_shape), nb_task_tokens, original_query_num)
+        if key not in self.attn_mask_cache:
+            # task sizes never change once added, so the mask is fixed for the session
+            mask = build_task_attention_mask(self.task_to_cls_num, nb_task_tokens, self.args.expandable_tokens)
+            assert mask.shape == key[0]
+            self.attn_mask_cache[key] = mask.to(self.args.device)
+        return self.attn_mask_cache[key]
 
     def get_avg_inter_adapter_distance(self, per_task_samples):
         pairwise_distances = []
@@ -279,10 +303,24 @@ class CLIP(nn.Module):
         avg_distance = np.mean(pairwise_distances)
         return avg_distance
         
-    def forward(self, image, labels=None, test=False, finetuning=False, return_mean=True, for_prior=None):
-        with torch.no_grad():
-            image_features = self.image_encoder(image.type(self.dtype))
-            image_features_normed = image_features / image_features.norm(dim=-1, keepdim=True)
+    @torch.no_grad()
+    def encode_image_features(self, image, indices=None):
+        if image.dim() == 2:
+            # rows from a feature loader are already encoded and normalised
+            return image.type(self.dtype)
+        if self.feature_store is not None and indices is not None:
+            # the store keeps whatever dtype it was written in, e.g. fp16 rows from a GPU run
+            return self.feature_store.get_or_encode(image, indices, self._encode_image).type(self.dtype)
+        return self._encode_image(image)
+
+    def _encode_image(self, image):
+        image_features = self.image_encoder(image.type(self.dtype))
+        return image_features / image_features.norm(dim=-1, keepdim=True)
+
+    def forward(self, image, labels=None, test=False, finetuning=False, return_mean=True, for_prior=None, indices=None, first_task=0):
+        profiler = self.args.profiler
+        with torch.no_grad(), profiler.span('image_encoding'):
+            image_features_normed = self.encode_image_features(image, indices)
             image_features = image_features_normed.detach()
             image_features_normed = image_features_normed.detach()
 
@@ -299,7 +337,8 @@ class CLIP(nn.Module):
                     query = torch.cat([query] + [token for token in self.task_tokens], 1)                
                 attn_mask = self.get_attention_mask((query.shape[1], query.shape[1]), self.args.sess+1, text_features.shape[0])
                 if self.args.use_vga:
-                    vga_features = self.vga(query, context.unsqueeze(0), tgt_mask=attn_mask).squeeze(0)
+                    with profiler.span('vga'):
+                        vga_features = self.vga(query, context.unsqueeze(0), tgt_mask=attn_mask).squeeze(0)
                 
                 rsamples_g = None 
                 if self.args.hierarchical:
@@ -311,35 +350,53 @@ class CLIP(nn.Module):
 
                 logits =[]
                 samplewise_text_feats = []
-                start_cls_idx, end_cls_idx = 0, 0
-                for i in range(self.args.sess+1):
-                    start_cls_idx = end_cls_idx
-                    end_cls_idx += self.task_to_cls_num[i]
-                    text_features_relevant = text_features[start_cls_idx:end_cls_idx].clone()
-                    text_features_ = text_features_relevant
-                    if self.args.use_vga:
-                        text_features_ = text_features_ + vga_features[start_cls_idx:end_cls_idx] 
-                    if self.args.expandable_tokens:
-                        text_features_ = text_features_ + vga_features[n_query+i]
+                if self.args.hierarchical:
+                    start_cls_idx, end_cls_idx = 0, 0
+                    for i in range(self.args.sess+1):
+                        start_cls_idx = end_cls_idx
+                        end_cls_idx += self.task_to_cls_num[i]
+                        text_features_relevant = text_features[start_cls_idx:end_cls_idx].clone()
+                        text_features_ = text_features_relevant
+                        if self.args.use_vga:
+                            text_features_ = text_features_ + vga_features[start_cls_idx:end_cls_idx] 
+                        if self.args.expandable_tokens:
+                            text_features_ = text_features_ + vga_features[n_query+i]
 
-                    if self.args.hierarchical:
                         text_features_ = text_features_.unsqueeze(0).expand(self.forward_times_global, -1, -1) + rsamples_g[:, start_cls_idx:end_cls_idx, :]
-                    qdist = self.get_variational_adapter_features(text_features_, i if self.args.expandable_adapter else 0)            
-                    rsamples = qdist.rsample([self.forward_times])
-                   
-                    text_features_ = text_features_.unsqueeze(0).expand(self.forward_times, -1, -1, -1) if self.args.hierarchical else text_features_.unsqueeze(0).expand(self.forward_times, -1, -1)
-                    if self.args.hierarchical:
+                        qdist = self.get_variational_adapter_features(text_features_, i if self.args.expandable_adapter else 0)            
+                        rsamples = qdist.rsample([self.forward_times])
+                    
+                        text_features_ = text_features_.unsqueeze(0).expand(self.forward_times, -1, -1, -1)
                         rsamples = rsamples.flatten(0, 1)
                         text_features_ = text_features_.flatten(0, 1)
-                    text_features_ = rsamples + text_features_ 
+                        text_features_ = rsamples + text_features_ 
+                        
+                        logits_ = logit_scale * image_features_normed @ text_features_.permute(0, 2, 1) 
                     
-                    logits_ = logit_scale * image_features_normed @ text_features_.permute(0, 2, 1) 
-                  
-                    logits.append(logits_)
+                        logits.append(logits_)
+                        if self.args.compute_ram:
+                            samplewise_text_feats.append(text_features_relevant)
+                    # logits = torch.stack(logits, 0).sum(0)
+                    logits = torch.cat(logits, -1)
+                else:
+                    # all tasks are sampled at once and scored with a single batched matmul
+                    text_features_ = self.get_vga_conditioned_features(text_features, vga_features if self.args.use_vga else None)
+                    if first_task > 0:
+                        # columns of earlier tasks come from the evaluator's cache
+                        text_features_ = text_features_[sum(self.task_to_cls_num[t] for t in range(first_task)):]
+                    with profiler.span('adapter_sampling'):
+                        qdist = self.get_batched_adapter_features(text_features_, first_task)
+                        rsamples = qdist.rsample([self.forward_times])
+                    with profiler.span('logits'):
+                        text_features_ = rsamples + text_features_.unsqueeze(0)
+                        logits = logit_scale * image_features_normed @ text_features_.permute(0, 2, 1)
                     if self.args.compute_ram:
-                        samplewise_text_feats.append(text_features_relevant)
-                # logits = torch.stack(logits, 0).sum(0)
-                logits = torch.cat(logits, -1)
+                        # same per-task rows as the loop above: only the classes of the tasks seen so far
+                        end_cls_idx = 0
+                        for i in range(self.args.sess+1):
+                            start_cls_idx = end_cls_idx
+                            end_cls_idx += self.task_to_cls_num[i]
+                            samplewise_text_feats.append(text_features[start_cls_idx:end_cls_idx])
                 logits = logits.detach()
             if self.args.compute_ram:
                 visual_feats = image_features_normed
@@ -365,7 +422,8 @@ class CLIP(nn.Module):
                 query = torch.cat([query] + [token for token in self.task_tokens], 1)
             attn_mask = self.get_attention_mask((query.shape[1], query.shape[1]), self.args.sess+1, text_features.shape[0])
             if self.args.use_vga:
-                vga_features_all = self.vga(query, context.unsqueeze(0), tgt_mask=attn_mask).squeeze(0)
+                with profiler.span('vga'):
+                    vga_features_all = self.vga(query, context.unsqueeze(0), tgt_mask=attn_mask).squeeze(0)
             
             rsamples_g = None 
             if self.args.hierarchical:
@@ -386,7 +444,7 @@ class CLIP(nn.Module):
                     prior_text_features = self.frozen_text_features_individual.clone()
                     sims = torch.stack([prior_text_features @ rsamples_g[r].t() for r in range(rsamples_g.shape[0])], 0)
                     sims = sims.mean(2).mean(0)
-                    kl_losses.append(F.cross_entropy(sims,  torch.arange(sims.size(0)).cuda(device=self.args.default_gpu)) * self.args.beta)
+                    kl_losses.append(F.cross_entropy(sims,  torch.arange(sims.size(0)).to(self.args.device)) * self.args.beta)
 
 
             if self.args.distill and self.args.sess > 0 and self.args.alpha > 0:
@@ -406,6 +464,15 @@ class CLIP(nn.Module):
             per_sample_text_feats = []
             taskwise_means = []
 
+            if not self.args.hierarchical:
+                # sample every task's adapter at once; the per-task losses below use slices of it
+                text_features_all = self.get_vga_conditioned_features(text_features, vga_features_all if self.args.use_vga else None)
+                with profiler.span('adapter_sampling'):
+                    qdist_all = self.get_batched_adapter_features(text_features_all)
+                    rsamples_all = qdist_all.rsample([self.forward_times])
+                with profiler.span('logits'):
+                    logits = logit_scale * image_features_normed @ (rsamples_all + text_features_all.unsqueeze(0)).permute(0, 2, 1)
+
             for i in range(self.args.sess+1):   
                 start_cls_idx = end_cls_idx
                 end_cls_idx += self.task_to_cls_num[i]
@@ -414,25 +481,28 @@ class CLIP(nn.Module):
                     self.class_to_task_mapping.update(dict(zip(np.arange(start_cls_idx, end_cls_idx), [i] * (end_cls_idx - start_cls_idx))))
 
                 text_features_relevant = text_features.clone()[start_cls_idx:end_cls_idx]
-                if self.args.use_vga:
-                    vga_features = vga_features_all[start_cls_idx:end_cls_idx]
-                    if self.args.expandable_tokens:
-                        vga_features = vga_features + vga_features_all[n_query+i]
-                    text_features_ = text_features_relevant + vga_features
-                else:
-                    text_features_ = text_features_relevant
-
                 if self.args.hierarchical:
+                    if self.args.use_vga:
+                        vga_features = vga_features_all[start_cls_idx:end_cls_idx]
+                        if self.args.expandable_tokens:
+                            vga_features = vga_features + vga_features_all[n_query+i]
+                        text_features_ = text_features_relevant + vga_features
+                    else:
+                        text_features_ = text_features_relevant
+
                     text_features_ = text_features_.unsqueeze(0).expand(self.forward_times_global, -1, -1) + rsamples_g[:, start_cls_idx:end_cls_idx, :]
 
-                qdist = self.get_variational_adapter_features(text_features_, i if self.args.expandable_adapter else 0)    
-        
-                rsamples = qdist.rsample([self.forward_times])
-                text_features_ = text_features_.unsqueeze(0).expand(self.forward_times, -1, -1, -1) if self.args.hierarchical else text_features_.unsqueeze(0).expand(self.forward_times, -1, -1)
-                if self.args.hierarchical:
+                    qdist = self.get_variational_adapter_features(text_features_, i if self.args.expandable_adapter else 0)    
+            
+                    rsamples = qdist.rsample([self.forward_times])
+                    text_features_ = text_features_.unsqueeze(0).expand(self.forward_times, -1, -1, -1)
                     rsamples = rsamples.flatten(0, 1)
                     text_features_ = text_features_.flatten(0, 1)
-                text_features_ = rsamples + text_features_ 
+                    text_features_ = rsamples + text_features_ 
+                    logits.append(logit_scale * image_features_normed @ text_features_.permute(0, 2, 1))
+                else:
+                    qdist = Normal(qdist_all.loc[start_cls_idx:end_cls_idx], qdist_all.scale[start_cls_idx:end_cls_idx])
+                    rsamples = rsamples_all[:, start_cls_idx:end_cls_idx]
                 taskwise_means.append(rsamples.mean(0))
                 
                 if self.args.lasp and self.args.beta > 0 and (finetuning or (not finetuning and  self.args.sess == i)):
@@ -446,7 +516,6 @@ class CLIP(nn.Module):
                     pairwise_distances = pairwise_distances.masked_fill(mask, 0)
                     kernel_score = -0.5 * pairwise_distances.mean()
                     kl_losses.append((energy_score + kernel_score) * self.args.sr_beta)
-                logits_ = (logit_scale * image_features_normed @ text_features_.permute(0, 2, 1)) 
                 if finetuning or (not finetuning and self.args.sess == i):
                     if self.args.frozen_prior:
                         prior_text_features = self.frozen_text_features_individual.clone()[start_cls_idx:end_cls_idx] 
@@ -460,7 +529,6 @@ class CLIP(nn.Module):
                                                 )
                     prior_matching_losses.append(kl_divergence(qdist, pdist).mean(0).sum() * self.args.gamma)    
                 
-                logits.append(logits_)
                 if (self.args.get_interclass_dist and self.args.sess == 9 and finetuning) or (self.args.get_adapter_distances and self.args.sess > 0):
                     with torch.no_grad():                        
                         per_sample_text_feats.append(rsamples.clone().detach().mean(0))
@@ -470,9 +538,10 @@ class CLIP(nn.Module):
                 taskwise_means = torch.cat(taskwise_means)
                 # taskwise_means = taskwise_means / taskwise_means.norm(dim=-1, keepdim=True)
                 sims = taskwise_means @ taskwise_means.t()
-                kl_losses.append(F.cross_entropy(sims,  torch.arange(sims.size(0)).cuda(device=self.args.default_gpu)) * 5)
+                kl_losses.append(F.cross_entropy(sims,  torch.arange(sims.size(0)).to(self.args.device)) * 5)
                 
-            logits = torch.cat(logits, -1)
+            if self.args.hierarchical:
+                logits = torch.cat(logits, -1)
             kl_loss = sum(kl_losses)  if len(kl_losses) else 0.
             prior_matching_loss = sum(prior_matching_losses) 
             # prior_matching_loss = prior_matching_loss * 0.01 #if not finetuning else prior_matching_loss * 0.1 
@@ -531,10 +600,14 @@ class ClClipVariationalSR(Evaluator):
     def __init__(self, args, use_float32=False, use_grad_checkpoint=False):
         super().__init__(args)
         self.args = args
-        clip_model, _ = load(args.arch, device=f"cuda:{args.default_gpu}")
+        clip_model, _ = load(args.arch, device=args.device)
         clip_model.eval()
+        # feature caches of this backbone are keyed on it
+        self.backbone = model_key(args.arch)
         if use_float32:
             clip_model.float()
+        # frozen backbone shared by the CLIP wrapper of every session
+        freeze_parameters(clip_model, requires_grad=False)
         self.clip_model = clip_model
         self.use_grad_checkpoint = use_grad_checkpoint
         ctx_dim = self.clip_model.ln_final.weight.shape[0]
@@ -545,7 +618,7 @@ class ClClipVariationalSR(Evaluator):
         self.train_batch = args.train_batch 
         self.args = args
         self.current_class_names = []
-        decoder_layer = torch.nn.TransformerDecoderLayer(d_model=ctx_dim, nhead=1, activation='gelu', batch_first=True).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)
+        decoder_layer = torch.nn.TransformerDecoderLayer(d_model=ctx_dim, nhead=1, activation='gelu', batch_first=True).to(self.args.device).type(self.clip_model.dtype)
         self.vga = torch.nn.TransformerDecoder(decoder_layer, 1) if self.args.use_vga else None
         
         self.get_variational_adapters(ctx_dim)
@@ -565,8 +638,11 @@ class ClClipVariationalSR(Evaluator):
         self.previous_task_tokens = None
         self.previous_vga = None
 
+        self.feature_store = None
+        self.text_feature_cache = TextFeatureCache.shared(self.clip_model.encode_text, self.backbone, self.args.device, scope=self.args.db_name)
+
     def init_task_tokens(self, ctx_dim):
-        task_token = torch.zeros((1, 1,  ctx_dim), dtype=self.clip_model.dtype, requires_grad=True).cuda(device=self.args.default_gpu) 
+        task_token = torch.zeros((1, 1,  ctx_dim), dtype=self.clip_model.dtype, requires_grad=True).to(self.args.device) 
         nn.init.normal_(task_token, std=.02)
         self.task_tokens =  nn.ParameterList([nn.Parameter(task_token)]) if self.args.expandable_tokens else None 
 
@@ -590,12 +666,22 @@ class ClClipVariationalSR(Evaluator):
 
     def get_variational_adapters(self, ctx_dim, global_adapter=False):
         if not global_adapter:
-            self.mu_adapters = nn.ModuleList([Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)])
-            self.sigma_adapters = nn.ModuleList([Adapter(ctx_dim, ctx_dim, sigma=True).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)])
+            self.mu_adapters = nn.ModuleList([Adapter(ctx_dim, ctx_dim).to(self.args.device).type(self.clip_model.dtype)])
+            self.sigma_adapters = nn.ModuleList([Adapter(ctx_dim, ctx_dim, sigma=True).to(self.args.device).type(self.clip_model.dtype)])
             self.mu_adapter_deter = None
         else:
-            self.mu_global_adapter = Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)
-            self.sigma_global_adapter = Adapter(ctx_dim, ctx_dim, sigma=True).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)
+            self.mu_global_adapter = Adapter(ctx_dim, ctx_dim).to(self.args.device).type(self.clip_model.dtype)
+            self.sigma_global_adapter = Adapter(ctx_dim, ctx_dim, sigma=True).to(self.args.device).type(self.clip_model.dtype)
+
+    @torch.no_grad()
+    def encode_images(self, images):
+        image_features = self.clip_model.visual(images.to(self.args.device).type(self.clip_model.dtype))
+        return image_features / image_features.norm(dim=-1, keepdim=True)
+
+    def init_feature_store(self, dataset):
+        # the train and memory loaders both index into the train split
+        if self.args.feature_cache_dir is not None and self.feature_store is None:
+            self.feature_store = ImageFeatureStore(self.args.feature_cache_dir, self.args.db_name, self.backbone, 'train', len(dataset))
 
     def fit(self, data):
         self.task_to_cls_num[self.args.sess] = len(data['class_names'])
@@ -610,26 +696,27 @@ class ClClipVariationalSR(Evaluator):
             real_img_bsz = self.train_batch
 
         per_epoch_steps = len(train_loader)
+        self.init_feature_store(train_loader.dataset)
 
         self.init_model(class_names=self.current_class_names, per_epoch_steps=per_epoch_steps, prompt_templates=data['prompt_templates'])
 
         inter_adapter_distances = []
-        run_times = []
+        # device-side forward time, resolved once after training
+        run_timer = StageProfiler(device=self.args.device)
         # self.model.eval()
         if self.model.vga is not None:
             self.model.vga.train()
         if self.args.sess >= 0:
+            profiler = self.args.profiler
             for epoch in tqdm(range(self.epochs)):
-                for idx, (x, y, index) in tqdm(enumerate(train_loader), total=len(train_loader), desc = 'Training'):
+                for idx, (x, y, index) in tqdm(enumerate(profiler.iter(train_loader)), total=len(train_loader), desc = 'Training'):
 
                     cur_iter_idx = epoch*per_epoch_steps+idx
                     self.cur_iter_idx = cur_iter_idx
                     self.scheduler.step(cur_iter_idx)
-                    start_time = time.time()
-                    output, (kl_loss, prior_matching_loss, inter_adapter_distance) = self.model(x.cuda(device=self.args.default_gpu), y)
-                    run_time = time.time() - start_time
-                    run_times.append(run_time)
-                    y = y.cuda(device=self.args.default_gpu)
+                    with profiler.span('forward'), run_timer.span('forward'):
+                        output, (kl_loss, prior_matching_loss, inter_adapter_distance) = self.model(x.to(self.args.device), y, indices=index)
+                    y = y.to(self.args.device)
                     loss = 0.
                     # pdb.set_trace()
                     if self.args.variational:
@@ -640,10 +727,13 @@ class ClClipVariationalSR(Evaluator):
                     else:
                         targets = y 
                     #print(F.cross_entropy(output,targets), kl_loss, prior_matching_loss)
-                    loss = loss + F.cross_entropy(output, targets) + kl_loss + prior_matching_loss
+                    with profiler.span('loss'):
+                        loss = loss + F.cross_entropy(output, targets) + kl_loss + prior_matching_loss
                     self.optimizer.zero_grad()
-                    loss.backward()
-                    self.optimizer.step()
+                    with profiler.span('backward'):
+                        loss.backward()
+                    with profiler.span('optimizer_step'):
+                        self.optimizer.step()
                     
                     if inter_adapter_distance is not None and (epoch == self.epochs-1):
                         inter_adapter_distances.append(inter_adapter_distance)
@@ -658,7 +748,10 @@ class ClClipVariationalSR(Evaluator):
 
         # pdb.set_trace()
             # print(self.model.image_encoder.layer1[0].conv1.weight[0])
-        print(f"Average run time: {np.mean(run_times)}")
+        print(f"Average run time: {run_timer.mean('forward')}")
+        self.args.profiler.log(self.metric_sinks, self.args.sess, 'train')
+        if self.feature_store is not None:
+            self.feature_store.save()
         self.model.eval()
         
         if self.model.vga is not None:
@@ -684,6 +777,7 @@ class ClClipVariationalSR(Evaluator):
             self.preserve_copy_for_distillation()
 
     def finetuning(self, data):
+        self.eval_logit_cache = {}
         self.unfreeze_for_finetuning()
         self.cur_iter_idx = 0
         memory_loader = data['memory_loader']
@@ -698,16 +792,18 @@ class ClClipVariationalSR(Evaluator):
         self.build_optimizer(per_epoch_steps=per_epoch_steps, lr=self.lr/10., warmup=False, finetune=True)
         if self.model.vga is not None:
             self.model.vga.eval()
+        profiler = self.args.profiler
         for epoch in tqdm(range(self.args.finetune_epochs)):
-            for idx, (x, y, index) in tqdm(enumerate(memory_loader), total=len(memory_loader), desc = 'Finetuning'):
+            for idx, (x, y, index) in tqdm(enumerate(profiler.iter(memory_loader)), total=len(memory_loader), desc = 'Finetuning'):
 
                 cur_iter_idx = epoch*per_epoch_steps+idx
                 self.cur_iter_idx = cur_iter_idx
                 self.scheduler.step(cur_iter_idx)
 
-                output, (kl_loss, prior_matching_loss, inter_adapter_distance) = self.model(x.cuda(device=self.args.default_gpu), y, finetuning=True)
+                with profiler.span('forward'):
+                    output, (kl_loss, prior_matching_loss, inter_adapter_distance) = self.model(x.to(self.args.device), y, finetuning=True, indices=index)
                 # pdb.set_trace()
-                y = y.cuda(device=self.args.default_gpu)
+                y = y.to(self.args.device)
                 # pdb.set_trace()
                 loss = 0.
                 if self.args.variational:
@@ -716,10 +812,13 @@ class ClClipVariationalSR(Evaluator):
                 else:
                     targets = y 
                 #print(F.cross_entropy(output,targets), kl_loss, prior_matching_loss)
-                loss = loss + F.cross_entropy(output, targets) + kl_loss + prior_matching_loss
+                with profiler.span('loss'):
+                    loss = loss + F.cross_entropy(output, targets) + kl_loss + prior_matching_loss
                 self.optimizer.zero_grad()
-                loss.backward()
-                self.optimizer.step()
+                with profiler.span('backward'):
+                    loss.backward()
+                with profiler.span('optimizer_step'):
+                    self.optimizer.step()
 
                 if inter_adapter_distance is not None and (epoch == self.epochs-1):
                         inter_adapter_distances.append(inter_adapter_distance)
@@ -728,9 +827,12 @@ class ClClipVariationalSR(Evaluator):
                 self.compute_class_centroids()
         if len(inter_adapter_distances):
                 print(f"Average inter-adapter distance: {np.mean(inter_adapter_distance)}")
+        if self.feature_store is not None:
+            self.feature_store.save()
 
         if self.args.sess > 0 and self.args.expandable_tokens:
             self.epoch_log()
+        self.args.profiler.log(self.metric_sinks, self.args.sess, 'finetune')
         
     @torch.no_grad()
     def preserve_copy_for_distillation(self):
@@ -759,8 +861,8 @@ class ClClipVariationalSR(Evaluator):
     def expand_adapter(self):
         ctx_dim = self.clip_model.ln_final.weight.shape[0]
         dtype = self.clip_model.dtype
-        new_mu = Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(dtype)
-        new_sigma = Adapter(ctx_dim, ctx_dim, sigma=True).cuda(device=self.args.default_gpu).type(dtype)
+        new_mu = Adapter(ctx_dim, ctx_dim).to(self.args.device).type(dtype)
+        new_sigma = Adapter(ctx_dim, ctx_dim, sigma=True).to(self.args.device).type(dtype)
         self.mu_adapters.append(new_mu)
         self.sigma_adapters.append(new_sigma)
         self.mu_adapters[:-1].eval()
@@ -791,7 +893,7 @@ class ClClipVariationalSR(Evaluator):
                 self.expand_prompts()
 
         self.n_class = len(class_names)
-        clip_model = deepcopy(self.clip_model)
+        clip_model = self.clip_model
 
         prev_model_components = (
                                  self.previous_mu_adapters, self.previous_sigma_adapters, 
@@ -804,7 +906,7 @@ class ClClipVariationalSR(Evaluator):
                           task_to_distribution=self.task_to_distribution,
                           mu_global_adapter=self.mu_global_adapter if self.args.hierarchical else None, 
                           sigma_global_adapter=self.sigma_global_adapter if self.args.hierarchical else None,
-                           global_vga=self.vga_global
+                           global_vga=self.vga_global, feature_store=self.feature_store, text_feature_cache=self.text_feature_cache
                           )
         self.model.eval()
         if self.use_grad_checkpoint:
@@ -843,11 +945,16 @@ class ClClipVariationalSR(Evaluator):
             )
         
     @torch.no_grad()
-    def inference(self, image, label, num_test, test_class):
+    def inference(self, image, label, num_test, test_class, first_task=0):
         self.model.eval()
-        logits, feats = self.model(image, label, test=True, return_mean=False)
+        logits, feats = self.model(image, label, test=True, return_mean=False, first_task=first_task)
         return logits.float(), feats
 
+    def incremental_eval_supported(self):
+        # past-task logits stay valid only while every module they depend on is frozen:
+        # per-task adapters, no VGA/global adapter trained on all classes
+        return self.args.expandable_adapter and not (self.args.use_vga or self.args.hierarchical or self.args.compute_ram)
+
     
     @torch.no_grad()
     def epoch_log(self):
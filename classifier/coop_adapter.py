@@ -26,7 +26,7 @@ class PromptLearner(nn.Module):
 
         n_cls = len(class_names)
         self.dtype = dtype
-        ctx_vectors = torch.empty(1, n_ctx, ctx_dim, dtype=self.dtype).cuda(device=self.args.default_gpu)
+        ctx_vectors = torch.empty(1, n_ctx, ctx_dim, dtype=self.dtype).to(self.args.device)
         nn.init.normal_(ctx_vectors, std=0.02)
         self.ctx = nn.Parameter(ctx_vectors)
 
@@ -41,7 +41,7 @@ class PromptLearner(nn.Module):
         tokenized_prompts = torch.cat([tokenize(p) for p in prompts])
         self.tokenized_prompts = tokenized_prompts
         with torch.no_grad():
-            embedding = clip_model.token_embedding(tokenized_prompts.cuda(device=self.args.default_gpu)).type(self.dtype)
+            embedding = clip_model.token_embedding(tokenized_prompts.to(self.args.device)).type(self.dtype)
         self.register_buffer( 'token_prefix', embedding[:, :1, :]) # SOS, [n_cls, 1, ctx_dim]
         self.register_buffer( 'token_suffix', embedding[:, 1+n_ctx:,:]) # CLS, EOS, [n_cls, -1, ctx_dim]
 
@@ -139,7 +139,7 @@ class CLIP(nn.Module):
         self.pretrained_text_encoder = clip_model.encode_text
         # text enoder
         self.text_encoder = TextEncoder(clip_model)
-        if torch.cuda.device_count() > 1:
+        if args.device.type == 'cuda' and torch.cuda.device_count() > 1:
             self.text_encoder = nn.DataParallel(self.text_encoder, device_ids=args.gpus)
 
         # prompt learner
@@ -151,7 +151,7 @@ class CLIP(nn.Module):
         self.image_encoder = clip_model.visual
 
         self.logit_scale = clip_model.logit_scale
-        self.mu_adapter = Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(dtype)
+        self.mu_adapter = Adapter(ctx_dim, ctx_dim).to(self.args.device).type(dtype)
         self.prompt_templates = prompt_templates
 
     def get_adapter_features(self, x):
@@ -163,7 +163,7 @@ class CLIP(nn.Module):
         prompts = [[temp.format(c.replace("_", " ")) for temp in self.prompt_templates] for c in self.current_class_names]
         text_features_ = []
         for per_cls_prompts in prompts:
-            per_cls_prompt_embs = tokenize(per_cls_prompts).cuda(device=self.args.default_gpu)
+            per_cls_prompt_embs = tokenize(per_cls_prompts).to(self.args.device)
             text_features = self.pretrained_text_encoder(per_cls_prompt_embs)
             text_features = text_features / text_features.norm(dim=-1, keepdim=True)
             text_features = text_features.mean(dim=0)
@@ -238,7 +238,7 @@ class CLIP(nn.Module):
 class CoOpAdapter:
     def __init__(self, args, n_ctx=16, use_float32=False, use_grad_checkpoint=False):
         self.args = args
-        clip_model, _ = load(args.ckpt_path, device=f"cuda:{args.default_gpu}")
+        clip_model, _ = load(args.ckpt_path, device=args.device)
         clip_model.eval()
         if use_float32:
             clip_model.float()
@@ -281,12 +281,12 @@ class CoOpAdapter:
                 self.cur_iter_idx = cur_iter_idx
                 self.scheduler.step(cur_iter_idx)
 
-                output, (kl_loss, scl_loss) = self.model(x.cuda(device=self.args.default_gpu))
+                output, (kl_loss, scl_loss) = self.model(x.to(self.args.device))
                 # pdb.set_trace()
                 loss = F.cross_entropy(output, 
-                                       y.cuda(device=self.args.default_gpu)) 
+                                       y.to(self.args.device)) 
                 # loss = F.cross_entropy(output.view(-1, output.shape[-1]), 
-                #                        y.cuda(device=self.args.default_gpu).unsqueeze(0).expand(self.args.forward_times, -1).contiguous().view(-1)) 
+                #                        y.to(self.args.device).unsqueeze(0).expand(self.args.forward_times, -1).contiguous().view(-1)) 
                 loss = loss + kl_loss + scl_loss
                 # loss = loss + self.ortho_penalty(self.model.prompt_learner.ctx)
                 self.optimizer.zero_grad()
@@ -337,11 +337,11 @@ class CoOpAdapter:
         acc_per_class = [0 for _ in range(n_class)]
         count_per_class = [0 for _ in range(n_class)]
         for i, (x, y, _) in tqdm(enumerate(loader), total=len(loader), desc = 'running inference'):
-            pred_y = self.inference(x.cuda(device=self.args.default_gpu))
+            pred_y = self.inference(x.to(self.args.device))
             _, top_labels = pred_y.topk(1, dim=-1)
             for c in range(n_class):
-                acc_per_class[c] += ((top_labels.view(-1) == y.cuda(device=self.args.default_gpu)) * (y.cuda(device=self.args.default_gpu)== c)).sum().item()
-                count_per_class[c] += (y.cuda(device=self.args.default_gpu) == c).sum().item()
+                acc_per_class[c] += ((top_labels.view(-1) == y.to(self.args.device)) * (y.to(self.args.device)== c)).sum().item()
+                count_per_class[c] += (y.to(self.args.device) == c).sum().item()
         acc = [a*1.0/c for (a, c) in zip(acc_per_class, count_per_class)]
         acc = np.array(acc).mean()
         return acc
@@ -351,9 +351,9 @@ class CoOpAdapter:
         acc_count =0
         # pdb.set_trace()
         for i, (x, y, _) in tqdm(enumerate(loader), total=len(loader), desc = 'running inference'):
-            pred_y = self.inference(x.cuda(device=self.args.default_gpu))
+            pred_y = self.inference(x.to(self.args.device))
             _, top_labels = pred_y.topk(1, dim=-1)
-            acc_count += (top_labels.view(-1)==y.cuda(device=self.args.default_gpu)).sum().cpu().numpy()
+            acc_count += (top_labels.view(-1)==y.to(self.args.device)).sum().cpu().numpy()
             total_count += y.shape[0]
         acc = acc_count*1.0/total_count
         acc = acc.item()
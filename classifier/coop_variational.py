@@ -41,7 +41,7 @@ class PromptLearner(nn.Module):
         tokenized_prompts = torch.cat([tokenize(p) for p in prompts])
         self.tokenized_prompts = tokenized_prompts
         with torch.no_grad():
-            embedding = clip_model.token_embedding(tokenized_prompts.cuda(device=self.args.default_gpu)).type(self.dtype)
+            embedding = clip_model.token_embedding(tokenized_prompts.to(self.args.device)).type(self.dtype)
         self.register_buffer( 'token_prefix', embedding[:, :1, :]) # SOS, [n_cls, 1, ctx_dim]
         self.register_buffer( 'token_suffix', embedding[:, 1+n_ctx:,:]) # CLS, EOS, [n_cls, -1, ctx_dim]
 
@@ -145,7 +145,7 @@ class CLIP(nn.Module):
         self.n_ctx = n_ctx
         # text enoder
         self.text_encoder = TextEncoder(clip_model)
-        if torch.cuda.device_count() > 1:
+        if args.device.type == 'cuda' and torch.cuda.device_count() > 1:
             self.text_encoder = nn.DataParallel(self.text_encoder, device_ids=args.gpus)
 
         self.current_class_names = class_names
@@ -218,7 +218,7 @@ class CLIP(nn.Module):
         prompts = [[temp.format(c.replace("_", " ")) for temp in self.prompt_templates] for c in self.current_class_names]
         text_features_, text_features_per_prompt = [], []
         for per_cls_prompts in prompts:
-            per_cls_prompt_embs = tokenize(per_cls_prompts).cuda(device=self.args.default_gpu)
+            per_cls_prompt_embs = tokenize(per_cls_prompts).to(self.args.device)
             text_features = self.pretrained_text_encoder(per_cls_prompt_embs)
             text_features = text_features / text_features.norm(dim=-1, keepdim=True)
             text_features_per_prompt.append(text_features)
@@ -298,7 +298,7 @@ class CLIP(nn.Module):
         # nb_task_tokens = 3
         # original_query_num = 6
         # attn_shape = (9, 9)
-        mask = torch.zeros(attn_shape, dtype=torch.bool).cuda(device=self.args.default_gpu)
+        mask = torch.zeros(attn_shape, dtype=torch.bool).to(self.args.device)
         if self.args.expandable_tokens:
             for i in range(nb_task_tokens):
                 mask[original_query_num+i, original_query_num:original_query_num+i] = True
@@ -489,7 +489,7 @@ class CLIP(nn.Module):
                     prior_text_features = self.frozen_text_features_individual.clone()
                     sims = torch.stack([prior_text_features @ rsamples_g[r].t() for r in range(rsamples_g.shape[0])], 0)
                     sims = sims.mean(2).mean(0)
-                    kl_losses.append(F.cross_entropy(sims,  torch.arange(sims.size(0)).cuda(device=self.args.default_gpu)) * self.args.beta)
+                    kl_losses.append(F.cross_entropy(sims,  torch.arange(sims.size(0)).to(self.args.device)) * self.args.beta)
 
 
             if self.args.distill and self.args.sess > 0 and self.args.alpha > 0:
@@ -532,7 +532,7 @@ class CLIP(nn.Module):
                 #     q_norm = vga_features / vga_features.norm(dim=-1, keepdim=True)
                 #     k_norm = prev_vga_features / prev_vga_features.norm(dim=-1, keepdim=True)
                 #     sims = k_norm @ q_norm.t()
-                #     kl_losses.append(F.cross_entropy(sims,  torch.arange(sims.size(0)).cuda(device=self.args.default_gpu)) * self.args.alpha)
+                #     kl_losses.append(F.cross_entropy(sims,  torch.arange(sims.size(0)).to(self.args.device)) * self.args.alpha)
 
                     # cos = (q_norm * k_norm).sum(-1).mean()
                     # kl_losses.append(1-cos)
@@ -558,11 +558,11 @@ class CLIP(nn.Module):
                     prior_text_features = self.frozen_text_features_individual.clone()[start_cls_idx:end_cls_idx]
                     sims = torch.stack([prior_text_features @ rsamples[r].t() for r in range(rsamples.shape[0])], 0)
                     sims = sims.mean(2).mean(0)
-                    kl_losses.append(F.cross_entropy(sims,  torch.arange(sims.size(0)).cuda(device=self.args.default_gpu)) * self.args.beta)
+                    kl_losses.append(F.cross_entropy(sims,  torch.arange(sims.size(0)).to(self.args.device)) * self.args.beta)
                     if self.args.use_det_path:
                         sims_det = prior_text_features @ deterministic_features.t() 
                         sims_det = sims_det.mean(1)
-                        kl_losses.append(F.cross_entropy(sims_det,  torch.arange(sims_det.size(0)).cuda(device=self.args.default_gpu)) * self.args.beta)
+                        kl_losses.append(F.cross_entropy(sims_det,  torch.arange(sims_det.size(0)).to(self.args.device)) * self.args.beta)
                 logits_ = (logit_scale * image_features_normed @ text_features_.permute(0, 2, 1)) 
                 if finetuning or (not finetuning and self.args.sess == i):
                     if self.args.frozen_prior:
@@ -586,7 +586,7 @@ class CLIP(nn.Module):
                 taskwise_means = torch.cat(taskwise_means)
                 # taskwise_means = taskwise_means / taskwise_means.norm(dim=-1, keepdim=True)
                 sims = taskwise_means @ taskwise_means.t()
-                kl_losses.append(F.cross_entropy(sims,  torch.arange(sims.size(0)).cuda(device=self.args.default_gpu)) * 5)
+                kl_losses.append(F.cross_entropy(sims,  torch.arange(sims.size(0)).to(self.args.device)) * 5)
                 # taskwise_means = torch.stack(taskwise_means, 0)
                 # taskwise_means = taskwise_means / taskwise_means.norm(dim=-1, keepdim=True)
                 # dis = taskwise_means @ taskwise_means.permute(0, 2, 1)
@@ -690,14 +690,14 @@ class CoOpVariational(Evaluator):
         super().__init__(args)
         n_ctx = 2 if args.expandable_prompt else n_ctx
         self.args = args
-        clip_model, _ = load(args.ckpt_path, device=f"cuda:{args.default_gpu}")
+        clip_model, _ = load(args.ckpt_path, device=args.device)
         clip_model.eval()
         if use_float32:
             clip_model.float()
         self.clip_model = clip_model
         self.use_grad_checkpoint = use_grad_checkpoint
         ctx_dim = self.clip_model.ln_final.weight.shape[0]
-        ctx_vectors = torch.empty(1, n_ctx, ctx_dim, dtype=self.clip_model.dtype).cuda(device=self.args.default_gpu)
+        ctx_vectors = torch.empty(1, n_ctx, ctx_dim, dtype=self.clip_model.dtype).to(self.args.device)
         nn.init.normal_(ctx_vectors, std=0.02)
         self.ctx = nn.ParameterList([nn.Parameter(ctx_vectors)])
 
@@ -707,7 +707,7 @@ class CoOpVariational(Evaluator):
         self.epochs = args.epochs
         self.train_batch = args.train_batch 
         self.current_class_names = []
-        decoder_layer = torch.nn.TransformerDecoderLayer(d_model=ctx_dim, nhead=ctx_dim//64, activation='gelu', batch_first=True).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)
+        decoder_layer = torch.nn.TransformerDecoderLayer(d_model=ctx_dim, nhead=ctx_dim//64, activation='gelu', batch_first=True).to(self.args.device).type(self.clip_model.dtype)
         self.vga = torch.nn.TransformerDecoder(decoder_layer, 1)
 
         self.get_variational_adapters(ctx_dim)
@@ -728,7 +728,7 @@ class CoOpVariational(Evaluator):
         self.previous_vga = None
 
     def init_task_tokens(self, ctx_dim):
-        task_token = torch.zeros((1, 1,  ctx_dim), dtype=self.clip_model.dtype, requires_grad=True).cuda(device=self.args.default_gpu) 
+        task_token = torch.zeros((1, 1,  ctx_dim), dtype=self.clip_model.dtype, requires_grad=True).to(self.args.device) 
         nn.init.normal_(task_token, std=.02)
         self.task_tokens =  nn.ParameterList([nn.Parameter(task_token)]) if self.args.expandable_tokens else None 
 
@@ -752,14 +752,14 @@ class CoOpVariational(Evaluator):
 
     def get_variational_adapters(self, ctx_dim, global_adapter=False):
         if not global_adapter:
-            self.mu_adapters = nn.ModuleList([Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)])
-            self.sigma_adapters = nn.ModuleList([Adapter(ctx_dim, ctx_dim, sigma=True).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)])
+            self.mu_adapters = nn.ModuleList([Adapter(ctx_dim, ctx_dim).to(self.args.device).type(self.clip_model.dtype)])
+            self.sigma_adapters = nn.ModuleList([Adapter(ctx_dim, ctx_dim, sigma=True).to(self.args.device).type(self.clip_model.dtype)])
             self.mu_adapter_deter = None
             if self.args.use_det_path:
-                self.mu_adapter_deter = nn.ModuleList([Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)])
+                self.mu_adapter_deter = nn.ModuleList([Adapter(ctx_dim, ctx_dim).to(self.args.device).type(self.clip_model.dtype)])
         else:
-            self.mu_global_adapter = Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)
-            self.sigma_global_adapter = Adapter(ctx_dim, ctx_dim, sigma=True).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)
+            self.mu_global_adapter = Adapter(ctx_dim, ctx_dim).to(self.args.device).type(self.clip_model.dtype)
+            self.sigma_global_adapter = Adapter(ctx_dim, ctx_dim, sigma=True).to(self.args.device).type(self.clip_model.dtype)
 
     def fit(self, data):
         self.task_to_cls_num[self.args.sess] = len(data['class_names'])
@@ -788,8 +788,8 @@ class CoOpVariational(Evaluator):
                     self.cur_iter_idx = cur_iter_idx
                     self.scheduler.step(cur_iter_idx)
 
-                    output, (kl_loss, prior_matching_loss, inter_adapter_distance) = self.model(x.cuda(device=self.args.default_gpu), y)
-                    y = y.cuda(device=self.args.default_gpu)
+                    output, (kl_loss, prior_matching_loss, inter_adapter_distance) = self.model(x.to(self.args.device), y)
+                    y = y.to(self.args.device)
                     loss = 0.
                     # pdb.set_trace()
                     if self.args.variational:
@@ -823,7 +823,7 @@ class CoOpVariational(Evaluator):
             with torch.no_grad():
                 batchwise_means, batchwise_variances = [], []
                 for idx, (x, y, index) in tqdm(enumerate(train_loader), total=len(train_loader), desc = 'Recording distribution..'):
-                    qdist = self.model.record_dist(x.cuda(device=self.args.default_gpu))
+                    qdist = self.model.record_dist(x.to(self.args.device))
                     batchwise_means.append(qdist.loc.detach())
                     batchwise_variances.append(qdist.scale.detach())
                 batchwise_means = torch.stack(batchwise_means).mean(0).detach()
@@ -872,9 +872,9 @@ class CoOpVariational(Evaluator):
                 self.cur_iter_idx = cur_iter_idx
                 self.scheduler.step(cur_iter_idx)
 
-                output, (kl_loss, prior_matching_loss, inter_adapter_distance) = self.model(x.cuda(device=self.args.default_gpu), y, finetuning=True)
+                output, (kl_loss, prior_matching_loss, inter_adapter_distance) = self.model(x.to(self.args.device), y, finetuning=True)
                 # pdb.set_trace()
-                y = y.cuda(device=self.args.default_gpu)
+                y = y.to(self.args.device)
                 # pdb.set_trace()
                 loss = 0.
                 if self.args.variational:
@@ -934,8 +934,8 @@ class CoOpVariational(Evaluator):
     def expand_adapter(self):
         ctx_dim = self.clip_model.ln_final.weight.shape[0]
         dtype = self.clip_model.dtype
-        new_mu = Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(dtype)
-        new_sigma = Adapter(ctx_dim, ctx_dim, sigma=True).cuda(device=self.args.default_gpu).type(dtype)
+        new_mu = Adapter(ctx_dim, ctx_dim).to(self.args.device).type(dtype)
+        new_sigma = Adapter(ctx_dim, ctx_dim, sigma=True).to(self.args.device).type(dtype)
         self.mu_adapters.append(new_mu)
         self.sigma_adapters.append(new_sigma)
         self.mu_adapters[:-1].eval()
@@ -945,7 +945,7 @@ class CoOpVariational(Evaluator):
         freeze_parameters(self.mu_adapters[-1], requires_grad=True)
         freeze_parameters(self.sigma_adapters[-1], requires_grad=True)
         if self.args.use_det_path:
-            new_mu_deter = Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(dtype)
+            new_mu_deter = Adapter(ctx_dim, ctx_dim).to(self.args.device).type(dtype)
             self.mu_adapter_deter.append(new_mu_deter)
             self.mu_adapter_deter[:-1].eval()
             freeze_parameters(self.mu_adapter_deter[:-1], requires_grad=False)
@@ -6,18 +6,19 @@ from tqdm import tqdm
 from copy import deepcopy
 import numpy as np
 
-from clip.clip import load, tokenize
+from clip.clip import load, tokenize, model_key
 from clip.simple_tokenizer import SimpleTokenizer as _Tokenizer
 _tokenizer = _Tokenizer()
 import dataset.incremental_dataloader
 
-from .utils import build_cosine_scheduler, freeze_parameters
+from .utils import build_cosine_scheduler, freeze_parameters, build_task_attention_mask
 import pdb
 import time
 from .utils import init_weights, get_context_indices, get_context_indices_by_uncertainty
 from torch.distributions.normal import Normal 
 from torch.distributions.kl import kl_divergence
 from .evaluator import Evaluator
+from .feature_store import ImageFeatureStore, TextFeatureCache
 
 class PromptLearner(nn.Module):
     def __init__(self, args, class_names, clip_model, ctx_vectors,  n_ctx=16, prompt_pos=2, prev_ctx_vectors=None):
@@ -38,19 +39,36 @@ class PromptLearner(nn.Module):
 
         self.prompt_pos = prompt_pos
 
-        tokenized_prompts = torch.cat([tokenize(p) for p in prompts])
+        tokenized_prompts = tokenize(prompts)
         self.tokenized_prompts = tokenized_prompts
         with torch.no_grad():
-            embedding = clip_model.token_embedding(tokenized_prompts.cuda(device=self.args.default_gpu)).type(self.dtype)
+            embedding = clip_model.token_embedding(tokenized_prompts.to(self.args.device)).type(self.dtype)
         self.register_buffer( 'token_prefix', embedding[:, :1, :]) # SOS, [n_cls, 1, ctx_dim]
         self.register_buffer( 'token_suffix', embedding[:, 1+n_ctx:,:]) # CLS, EOS, [n_cls, -1, ctx_dim]
 
         self.n_cls = n_cls 
         self.n_ctx = n_ctx 
         self.ctx_dim = ctx_dim
+        if prompt_pos in (0, 1):
+            self.register_buffer('prompt_index', self.build_prompt_index().to(self.args.device), persistent=False) # [n_cls, n_tokens]
 
         self.prev_ctx = prev_ctx_vectors 
 
+    def build_prompt_index(self):
+        """Token positions of every class prompt within the prompt_pos=2 layout [SOS, ctx, class name, suffix]."""
+        n_suffix = self.token_suffix.shape[1]
+        ctx = list(range(1, 1 + self.n_ctx))
+        index = []
+        for name_len in self.name_lens:
+            name = list(range(1 + self.n_ctx, 1 + self.n_ctx + name_len))
+            suffix = list(range(1 + self.n_ctx + name_len, 1 + self.n_ctx + n_suffix))
+            if self.prompt_pos == 1:
+                half_n_ctx = self.n_ctx // 2
+                index.append([0] + ctx[:half_n_ctx] + name + ctx[half_n_ctx:] + suffix)
+            else:
+                index.append([0] + name + ctx + suffix)
+        return torch.tensor(index)
+
     def forward(self, distill=False):
         all_ctx = []
         ctx_to_consider = self.prev_ctx if distill else self.ctx
@@ -70,30 +88,10 @@ class PromptLearner(nn.Module):
             suffix = self.token_suffix.unsqueeze(1)
             ctx = ctx.unsqueeze(0).repeat(n_cls, 1, 1, 1)
             prompts = torch.cat([prefix, ctx, suffix],dim=2)
-        elif self.prompt_pos == 1:
-            prompts =[]
-            half_n_ctx = self.n_ctx // 2
-            for i in range(n_cls):
-                name_len = self.name_lens[i]
-                prefix_i = self.token_prefix[i:i+1, :,:].unsqueeze(1)
-                class_i = self.token_suffix[i:i+1,:name_len, :].unsqueeze(1)
-                suffix_i = self.token_suffix[i:i+1, name_len:,:].unsqueeze(1)
-                ctx_i_half1 = ctx[:,:half_n_ctx, :].unsqueeze(0)
-                ctx_i_half2 = ctx[:, half_n_ctx:,:].unsqueeze(0)
-                prompt = torch.cat([prefix_i, ctx_i_half1, class_i, ctx_i_half2, suffix_i],dim=2)
-                prompts.append(prompt)
-            prompts = torch.cat(prompts, dim=0)
-        elif self.prompt_pos == 0:
-            prompts =[]
-            for i in range(self.n_cls):
-                name_len = self.name_lens[i]
-                prefix_i = self.token_prefix[i:i+1,:,:].unsqueeze(1)
-                class_i = self.token_suffix[i:i+1, :name_len,:].unsqueeze(1)
-                suffix_i = self.token_suffix[i:i+1, name_len:,:].unsqueeze(1)
-                ctx_i = ctx.unsqueeze(0)
-                prompt = torch.cat([prefix_i, class_i, ctx_i, suffix_i], dim=2)
-                prompts.append(prompt)
-            prompts = torch.cat(prompts, dim=0)
+        elif self.prompt_pos in (0, 1):
+            # the class prompts only reorder the prompt_pos=2 tokens, so all of them come from one gather
+            prompts = torch.cat([self.token_prefix, ctx.expand(n_cls, -1, -1), self.token_suffix], dim=1)
+            prompts = prompts.gather(1, self.prompt_index.unsqueeze(-1).expand(-1, -1, self.ctx_dim))
 
         prompts = prompts.view(n_cls, -1, self.ctx_dim)
 
@@ -138,14 +136,14 @@ class CLIP(nn.Module):
                  mu_adapters=None, sigma_adapters=None, task_tokens=None, 
                  task_to_cls_num=None, prompt_templates=None, previous_components=None,
                  task_to_distribution=None, mu_global_adapter=None, sigma_global_adapter=None,
-                 mu_adapter_deter=None, global_vga=None):
+                 mu_adapter_deter=None, global_vga=None, feature_store=None, text_feature_cache=None):
         super().__init__()
         self.n_class = len(class_names)
         self.args = args
         self.n_ctx = n_ctx
         # text enoder
         self.text_encoder = TextEncoder(clip_model)
-        if torch.cuda.device_count() > 1:
+        if args.device.type == 'cuda' and torch.cuda.device_count() > 1:
             self.text_encoder = nn.DataParallel(self.text_encoder, device_ids=args.gpus)
 
         self.current_class_names = class_names
@@ -160,6 +158,7 @@ class CLIP(nn.Module):
         self.prompt_learner = PromptLearner(args, class_names, clip_model, self.ctx, n_ctx=n_ctx, prev_ctx_vectors=previous_ctx)
         # image encoder
         self.image_encoder = clip_model.visual
+        self.feature_store = feature_store
         self.vga = vga 
         self.vga_global = global_vga
         self.logit_scale = clip_model.logit_scale
@@ -176,9 +175,12 @@ class CLIP(nn.Module):
         self.task_tokens = task_tokens
         self.task_to_cls_num = task_to_cls_num
         self.prompt_templates = prompt_templates
-        self.pretrained_text_encoder = clip_model.encode_text
+        if text_feature_cache is None:
+            text_feature_cache = TextFeatureCache(clip_model.encode_text, model_key(args.ckpt_path), args.device)
+        self.text_feature_cache = text_feature_cache
         self.prior_text_features()
         self.class_to_task_mapping = {} # for faster indexing to get task ids
+        self.attn_mask_cache = {}
         self.classwise_centroids = {}
         self.task_to_distribution = task_to_distribution
         self.init_new_heads()
@@ -215,18 +217,8 @@ class CLIP(nn.Module):
     
     @torch.no_grad()
     def prior_text_features(self):
-        prompts = [[temp.format(c.replace("_", " ")) for temp in self.prompt_templates] for c in self.current_class_names]
-        text_features_, text_features_per_prompt = [], []
-        for per_cls_prompts in prompts:
-            per_cls_prompt_embs = tokenize(per_cls_prompts).cuda(device=self.args.default_gpu)
-            text_features = self.pretrained_text_encoder(per_cls_prompt_embs)
-            text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-            text_features_per_prompt.append(text_features)
-            text_features = text_features.mean(dim=0)
-            text_features = text_features / text_features.norm()
-            text_features_.append(text_features)
-        self.frozen_text_features = torch.stack(text_features_, dim=0)
-        self.frozen_text_features_individual = torch.stack(text_features_per_prompt, dim=0)
+        # only classes new to the cache are encoded, earlier tasks are reused
+        self.frozen_text_features, self.frozen_text_features_individual = self.text_feature_cache(self.current_class_names, self.prompt_templates)
     
     def get_variational_adapter_features(self, x, i=None, distill=False, global_adapter=False):
         if global_adapter:
@@ -292,32 +284,13 @@ class CLIP(nn.Module):
         False True False False False
         True False False False False
         """
-        # self.task_to_cls_num[0] = 2
-        # self.task_to_cls_num[1] = 2
-        # self.task_to_cls_num[2] = 2
-        # nb_task_tokens = 3
-        # original_query_num = 6
-        # attn_shape = (9, 9)
-        mask = torch.zeros(attn_shape, dtype=torch.bool).cuda(device=self.args.default_gpu)
-        if self.args.expandable_tokens:
-            for i in range(nb_task_tokens):
-                mask[original_query_num+i, original_query_num:original_query_num+i] = True
-                mask[original_query_num+i, original_query_num+i+1:original_query_num+nb_task_tokens] = True
-
-        start_cls_idx, end_cls_idx = 0, 0 
-        for i in range(nb_task_tokens):
-            start_cls_idx = end_cls_idx
-            end_cls_idx += self.task_to_cls_num[i]
-            curr_class_indices = np.arange(start_cls_idx, end_cls_idx)
-            for cls in curr_class_indices:
-                mask[cls][:start_cls_idx] = True 
-                mask[cls][end_cls_idx:] = True
-                if self.args.expandable_tokens:
-                    mask[cls][original_query_num+i] = False
-            if self.args.expandable_tokens:
-                mask[original_query_num+i, :start_cls_idx] = True 
-                mask[original_query_num+i, end_cls_idx:original_query_num] = True
-        return mask
+        key = (tuple(attn_shape), nb_task_tokens, original_query_num)
+        if key not in self.attn_mask_cache:
+            # task sizes never change once added, so the mask is fixed for the session
+            mask = build_task_attention_mask(self.task_to_cls_num, nb_task_tokens, self.args.expandable_tokens)
+            assert mask.shape == key[0]
+            self.attn_mask_cache[key] = mask.to(self.args.device)
+        return self.attn_mask_cache[key]
     
     @torch.no_grad()
     def record_dist(self, image):
@@ -371,10 +344,24 @@ class CLIP(nn.Module):
         avg_distance = np.mean(pairwise_distances)
         return avg_distance
         
-    def forward(self, image, labels=None, test=False, finetuning=False, return_mean=True, for_prior=None):
-        with torch.no_grad():
-            image_features = self.image_encoder(image.type(self.dtype))
-            image_features_normed = image_features / image_features.norm(dim=-1, keepdim=True)
+    @torch.no_grad()
+    def encode_image_features(self, image, indices=None):
+        if image.dim() == 2:
+            # rows from a feature loader are already encoded and normalised
+            return image.type(self.dtype)
+        if self.feature_store is not None and indices is not None:
+            # the store keeps whatever dtype it was written in, e.g. fp16 rows from a GPU run
+            return self.feature_store.get_or_encode(image, indices, self._encode_image).type(self.dtype)
+        return self._encode_image(image)
+
+    def _encode_image(self, image):
+        image_features = self.image_encoder(image.type(self.dtype))
+        return image_features / image_features.norm(dim=-1, keepdim=True)
+
+    def forward(self, image, labels=None, test=False, finetuning=False, return_mean=True, for_prior=None, indices=None):
+        profiler = self.args.profiler
+        with torch.no_grad(), profiler.span('image_encoding'):
+            image_features_normed = self.encode_image_features(image, indices)
             image_features = image_features_normed.detach()
             image_features_normed = image_features_normed.detach()
 
@@ -393,7 +380,8 @@ class CLIP(nn.Module):
                     query = torch.cat([query] + [token for token in self.task_tokens], 1)                
                 attn_mask = self.get_attention_mask((query.shape[1], query.shape[1]), self.args.sess+1, text_features.shape[0])
                 if self.args.use_vga:
-                    vga_features = self.vga(query, context.unsqueeze(0), tgt_mask=attn_mask).squeeze(0)
+                    with profiler.span('vga'):
+                        vga_features = self.vga(query, context.unsqueeze(0), tgt_mask=attn_mask).squeeze(0)
                 
                 rsamples_g = None 
                 if self.args.hierarchical:
@@ -453,8 +441,9 @@ class CLIP(nn.Module):
 
         else:
             
-            text_prompt, tokenized_prompts = self.prompt_learner()
-            text_features = self.text_encoder(text_prompt,tokenized_prompts)
+            with profiler.span('text_encoding'):
+                text_prompt, tokenized_prompts = self.prompt_learner()
+                text_features = self.text_encoder(text_prompt,tokenized_prompts)
             text_features = text_features.view(n_class, -1)
             text_features = text_features / text_features.norm(dim=-1, keepdim=True)
             logits =[]
@@ -468,7 +457,8 @@ class CLIP(nn.Module):
                 query = torch.cat([query] + [token for token in self.task_tokens], 1)
             attn_mask = self.get_attention_mask((query.shape[1], query.shape[1]), self.args.sess+1, text_features.shape[0])
             if self.args.use_vga:
-                vga_features_all = self.vga(query, context.unsqueeze(0), tgt_mask=attn_mask).squeeze(0)
+                with profiler.span('vga'):
+                    vga_features_all = self.vga(query, context.unsqueeze(0), tgt_mask=attn_mask).squeeze(0)
             
             rsamples_g = None 
             if self.args.hierarchical:
@@ -489,7 +479,7 @@ class CLIP(nn.Module):
                     prior_text_features = self.frozen_text_features_individual.clone()
                     sims = torch.stack([prior_text_features @ rsamples_g[r].t() for r in range(rsamples_g.shape[0])], 0)
                     sims = sims.mean(2).mean(0)
-                    kl_losses.append(F.cross_entropy(sims,  torch.arange(sims.size(0)).cuda(device=self.args.default_gpu)) * self.args.beta)
+                    kl_losses.append(F.cross_entropy(sims,  torch.arange(sims.size(0)).to(self.args.device)) * self.args.beta)
 
 
             if self.args.distill and self.args.sess > 0 and self.args.alpha > 0:
@@ -532,7 +522,7 @@ class CLIP(nn.Module):
                 #     q_norm = vga_features / vga_features.norm(dim=-1, keepdim=True)
                 #     k_norm = prev_vga_features / prev_vga_features.norm(dim=-1, keepdim=True)
                 #     sims = k_norm @ q_norm.t()
-                #     kl_losses.append(F.cross_entropy(sims,  torch.arange(sims.size(0)).cuda(device=self.args.default_gpu)) * self.args.alpha)
+                #     kl_losses.append(F.cross_entropy(sims,  torch.arange(sims.size(0)).to(self.args.device)) * self.args.alpha)
 
                     # cos = (q_norm * k_norm).sum(-1).mean()
                     # kl_losses.append(1-cos)
@@ -588,7 +578,7 @@ class CLIP(nn.Module):
                 taskwise_means = torch.cat(taskwise_means)
                 # taskwise_means = taskwise_means / taskwise_means.norm(dim=-1, keepdim=True)
                 sims = taskwise_means @ taskwise_means.t()
-                kl_losses.append(F.cross_entropy(sims,  torch.arange(sims.size(0)).cuda(device=self.args.default_gpu)) * 5)
+                kl_losses.append(F.cross_entropy(sims,  torch.arange(sims.size(0)).to(self.args.device)) * 5)
                 # taskwise_means = torch.stack(taskwise_means, 0)
                 # taskwise_means = taskwise_means / taskwise_means.norm(dim=-1, keepdim=True)
                 # dis = taskwise_means @ taskwise_means.permute(0, 2, 1)
@@ -692,14 +682,18 @@ class CoOpVariationalSR(Evaluator):
         super().__init__(args)
         n_ctx = 2 if args.expandable_prompt else n_ctx
         self.args = args
-        clip_model, _ = load(args.ckpt_path, device=f"cuda:{args.default_gpu}")
+        clip_model, _ = load(args.ckpt_path, device=args.device)
         clip_model.eval()
+        # feature caches of this backbone are keyed on it
+        self.backbone = model_key(args.ckpt_path)
         if use_float32:
             clip_model.float()
+        # frozen backbone shared by the CLIP wrapper of every session
+        freeze_parameters(clip_model, requires_grad=False)
         self.clip_model = clip_model
         self.use_grad_checkpoint = use_grad_checkpoint
         ctx_dim = self.clip_model.ln_final.weight.shape[0]
-        ctx_vectors = torch.empty(1, n_ctx, ctx_dim, dtype=self.clip_model.dtype).cuda(device=self.args.default_gpu)
+        ctx_vectors = torch.empty(1, n_ctx, ctx_dim, dtype=self.clip_model.dtype).to(self.args.device)
         nn.init.normal_(ctx_vectors, std=0.02)
         self.ctx = nn.ParameterList([nn.Parameter(ctx_vectors)])
 
@@ -709,7 +703,7 @@ class CoOpVariationalSR(Evaluator):
         self.epochs = args.epochs
         self.train_batch = args.train_batch 
         self.current_class_names = []
-        decoder_layer = torch.nn.TransformerDecoderLayer(d_model=ctx_dim, nhead=ctx_dim//64, activation='gelu', batch_first=True).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)
+        decoder_layer = torch.nn.TransformerDecoderLayer(d_model=ctx_dim, nhead=ctx_dim//64, activation='gelu', batch_first=True).to(self.args.device).type(self.clip_model.dtype)
         self.vga = torch.nn.TransformerDecoder(decoder_layer, 1)
 
         self.get_variational_adapters(ctx_dim)
@@ -729,8 +723,11 @@ class CoOpVariationalSR(Evaluator):
         self.previous_task_tokens = None
         self.previous_vga = None
 
+        self.feature_store = None
+        self.text_feature_cache = TextFeatureCache.shared(self.clip_model.encode_text, self.backbone, self.args.device, scope=self.args.db_name)
+
     def init_task_tokens(self, ctx_dim):
-        task_token = torch.zeros((1, 1,  ctx_dim), dtype=self.clip_model.dtype, requires_grad=True).cuda(device=self.args.default_gpu) 
+        task_token = torch.zeros((1, 1,  ctx_dim), dtype=self.clip_model.dtype, requires_grad=True).to(self.args.device) 
         nn.init.normal_(task_token, std=.02)
         self.task_tokens =  nn.ParameterList([nn.Parameter(task_token)]) if self.args.expandable_tokens else None 
 
@@ -754,14 +751,24 @@ class CoOpVariationalSR(Evaluator):
 
     def get_variational_adapters(self, ctx_dim, global_adapter=False):
         if not global_adapter:
-            self.mu_adapters = nn.ModuleList([Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)])
-            self.sigma_adapters = nn.ModuleList([Adapter(ctx_dim, ctx_dim, sigma=True).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)])
+            self.mu_adapters = nn.ModuleList([Adapter(ctx_dim, ctx_dim).to(self.args.device).type(self.clip_model.dtype)])
+            self.sigma_adapters = nn.ModuleList([Adapter(ctx_dim, ctx_dim, sigma=True).to(self.args.device).type(self.clip_model.dtype)])
             self.mu_adapter_deter = None
             if self.args.use_det_path:
-                self.mu_adapter_deter = nn.ModuleList([Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)])
+                self.mu_adapter_deter = nn.ModuleList([Adapter(ctx_dim, ctx_dim).to(self.args.device).type(self.clip_model.dtype)])
         else:
-            self.mu_global_adapter = Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)
-            self.sigma_global_adapter = Adapter(ctx_dim, ctx_dim, sigma=True).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)
+            self.mu_global_adapter = Adapter(ctx_dim, ctx_dim).to(self.args.device).type(self.clip_model.dtype)
+            self.sigma_global_adapter = Adapter(ctx_dim, ctx_dim, sigma=True).to(self.args.device).type(self.clip_model.dtype)
+
+    @torch.no_grad()
+    def encode_images(self, images):
+        image_features = self.clip_model.visual(images.to(self.args.device).type(self.clip_model.dtype))
+        return image_features / image_features.norm(dim=-1, keepdim=True)
+
+    def init_feature_store(self, dataset):
+        # the train and memory loaders both index into the train split
+        if self.args.feature_cache_dir is not None and self.feature_store is None:
+            self.feature_store = ImageFeatureStore(self.args.feature_cache_dir, self.args.db_name, self.backbone, 'train', len(dataset))
 
     def fit(self, data):
         self.task_to_cls_num[self.args.sess] = len(data['class_names'])
@@ -776,6 +783,7 @@ class CoOpVariationalSR(Evaluator):
             real_img_bsz = self.train_batch
 
         per_epoch_steps = len(train_loader)
+        self.init_feature_store(train_loader.dataset)
 
         self.init_model(class_names=self.current_class_names, per_epoch_steps=per_epoch_steps, prompt_templates=data['prompt_templates'])
 
@@ -783,15 +791,17 @@ class CoOpVariationalSR(Evaluator):
         # self.model.eval()
         self.model.vga.train()
         if self.args.sess >= 0:
+            profiler = self.args.profiler
             for epoch in tqdm(range(self.epochs)):
-                for idx, (x, y, index) in tqdm(enumerate(train_loader), total=len(train_loader), desc = 'Training'):
+                for idx, (x, y, index) in tqdm(enumerate(profiler.iter(train_loader)), total=len(train_loader), desc = 'Training'):
 
                     cur_iter_idx = epoch*per_epoch_steps+idx
                     self.cur_iter_idx = cur_iter_idx
                     self.scheduler.step(cur_iter_idx)
 
-                    output, (kl_loss, prior_matching_loss, inter_adapter_distance) = self.model(x.cuda(device=self.args.default_gpu), y)
-                    y = y.cuda(device=self.args.default_gpu)
+                    with profiler.span('forward'):
+                        output, (kl_loss, prior_matching_loss, inter_adapter_distance) = self.model(x.to(self.args.device), y, indices=index)
+                    y = y.to(self.args.device)
                     loss = 0.
                     # pdb.set_trace()
                     if self.args.variational:
@@ -801,10 +811,13 @@ class CoOpVariationalSR(Evaluator):
                         output = output.view(-1, output.shape[-1])
                     else:
                         targets = y 
-                    loss = loss + F.cross_entropy(output, targets) + kl_loss + prior_matching_loss
+                    with profiler.span('loss'):
+                        loss = loss + F.cross_entropy(output, targets) + kl_loss + prior_matching_loss
                     self.optimizer.zero_grad()
-                    loss.backward()
-                    self.optimizer.step()
+                    with profiler.span('backward'):
+                        loss.backward()
+                    with profiler.span('optimizer_step'):
+                        self.optimizer.step()
                     
                     if inter_adapter_distance is not None and (epoch == self.epochs-1):
                         inter_adapter_distances.append(inter_adapter_distance)
@@ -820,12 +833,15 @@ class CoOpVariationalSR(Evaluator):
         # pdb.set_trace()
             # print(self.model.prompt_learner.ctx)
             # print(self.model.image_encoder.layer1[0].conv1.weight[0])
+        if self.feature_store is not None:
+            self.feature_store.save()
+        self.args.profiler.log(self.metric_sinks, self.args.sess, 'train')
         self.model.eval()
         if self.args.distill_distribution:
             with torch.no_grad():
                 batchwise_means, batchwise_variances = [], []
                 for idx, (x, y, index) in tqdm(enumerate(train_loader), total=len(train_loader), desc = 'Recording distribution..'):
-                    qdist = self.model.record_dist(x.cuda(device=self.args.default_gpu))
+                    qdist = self.model.record_dist(x.to(self.args.device))
                     batchwise_means.append(qdist.loc.detach())
                     batchwise_variances.append(qdist.scale.detach())
                 batchwise_means = torch.stack(batchwise_means).mean(0).detach()
@@ -867,16 +883,18 @@ class CoOpVariationalSR(Evaluator):
         inter_adapter_distances = []
         self.build_optimizer(per_epoch_steps=per_epoch_steps, lr=self.lr/10., warmup=False, finetune=True)
         self.model.vga.eval()
+        profiler = self.args.profiler
         for epoch in tqdm(range(self.args.finetune_epochs)):
-            for idx, (x, y, index) in tqdm(enumerate(memory_loader), total=len(memory_loader), desc = 'Finetuning'):
+            for idx, (x, y, index) in tqdm(enumerate(profiler.iter(memory_loader)), total=len(memory_loader), desc = 'Finetuning'):
 
                 cur_iter_idx = epoch*per_epoch_steps+idx
                 self.cur_iter_idx = cur_iter_idx
                 self.scheduler.step(cur_iter_idx)
 
-                output, (kl_loss, prior_matching_loss, inter_adapter_distance) = self.model(x.cuda(device=self.args.default_gpu), y, finetuning=True)
+                with profiler.span('forward'):
+                    output, (kl_loss, prior_matching_loss, inter_adapter_distance) = self.model(x.to(self.args.device), y, finetuning=True, indices=index)
                 # pdb.set_trace()
-                y = y.cuda(device=self.args.default_gpu)
+                y = y.to(self.args.device)
                 # pdb.set_trace()
                 loss = 0.
                 if self.args.variational:
@@ -884,10 +902,13 @@ class CoOpVariationalSR(Evaluator):
                     output = output.view(-1, output.shape[-1])
                 else:
                     targets = y 
-                loss = loss + F.cross_entropy(output, targets) + kl_loss + prior_matching_loss
+                with profiler.span('loss'):
+                    loss = loss + F.cross_entropy(output, targets) + kl_loss + prior_matching_loss
                 self.optimizer.zero_grad()
-                loss.backward()
-                self.optimizer.step()
+                with profiler.span('backward'):
+                    loss.backward()
+                with profiler.span('optimizer_step'):
+                    self.optimizer.step()
 
                 if inter_adapter_distance is not None and (epoch == self.epochs-1):
                         inter_adapter_distances.append(inter_adapter_distance)
@@ -896,9 +917,12 @@ class CoOpVariationalSR(Evaluator):
                 self.compute_class_centroids()
         if len(inter_adapter_distances):
                 print(f"Average inter-adapter distance: {np.mean(inter_adapter_distance)}")
+        if self.feature_store is not None:
+            self.feature_store.save()
 
         if self.args.sess > 0 and self.args.expandable_tokens:
             self.epoch_log()
+        self.args.profiler.log(self.metric_sinks, self.args.sess, 'finetune')
         
     @torch.no_grad()
     def preserve_copy_for_distillation(self):
@@ -936,8 +960,8 @@ class CoOpVariationalSR(Evaluator):
     def expand_adapter(self):
         ctx_dim = self.clip_model.ln_final.weight.shape[0]
         dtype = self.clip_model.dtype
-        new_mu = Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(dtype)
-        new_sigma = Adapter(ctx_dim, ctx_dim, sigma=True).cuda(device=self.args.default_gpu).type(dtype)
+        new_mu = Adapter(ctx_dim, ctx_dim).to(self.args.device).type(dtype)
+        new_sigma = Adapter(ctx_dim, ctx_dim, sigma=True).to(self.args.device).type(dtype)
         self.mu_adapters.append(new_mu)
         self.sigma_adapters.append(new_sigma)
         self.mu_adapters[:-1].eval()
@@ -947,7 +971,7 @@ class CoOpVariationalSR(Evaluator):
         freeze_parameters(self.mu_adapters[-1], requires_grad=True)
         freeze_parameters(self.sigma_adapters[-1], requires_grad=True)
         if self.args.use_det_path:
-            new_mu_deter = Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(dtype)
+            new_mu_deter = Adapter(ctx_dim, ctx_dim).to(self.args.device).type(dtype)
             self.mu_adapter_deter.append(new_mu_deter)
             self.mu_adapter_deter[:-1].eval()
             freeze_parameters(self.mu_adapter_deter[:-1], requires_grad=False)
@@ -979,7 +1003,7 @@ class CoOpVariationalSR(Evaluator):
                 self.expand_prompts()
 
         self.n_class = len(class_names)
-        clip_model = deepcopy(self.clip_model)
+        clip_model = self.clip_model
         print(f"Number of prompt vectors: {len(self.ctx)}")
 
         prev_model_components = (self.previous_ctx, 
@@ -993,7 +1017,8 @@ class CoOpVariationalSR(Evaluator):
                           task_to_distribution=self.task_to_distribution,
                           mu_global_adapter=self.mu_global_adapter if self.args.hierarchical else None, 
                           sigma_global_adapter=self.sigma_global_adapter if self.args.hierarchical else None,
-                          mu_adapter_deter=self.mu_adapter_deter, global_vga=self.vga_global
+                          mu_adapter_deter=self.mu_adapter_deter, global_vga=self.vga_global,
+                          feature_store=self.feature_store, text_feature_cache=self.text_feature_cache
                           )
         self.model.eval()
         if self.use_grad_checkpoint:
@@ -1,20 +1,22 @@
 import torch
 import torch.nn as nn
+from concurrent.futures import ThreadPoolExecutor
 from torch.nn import functional as F
 
 from tqdm import tqdm
 from copy import deepcopy
 import numpy as np
 
-from clip.clip import load, tokenize
+from clip.clip import load, tokenize, quantize_backbone, restore_backbone
 from clip.simple_tokenizer import SimpleTokenizer as _Tokenizer
 _tokenizer = _Tokenizer()
 import dataset.incremental_dataloader
 
 from .utils import build_cosine_scheduler, freeze_parameters
+from .metrics import StreamingMetrics
 import pdb
 import time
-from torchmetrics.classification import MulticlassCalibrationError
+import warnings
 from utils.display_results import get_measures, print_measures
 
 class Evaluator():
@@ -26,7 +28,23 @@ class Evaluator():
         self.task_to_ood_metrics = {}
         self.time_step_to_future_task_acc = {}
         self.time_step_to_test_id_to_module_id = {}
-        
+        self.metric_sinks = []
+        self.eval_logit_cache = {}
+
+    # rebuilt by the constructor, ``init_model`` or ``fit`` instead of being checkpointed
+    checkpoint_exclude = ('args', 'clip_model', 'model', 'optimizer', 'scheduler', 'metric_sinks',
+                          'text_feature_cache', 'feature_store', 'eval_logit_cache')
+
+    def checkpoint_state(self):
+        """State the next session builds on: adapters, VGA, task tokens, prompts, distillation copies, class maps and accuracy history."""
+        return {k: v for k, v in self.__dict__.items() if k not in self.checkpoint_exclude}
+
+    def load_checkpoint_state(self, state):
+        self.__dict__.update(state)
+
+    def add_metric_sink(self, sink):
+        """Register a callable ``sink(sess, metric_dict)`` run after every evaluation."""
+        self.metric_sinks.append(sink)
 
     def flush_task_to_accs(self):
         self.task_to_original_acc = {}
@@ -77,20 +95,17 @@ class Evaluator():
     
     def compute_ood_scores(self, id_preds, ood_test_loader, num_test=None, test_class=None):
         ood_preds = []
-        total_count, acc_count = 0, 0
+        ood_metrics = StreamingMetrics(device=self.args.device)
         for i, (x, y, idx) in tqdm(enumerate(ood_test_loader), total=len(ood_test_loader), desc=f"Running OOD inference:"):
-            pred_y_, _ = self.inference(x.cuda(device=self.args.default_gpu), y, num_test=num_test, test_class=test_class)
+            pred_y_, _ = self.inference(x.to(self.args.device, non_blocking=True), y, num_test=num_test, test_class=test_class)
             if pred_y_.dim() == 3:
                 pred_y_ = pred_y_.permute(1, 0, 2)
-            ood_preds.append(pred_y_.clone().cpu())
+            ood_preds.append(pred_y_.to('cpu', non_blocking=True, copy=True))
             pred_y = pred_y_.mean(0) if pred_y_.dim() == 3 else pred_y_
-            pred_y = pred_y.softmax(dim=-1)
-            _, top_labels = pred_y.topk(1, dim=-1)
-            acc_count += (top_labels.view(-1)==y.cuda(device=self.args.default_gpu)).sum().cpu().numpy()
-            total_count += y.shape[0]
+            ood_metrics.update(pred_y.softmax(dim=-1), y.to(self.args.device, non_blocking=True))
+        acc, _, _ = ood_metrics.compute()
+        # the copies to the host are complete once compute() has synced
         ood_preds = torch.cat(ood_preds, 0)
-        acc = acc_count*1.0/total_count
-        acc = acc.item()
         self.time_step_to_future_task_acc[self.args.sess] = acc
         print(f"Future tasks avg acc: {np.mean(list(self.time_step_to_future_task_acc.values()))} {acc}")
         print(f"Total ID examples: {id_preds.shape[0]}, Total OOD examples: {ood_preds.shape[0]}")
@@ -108,6 +123,50 @@ class Evaluator():
                     means_ = np.mean(all_vals, 0)
                     print(f"Average {metric}: FPR95: {means_[2]}  || AUROC: {means_[0]} || AUPR: {means_[1]}")
     
+    def incremental_eval_supported(self):
+        return False
+
+    def incremental_inference(self, image, label, indices, loader_id, batch_id, num_test=None, test_class=None):
+        """Inference that reuses the logit columns of frozen past tasks cached for this batch
+        and only runs the modules of tasks added since."""
+        cached = self.eval_logit_cache.get((loader_id, batch_id))
+        if cached is not None and not torch.equal(cached[0], indices):
+            cached = None
+        first_task = cached[1] if cached is not None else 0
+        logits, feats = self.inference(image, label, num_test, test_class, first_task=first_task)
+        if cached is not None:
+            logits = torch.cat([cached[2].to(logits.device, non_blocking=True), logits], -1)
+        # kept on the host: the cache spans every test batch of the run
+        self.eval_logit_cache[(loader_id, batch_id)] = (indices, self.args.sess + 1, logits.to('cpu', non_blocking=True, copy=True))
+        return logits, feats
+
+    def pipelined_batches(self, loader, encode_times):
+        """Yield ``(image_features, y, idx)``, encoding the next batch on a separate thread
+        while the caller runs the rest of ``inference`` on the current one.
+
+        For CPU evaluation, where the frozen image encoder and the adapters would otherwise
+        take turns on the same cores. Both threads share torch's process-wide intra-op
+        thread count. The encoder time of every batch is appended to ``encode_times``.
+        """
+        def encode(x):
+            start = time.perf_counter()
+            x = self.encode_images(x) if x.dim() > 2 else x
+            return x, time.perf_counter() - start
+
+        with ThreadPoolExecutor(1) as pool:
+            pending = None
+            for x, y, idx in loader:
+                future = pool.submit(encode, x)
+                if pending is not None:
+                    features, encode_time = pending[0].result()
+                    encode_times.append(encode_time)
+                    yield features, pending[1], pending[2]
+                pending = (future, y, idx)
+            if pending is not None:
+                features, encode_time = pending[0].result()
+                encode_times.append(encode_time)
+                yield features, pending[1], pending[2]
+
     def map_class_id_to_module_id(self, class_id):
         module_id = torch.div(class_id, self.args.class_per_task, rounding_mode='trunc')
         return module_id
@@ -117,67 +176,75 @@ class Evaluator():
         visual_feats, textual_feats, indices, labels = [],[], [], []
         # pdb.set_trace()
         accs, accs_mask_classes = [], []
-        calibration_errors = []
         task_to_module_accuracy = {}
-        self.calibration_evaluator = MulticlassCalibrationError(num_classes=len(self.current_class_names)) if self.args.compute_ece else None 
+        # counters and calibration bins stay on the device, the host syncs once per loader
+        metrics = StreamingMetrics(device=self.args.device, compute_ece=self.args.compute_ece)
         id_preds = []
-        inference_times = []
+        inference_times, encode_times = [], []
+        incremental = self.args.incremental_eval and self.incremental_eval_supported()
+        if self.args.incremental_eval and not incremental:
+            warnings.warn(f"--incremental-eval is ignored for {type(self).__name__} with this configuration: "
+                          "past-task logits depend on modules that keep training (e.g. VGA or the global adapter)")
+        if not incremental:
+            self.eval_logit_cache = {}
+        # image features arrive pre-encoded; the encoder time is added back to the batch times below
+        pipelined = self.args.device.type == 'cpu' and self.args.cpu_encode_threads > 0 and hasattr(self, 'encode_images')
         if self.args.sess >= 0:
         #     return 0
         # else:
             for k, loader in enumerate(loaders):
-                total_count=0
-                acc_count =0
-                correct_mask_classes = 0
-                task_calibration_errors=[]
+                metrics.reset()
                 selected_module_ids = []
-                for i, (x, y, idx) in tqdm(enumerate(loader), total=len(loader), desc=f"Task {k} inference:"):
-                    start_time = time.time()
-                    pred_y_, feats = self.inference(x.cuda(device=self.args.default_gpu), y, num_test=num_test, test_class=test_class)
-                    inference_times.append(time.time() - start_time)
+                batches = self.args.profiler.iter(loader)
+                loader_encode_times = []
+                if pipelined:
+                    batches = self.pipelined_batches(batches, loader_encode_times)
+                for i, (x, y, idx) in tqdm(enumerate(batches), total=len(loader), desc=f"Task {k} inference:"):
+                    y_ = y.to(self.args.device, non_blocking=True)
+                    metrics.start_batch()
+                    if incremental:
+                        pred_y_, feats = self.incremental_inference(x.to(self.args.device, non_blocking=True), y, idx, k, i, num_test=num_test, test_class=test_class)
+                    else:
+                        pred_y_, feats = self.inference(x.to(self.args.device, non_blocking=True), y, num_test=num_test, test_class=test_class)
+                    metrics.end_batch()
                     
                     pred_y = pred_y_.mean(0) if pred_y_.dim() == 3 else pred_y_
                     pred_y = pred_y.softmax(dim=-1)
-                    _, top_labels = pred_y.topk(1, dim=-1)
-                    acc_count += (top_labels.view(-1)==y.cuda(device=self.args.default_gpu)).sum().cpu().numpy()
-                    total_count += y.shape[0]
                     if self.args.viz_module_selection:
+                        _, top_labels = pred_y.topk(1, dim=-1)
                         selected_module_id = self.map_class_id_to_module_id(top_labels)
                         selected_module_ids.append(selected_module_id)
-                    if self.args.compute_ece:
-                        task_calibration_errors.append(self.calibration_evaluator(pred_y, y.cuda(device=self.args.default_gpu)))
                     if self.args.compute_ram:
                         visual_feats.append(feats[0])
                         textual_feats.append(feats[1])
                         indices.append(deepcopy(idx))
                         labels.append(deepcopy(y))
                         del idx 
-                        del y 
 
                     if self.args.eval_ood_score and ood_test_loader is not None:
                         if pred_y_.dim() == 3:
                             pred_y_ = pred_y_.permute(1, 0, 2)
-                        id_preds.append(pred_y_.clone().cpu())
+                        # queued copy to (pinned) host memory, complete by the sync in metrics.compute()
+                        id_preds.append(pred_y_.to('cpu', non_blocking=True, copy=True))
                     
                     pred_y_ = pred_y_.mean(0) if pred_y_.dim() == 3 else pred_y_
                     self.mask_classes(pred_y_, k)
                     _, taw_pred = pred_y_.topk(1, dim=-1)
-                    correct_mask_classes += (taw_pred.view(-1)==y.cuda(device=self.args.default_gpu)).sum().cpu().numpy()
+                    metrics.update(pred_y, y_, taw_pred)
 
-                acc = acc_count*1.0/total_count
-                acc = acc.item()
+                acc, acc_taw, batch_times = metrics.compute()
+                if pipelined:
+                    # comparable with sequential runs: encoder plus the rest of inference per batch
+                    batch_times = [t + e for t, e in zip(batch_times, loader_encode_times)]
+                    encode_times.extend(loader_encode_times)
+                total_count = metrics.total
+                inference_times.extend(batch_times)
                 accs.append(acc)
-
-                acc_taw = correct_mask_classes*1.0/total_count
-                acc_taw = acc_taw.item()
                 accs_mask_classes.append(acc_taw)
 
                 if not only_eval and k == len(loaders) - 1:
                     self.task_to_original_acc[self.args.sess] = acc
 
-                if self.args.compute_ece:
-                    calibration_errors.extend(task_calibration_errors)
-
                 if self.args.viz_module_selection:
                     selected_module_ids = torch.cat(selected_module_ids)
                     module_ids, counts = torch.unique(selected_module_ids, return_counts=True)
@@ -201,9 +268,6 @@ class Evaluator():
                 labels = torch.cat(labels)
                 self.args.ram_computer.compute_rotation_angle_matrix(self.args.sess, labels, visual_feats, textual_feats, indices)
             
-            if self.args.compute_ece:
-                print(f"Avg. Expected Calibration Error: {torch.stack(calibration_errors).mean()}")
-            
             acc = np.mean(accs)
             self.time_step_to_acc[self.args.sess] = acc 
 
@@ -217,15 +281,56 @@ class Evaluator():
                     "acc_last": acc,
                     "taw_acc_avg": np.mean(list(self.time_step_to_taw_acc.values())),
                     "acc_taw": acc_taw,
-                    "ece_avg": torch.stack(calibration_errors).mean(),
                     "inf_time_avg": np.mean(inference_times)}
+            if pipelined:
+                metric_dict["encode_time_avg"] = np.mean(encode_times)
+                print(f"Average image encoding time: {metric_dict['encode_time_avg']}")
+
+            if self.args.compute_ece:
+                metric_dict["ece_avg"] = metrics.compute_ece()
+                print(f"Expected Calibration Error: {metric_dict['ece_avg']}")
             
             if self.args.sess > 0 and self.args.compute_bwt:
                 bwt = self.compute_backward_transfer(accs)
                 metric_dict["bwt"] = np.mean(bwt)
+
+            for sink in self.metric_sinks:
+                sink(self.args.sess, metric_dict)
+            self.args.profiler.log(self.metric_sinks, self.args.sess, 'test')
                 
             return metric_dict
 
+    @torch.no_grad()
+    def quantized_accuracy_delta(self, loaders, fp32_metrics, num_test=None, test_class=None):
+        """Re-run the test loaders with the frozen CLIP backbone dynamically quantized to int8 and
+        report accuracy and batch time against ``fp32_metrics`` from ``accuracy``. The fp32 layers
+        are put back afterwards, so nothing recorded for the session changes."""
+        replaced = quantize_backbone(self.clip_model)
+        metrics = StreamingMetrics(device=self.args.device)
+        accs, inference_times = [], []
+        try:
+            for k, loader in enumerate(loaders):
+                metrics.reset()
+                for x, y, idx in tqdm(loader, total=len(loader), desc=f"Task {k} int8 inference:"):
+                    metrics.start_batch()
+                    pred_y, _ = self.inference(x.to(self.args.device, non_blocking=True), y, num_test=num_test, test_class=test_class)
+                    metrics.end_batch()
+                    pred_y = pred_y.mean(0) if pred_y.dim() == 3 else pred_y
+                    metrics.update(pred_y.softmax(dim=-1), y.to(self.args.device, non_blocking=True))
+                acc, _, batch_times = metrics.compute()
+                accs.append(acc)
+                inference_times.extend(batch_times)
+        finally:
+            restore_backbone(replaced)
+        report = {"int8_acc_last": np.mean(accs),
+                  "int8_acc_delta": np.mean(accs) - fp32_metrics["acc_last"],
+                  "int8_inf_time_avg": np.mean(inference_times),
+                  "int8_speedup": fp32_metrics["inf_time_avg"] / np.mean(inference_times)}
+        print(f"Int8 backbone: Acc last: {report['int8_acc_last']}, delta vs fp32: {report['int8_acc_delta']}, speedup: {report['int8_speedup']:.2f}x")
+        for sink in self.metric_sinks:
+            sink(self.args.sess, report)
+        return report
+
     @torch.no_grad()
     def _accuracy_mpc(self, loader):
         n_class = self.n_class
@@ -233,7 +338,7 @@ class Evaluator():
         count_per_class = [0 for _ in range(n_class)]
         visual_feats, textual_feats, indices, labels = [],[], [], []
         for i, (x, y, idx) in tqdm(enumerate(loader), total=len(loader), desc = 'running inference'):
-            pred_y, feats = self.inference(x.cuda(device=self.args.default_gpu), y)
+            pred_y, feats = self.inference(x.to(self.args.device), y)
             if self.args.compute_ram:
                 visual_feats.append(feats[0])
                 textual_feats.append(feats[1])
@@ -241,8 +346,8 @@ class Evaluator():
                 labels.extend(y)
             _, top_labels = pred_y.topk(1, dim=-1)
             for c in range(n_class):
-                acc_per_class[c] += ((top_labels.view(-1) == y.cuda(device=self.args.default_gpu)) * (y.cuda(device=self.args.default_gpu)== c)).sum().item()
-                count_per_class[c] += (y.cuda(device=self.args.default_gpu) == c).sum().item()
+                acc_per_class[c] += ((top_labels.view(-1) == y.to(self.args.device)) * (y.to(self.args.device)== c)).sum().item()
+                count_per_class[c] += (y.to(self.args.device) == c).sum().item()
         acc = [a*1.0/c for (a, c) in zip(acc_per_class, count_per_class)]
         acc = np.array(acc).mean()
 
@@ -0,0 +1,116 @@
+import os
+
+import torch
+
+from clip.clip import tokenize_prompts
+
+
+class ImageFeatureStore:
+    """Persistent cache of frozen, L2-normalised CLIP image features.
+
+    One row is kept per dataset sample and addressed by the sample index the
+    datasets already return, so features are encoded once and reused across
+    epochs, tasks and runs. The store lives on the CPU and is saved to
+    ``<root>/<db_name>_<arch>_<mode>.pt``.
+    """
+    def __init__(self, root, db_name, arch, mode, num_samples):
+        self.path = os.path.join(root, f"{db_name}_{arch.replace('/', '-')}_{mode}.pt")
+        self.num_samples = num_samples
+        self.features = None
+        self.filled = torch.zeros(num_samples, dtype=torch.bool)
+        self.dirty = False
+        if os.path.isfile(self.path):
+            state = torch.load(self.path, map_location='cpu')
+            if state['features'].shape[0] == num_samples:
+                self.features, self.filled = state['features'], state['filled']
+                print(f"Loaded {int(self.filled.sum())}/{num_samples} cached image features from {self.path}")
+
+    @torch.no_grad()
+    def get_or_encode(self, images, indices, encode_fn):
+        """Return features for ``indices``, encoding (and storing) only the missing rows."""
+        indices = indices.cpu()
+        missing = ~self.filled[indices]
+        if missing.any():
+            new_features = encode_fn(images[missing.to(images.device)]).cpu()
+            if self.features is None:
+                self.features = torch.zeros(self.num_samples, new_features.shape[-1], dtype=new_features.dtype)
+            self.features[indices[missing]] = new_features
+            self.filled[indices[missing]] = True
+            self.dirty = True
+        return self.features[indices].to(images.device, non_blocking=True)
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        torch.save({'features': self.features, 'filled': self.filled}, tmp_path)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+
+class TextFeatureCache:
+    """Incremental cache of frozen prompt-ensembled class text features.
+
+    Rows are keyed by ``(class name, template, arch)`` and only classes that
+    have not been seen before go through ``encode_fn``, so every session
+    encodes just its newly arrived classes. ``features`` (``[N, D]``) and
+    ``features_individual`` (``[N, T, D]``) grow as classes are added.
+    """
+    def __init__(self, encode_fn, arch, device):
+        self.encode_fn = encode_fn
+        self.arch = arch
+        self.device = device
+        self.rows = {}
+        self.features = None
+        self.features_individual = None
+
+    _shared = {}
+
+    @classmethod
+    def shared(cls, encode_fn, arch, device, scope=None):
+        """Process-wide cache per ``(arch, device, scope)``, so classifiers built one after another reuse rows.
+
+        ``scope`` separates datasets whose template counts differ.
+        """
+        key = (arch, device, scope)
+        if key not in cls._shared:
+            cls._shared[key] = cls(encode_fn, arch, device)
+        # encode with the newest (identical, frozen) backbone so older ones can be freed
+        cls._shared[key].encode_fn = encode_fn
+        return cls._shared[key]
+
+    def __len__(self):
+        return 0 if self.features is None else self.features.shape[0]
+
+    @torch.no_grad()
+    def encode_classes(self, class_names, templates):
+        individual = []
+        all_tokens = tokenize_prompts(class_names, templates).to(self.device)
+        for tokens in all_tokens:
+            text_features = self.encode_fn(tokens)
+            individual.append(text_features / text_features.norm(dim=-1, keepdim=True))
+        individual = torch.stack(individual, dim=0)
+        features = individual.mean(dim=1)
+        features = features / features.norm(dim=-1, keepdim=True)
+        return features, individual
+
+    @torch.no_grad()
+    def __call__(self, class_names, templates):
+        """Return ``(features, features_individual)`` for ``class_names``, in order."""
+        templates = tuple(templates)
+        new_classes = [c for c in dict.fromkeys(class_names) if (c, templates, self.arch) not in self.rows]
+        if new_classes:
+            features, individual = self.encode_classes(new_classes, templates)
+            for row, c in enumerate(new_classes, len(self)):
+                self.rows[(c, templates, self.arch)] = row
+            if self.features is None:
+                self.features, self.features_individual = features, individual
+            else:
+                self.features = torch.cat([self.features, features], dim=0)
+                self.features_individual = torch.cat([self.features_individual, individual], dim=0)
+        rows = [self.rows[(c, templates, self.arch)] for c in class_names]
+        if rows == list(range(len(rows))):
+            return self.features[:len(rows)], self.features_individual[:len(rows)]
+        rows = torch.tensor(rows, device=self.features.device)
+        return self.features[rows], self.features_individual[rows]
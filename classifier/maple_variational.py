@@ -55,7 +55,7 @@ class MultiModalPromptLearner(nn.Module):
 
         self.tokenized_prompts = tokenized_prompts
         with torch.no_grad():
-            embedding = clip_model.token_embedding(tokenized_prompts.cuda(device=self.args.default_gpu)).type(self.dtype)
+            embedding = clip_model.token_embedding(tokenized_prompts.to(self.args.device)).type(self.dtype)
         
         self.register_buffer( 'token_prefix', embedding[:, :1, :]) # SOS, [n_cls, 1, ctx_dim]
         self.register_buffer( 'token_suffix', embedding[:, 1+n_ctx:,:]) # CLS, EOS, [n_cls, -1, ctx_dim]
@@ -152,7 +152,7 @@ class CLIP(nn.Module):
         self.ctx = ctx_vectors
         self.image_encoder = clip_model.visual
         self.logit_scale = clip_model.logit_scale
-        normal_clip_model, _ = load(args.ckpt_path, device=f"cuda:{args.default_gpu}", 
+        normal_clip_model, _ = load(args.ckpt_path, device=args.device, 
                                )
         normal_clip_model.eval()
         self.pretrained_text_encoder = normal_clip_model.encode_text
@@ -214,7 +214,7 @@ class CLIP(nn.Module):
         prompts = [[temp.format(c.replace("_", " ")) for temp in self.prompt_templates] for c in self.current_class_names]
         text_features_, text_features_per_prompt = [], []
         for per_cls_prompts in prompts:
-            per_cls_prompt_embs = tokenize(per_cls_prompts).cuda(device=self.args.default_gpu)
+            per_cls_prompt_embs = tokenize(per_cls_prompts).to(self.args.device)
             text_features = self.pretrained_text_encoder(per_cls_prompt_embs)
             text_features = text_features / text_features.norm(dim=-1, keepdim=True)
             text_features_per_prompt.append(text_features)
@@ -256,7 +256,7 @@ class CLIP(nn.Module):
         # nb_task_tokens = 3
         # original_query_num = 6
         # attn_shape = (9, 9)
-        mask = torch.zeros(attn_shape, dtype=torch.bool).cuda(device=self.args.default_gpu)
+        mask = torch.zeros(attn_shape, dtype=torch.bool).to(self.args.device)
         if self.args.expandable_tokens:
             for i in range(nb_task_tokens):
                 mask[original_query_num+i, original_query_num:original_query_num+i] = True
@@ -381,11 +381,11 @@ class CLIP(nn.Module):
                     prior_text_features = self.frozen_text_features_individual.clone()[start_cls_idx:end_cls_idx]
                     sims = torch.stack([prior_text_features @ rsamples[r].t() for r in range(rsamples.shape[0])], 0)
                     sims = sims.mean(2).mean(0)
-                    kl_losses.append(F.cross_entropy(sims,  torch.arange(sims.size(0)).cuda(device=self.args.default_gpu)) * self.args.beta)
+                    kl_losses.append(F.cross_entropy(sims,  torch.arange(sims.size(0)).to(self.args.device)) * self.args.beta)
                     if self.args.use_det_path:
                         sims_det = prior_text_features @ deterministic_features.t() 
                         sims_det = sims_det.mean(1)
-                        kl_losses.append(F.cross_entropy(sims_det,  torch.arange(sims_det.size(0)).cuda(device=self.args.default_gpu)) * self.args.beta)
+                        kl_losses.append(F.cross_entropy(sims_det,  torch.arange(sims_det.size(0)).to(self.args.device)) * self.args.beta)
                 logits_ = (logit_scale * image_features_normed @ text_features_.permute(0, 2, 1)) 
                 if finetuning or (not finetuning and self.args.sess == i):
                     pdist = self.get_prior_dist(context, text_features_relevant, labels, i, 
@@ -449,7 +449,7 @@ class MaPLe_var(Evaluator):
     def __init__(self, args, n_ctx=16, use_float32=False, use_grad_checkpoint=False):
         super().__init__(args)
         self.args = args
-        clip_model, _ = load(args.ckpt_path, device=f"cuda:{args.default_gpu}", 
+        clip_model, _ = load(args.ckpt_path, device=args.device, 
                                 design_details={"trainer": 'MaPLe',
                                         "vision_depth": 0,
                                         "language_depth": 0, "vision_ctx": 0,
@@ -468,7 +468,7 @@ class MaPLe_var(Evaluator):
         cfg_imsize = 224 
         self.compound_prompts_depth = 9
 
-        self.proj = nn.Linear(ctx_dim, 768).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)
+        self.proj = nn.Linear(ctx_dim, 768).to(self.args.device).type(self.clip_model.dtype)
 
         if ctx_init and (n_ctx) <= 4:
             # use given words to initialize context vectors
@@ -476,7 +476,7 @@ class MaPLe_var(Evaluator):
             n_ctx = n_ctx
             prompt = tokenize(ctx_init)
             with torch.no_grad():
-                embedding = clip_model.token_embedding(prompt.cuda(device=self.args.default_gpu)).type(dtype)
+                embedding = clip_model.token_embedding(prompt.to(self.args.device)).type(dtype)
             ctx_vectors = embedding[0, 1: 1 + n_ctx, :]
             prompt_prefix = ctx_init
         else:
@@ -493,12 +493,12 @@ class MaPLe_var(Evaluator):
         # Define the compound prompts for the deeper layers
         # Minimum can be 1, which defaults to shallow MaPLe
         # compound prompts
-        self.compound_prompts_text = nn.ParameterList([nn.Parameter(torch.empty(n_ctx, 512,  dtype=self.clip_model.dtype)).cuda(device=self.args.default_gpu)
+        self.compound_prompts_text = nn.ParameterList([nn.Parameter(torch.empty(n_ctx, 512,  dtype=self.clip_model.dtype)).to(self.args.device)
                                                       for _ in range(self.compound_prompts_depth - 1)])
         for single_para in self.compound_prompts_text:
             nn.init.normal_(single_para, std=0.02)
         # Also make corresponding projection layers, for each prompt
-        single_layer = nn.Linear(ctx_dim, 768).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)
+        single_layer = nn.Linear(ctx_dim, 768).to(self.args.device).type(self.clip_model.dtype)
         self.compound_prompt_projections = _get_clones(single_layer, self.compound_prompts_depth - 1)
 
         self.n_ctx = n_ctx # n_ctx 输入词数
@@ -512,7 +512,7 @@ class MaPLe_var(Evaluator):
         self.epochs = args.epochs
         self.train_batch = args.train_batch 
         self.current_class_names = []
-        decoder_layer = torch.nn.TransformerDecoderLayer(d_model=ctx_dim, nhead=ctx_dim//64, activation='gelu', batch_first=True).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)
+        decoder_layer = torch.nn.TransformerDecoderLayer(d_model=ctx_dim, nhead=ctx_dim//64, activation='gelu', batch_first=True).to(self.args.device).type(self.clip_model.dtype)
         self.vga = torch.nn.TransformerDecoder(decoder_layer, 1)
 
         self.get_variational_adapters(ctx_dim)
@@ -547,14 +547,14 @@ class MaPLe_var(Evaluator):
 
     def get_variational_adapters(self, ctx_dim, global_adapter=False):
         if not global_adapter:
-            self.mu_adapters = nn.ModuleList([Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)])
-            self.sigma_adapters = nn.ModuleList([Adapter(ctx_dim, ctx_dim, sigma=True).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)])
+            self.mu_adapters = nn.ModuleList([Adapter(ctx_dim, ctx_dim).to(self.args.device).type(self.clip_model.dtype)])
+            self.sigma_adapters = nn.ModuleList([Adapter(ctx_dim, ctx_dim, sigma=True).to(self.args.device).type(self.clip_model.dtype)])
             self.mu_adapter_deter = None
             if self.args.use_det_path:
-                self.mu_adapter_deter = nn.ModuleList([Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)])
+                self.mu_adapter_deter = nn.ModuleList([Adapter(ctx_dim, ctx_dim).to(self.args.device).type(self.clip_model.dtype)])
         else:
-            self.mu_global_adapter = Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)
-            self.sigma_global_adapter = Adapter(ctx_dim, ctx_dim, sigma=True).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)
+            self.mu_global_adapter = Adapter(ctx_dim, ctx_dim).to(self.args.device).type(self.clip_model.dtype)
+            self.sigma_global_adapter = Adapter(ctx_dim, ctx_dim, sigma=True).to(self.args.device).type(self.clip_model.dtype)
 
     def post_training(self, finalize=False):
         self.model.eval()
@@ -589,8 +589,8 @@ class MaPLe_var(Evaluator):
                     self.cur_iter_idx = cur_iter_idx
                     self.scheduler.step(cur_iter_idx)
 
-                    output, (kl_loss, prior_matching_loss, inter_adapter_distance) = self.model(x.cuda(device=self.args.default_gpu), y)
-                    y = y.cuda(device=self.args.default_gpu)
+                    output, (kl_loss, prior_matching_loss, inter_adapter_distance) = self.model(x.to(self.args.device), y)
+                    y = y.to(self.args.device)
                     loss = 0.
                     # pdb.set_trace()
                     if self.args.variational:
@@ -644,9 +644,9 @@ class MaPLe_var(Evaluator):
                 self.cur_iter_idx = cur_iter_idx
                 self.scheduler.step(cur_iter_idx)
 
-                output, (kl_loss, prior_matching_loss, inter_adapter_distance) = self.model(x.cuda(device=self.args.default_gpu), y, finetuning=True)
+                output, (kl_loss, prior_matching_loss, inter_adapter_distance) = self.model(x.to(self.args.device), y, finetuning=True)
                 # pdb.set_trace()
-                y = y.cuda(device=self.args.default_gpu)
+                y = y.to(self.args.device)
                 # pdb.set_trace()
                 loss = 0.
                 if self.args.variational:
@@ -677,8 +677,8 @@ class MaPLe_var(Evaluator):
     def expand_adapter(self):
         ctx_dim = self.clip_model.ln_final.weight.shape[0]
         dtype = self.clip_model.dtype
-        new_mu = Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(dtype)
-        new_sigma = Adapter(ctx_dim, ctx_dim, sigma=True).cuda(device=self.args.default_gpu).type(dtype)
+        new_mu = Adapter(ctx_dim, ctx_dim).to(self.args.device).type(dtype)
+        new_sigma = Adapter(ctx_dim, ctx_dim, sigma=True).to(self.args.device).type(dtype)
         self.mu_adapters.append(new_mu)
         self.sigma_adapters.append(new_sigma)
         self.mu_adapters[:-1].eval()
@@ -9,15 +9,16 @@ from tqdm import tqdm
 from copy import deepcopy
 import numpy as np
 
-from clip.clip import load, tokenize
+from clip.clip import load, tokenize, model_key
 from clip.simple_tokenizer import SimpleTokenizer as _Tokenizer
 _tokenizer = _Tokenizer()
 import dataset.incremental_dataloader
 
-from .utils import build_cosine_scheduler, freeze_parameters
+from .utils import build_cosine_scheduler, freeze_parameters, build_task_attention_mask
 import pdb
 import time
 from .evaluator import Evaluator
+from .feature_store import TextFeatureCache
 
 from torch.distributions.normal import Normal 
 from torch.distributions.kl import kl_divergence
@@ -51,11 +52,11 @@ class MultiModalPromptLearner(nn.Module):
         name_lens = [len(_tokenizer.encode(name)) for name in classnames]
         prompts = [prompt_prefix + " " + name + "." for name in classnames]
 
-        tokenized_prompts = torch.cat([tokenize(p) for p in prompts])  # (n_cls, n_tkn)
+        tokenized_prompts = tokenize(prompts)  # (n_cls, n_tkn)
 
         self.tokenized_prompts = tokenized_prompts
         with torch.no_grad():
-            embedding = clip_model.token_embedding(tokenized_prompts.cuda(device=self.args.default_gpu)).type(self.dtype)
+            embedding = clip_model.token_embedding(tokenized_prompts.to(self.args.device)).type(self.dtype)
         
         self.register_buffer( 'token_prefix', embedding[:, :1, :]) # SOS, [n_cls, 1, ctx_dim]
         self.register_buffer( 'token_suffix', embedding[:, 1+n_ctx:,:]) # CLS, EOS, [n_cls, -1, ctx_dim]
@@ -137,7 +138,7 @@ class CLIP(nn.Module):
                   vga=None,  mu_adapters=None, sigma_adapters=None, task_tokens=None, 
                  task_to_cls_num=None, prompt_templates=None, previous_components=None,
                  task_to_distribution=None, mu_global_adapter=None, sigma_global_adapter=None,
-                 mu_adapter_deter=None, global_vga=None):
+                 mu_adapter_deter=None, global_vga=None, text_feature_cache=None):
         super().__init__()
         self.n_class = len(class_names)
         self.args = args
@@ -152,10 +153,11 @@ class CLIP(nn.Module):
         self.ctx = ctx_vectors
         self.image_encoder = clip_model.visual
         self.logit_scale = clip_model.logit_scale
-        normal_clip_model, _ = load(args.ckpt_path, device=f"cuda:{args.default_gpu}", 
-                               )
-        normal_clip_model.eval()
-        self.pretrained_text_encoder = normal_clip_model.encode_text
+        if text_feature_cache is None:
+            normal_clip_model, _ = load(args.ckpt_path, device=args.device)
+            normal_clip_model.eval()
+            text_feature_cache = TextFeatureCache(normal_clip_model.encode_text, model_key(args.ckpt_path), args.device)
+        self.text_feature_cache = text_feature_cache
 
         self.current_class_names = class_names
         # prompt learner
@@ -180,6 +182,7 @@ class CLIP(nn.Module):
         self.prompt_templates = prompt_templates
         self.prior_text_features()
         self.class_to_task_mapping = {} # for faster indexing to get task ids
+        self.attn_mask_cache = {}
         self.init_new_heads()
 
     def init_new_heads(self):
@@ -211,18 +214,8 @@ class CLIP(nn.Module):
 
     @torch.no_grad()
     def prior_text_features(self):
-        prompts = [[temp.format(c.replace("_", " ")) for temp in self.prompt_templates] for c in self.current_class_names]
-        text_features_, text_features_per_prompt = [], []
-        for per_cls_prompts in prompts:
-            per_cls_prompt_embs = tokenize(per_cls_prompts).cuda(device=self.args.default_gpu)
-            text_features = self.pretrained_text_encoder(per_cls_prompt_embs)
-            text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-            text_features_per_prompt.append(text_features)
-            text_features = text_features.mean(dim=0)
-            text_features = text_features / text_features.norm()
-            text_features_.append(text_features)
-        self.frozen_text_features = torch.stack(text_features_, dim=0)
-        self.frozen_text_features_individual = torch.stack(text_features_per_prompt, dim=0)
+        # only classes new to the cache are encoded, earlier tasks are reused
+        self.frozen_text_features, self.frozen_text_features_individual = self.text_feature_cache(self.current_class_names, self.prompt_templates)
 
     def get_variational_adapter_features(self, x, i=None, distill=False, global_adapter=False):
         if global_adapter:
@@ -250,32 +243,13 @@ class CLIP(nn.Module):
         False True False False False
         True False False False False
         """
-        # self.task_to_cls_num[0] = 2
-        # self.task_to_cls_num[1] = 2
-        # self.task_to_cls_num[2] = 2
-        # nb_task_tokens = 3
-        # original_query_num = 6
-        # attn_shape = (9, 9)
-        mask = torch.zeros(attn_shape, dtype=torch.bool).cuda(device=self.args.default_gpu)
-        if self.args.expandable_tokens:
-            for i in range(nb_task_tokens):
-                mask[original_query_num+i, original_query_num:original_query_num+i] = True
-                mask[original_query_num+i, original_query_num+i+1:original_query_num+nb_task_tokens] = True
-
-        start_cls_idx, end_cls_idx = 0, 0 
-        for i in range(nb_task_tokens):
-            start_cls_idx = end_cls_idx
-            end_cls_idx += self.task_to_cls_num[i]
-            curr_class_indices = np.arange(start_cls_idx, end_cls_idx)
-            for cls in curr_class_indices:
-                mask[cls][:start_cls_idx] = True 
-                mask[cls][end_cls_idx:] = True
-                if self.args.expandable_tokens:
-                    mask[cls][original_query_num+i] = False
-            if self.args.expandable_tokens:
-                mask[original_query_num+i, :start_cls_idx] = True 
-                mask[original_query_num+i, end_cls_idx:original_query_num] = True
-        return mask
+        key = (tuple(attn_shape), nb_task_tokens, original_query_num)
+        if key not in self.attn_mask_cache:
+            # task sizes never change once added, so the mask is fixed for the session
+            mask = build_task_attention_mask(self.task_to_cls_num, nb_task_tokens, self.args.expandable_tokens)
+            assert mask.shape == key[0]
+            self.attn_mask_cache[key] = mask.to(self.args.device)
+        return self.attn_mask_cache[key]
 
     @staticmethod
     def get_contrastive_matrix(text_feats, image_feats, logit_scale=None):
@@ -290,6 +264,7 @@ class CLIP(nn.Module):
         
 
     def forward(self, image, labels=None, test=False, finetuning=False, return_mean=True, for_prior=None):
+        profiler = self.args.profiler
         tokenized_prompts = self.tokenized_prompts
         logit_scale = self.logit_scale.exp()
 
@@ -297,8 +272,10 @@ class CLIP(nn.Module):
         prev_cls_num = self.n_class - self.task_to_cls_num[self.args.sess]
         if test:
             with torch.no_grad():
-                text_features = self.text_encoder(self.prompts, tokenized_prompts, self.deep_compound_prompts_text)
-                image_features = self.image_encoder(image.type(self.dtype), self.shared_ctx, self.deep_compound_prompts_vision) 
+                with profiler.span('text_encoding'):
+                    text_features = self.text_encoder(self.prompts, tokenized_prompts, self.deep_compound_prompts_text)
+                with profiler.span('image_encoding'):
+                    image_features = self.image_encoder(image.type(self.dtype), self.shared_ctx, self.deep_compound_prompts_vision) 
                 image_features_normed = image_features / image_features.norm(dim=-1, keepdim=True)
 
                 context = image_features_normed.clone() # torch.cat([image_features.unsqueeze(0), self.task_token_two[-1]], 1)
@@ -308,7 +285,8 @@ class CLIP(nn.Module):
                     query = torch.cat([query] + [token for token in self.task_tokens], 1)                
                 attn_mask = self.get_attention_mask((query.shape[1], query.shape[1]), self.args.sess+1, text_features.shape[0])
                 if self.args.use_vga:
-                    vga_features = self.vga(query, context.unsqueeze(0), tgt_mask=attn_mask).squeeze(0)
+                    with profiler.span('vga'):
+                        vga_features = self.vga(query, context.unsqueeze(0), tgt_mask=attn_mask).squeeze(0)
                 logits =[]
                 samplewise_text_feats = []
                 start_cls_idx, end_cls_idx = 0, 0
@@ -334,8 +312,10 @@ class CLIP(nn.Module):
                 return logits, (None,None)
         else:
             prompts, shared_ctx, deep_compound_prompts_text, deep_compound_prompts_vision = self.prompt_learner()
-            text_features = self.text_encoder(prompts, tokenized_prompts, deep_compound_prompts_text)
-            image_features = self.image_encoder(image.type(self.dtype), shared_ctx, deep_compound_prompts_vision)
+            with profiler.span('text_encoding'):
+                text_features = self.text_encoder(prompts, tokenized_prompts, deep_compound_prompts_text)
+            with profiler.span('image_encoding'):
+                image_features = self.image_encoder(image.type(self.dtype), shared_ctx, deep_compound_prompts_vision)
             image_features_normed = image_features / image_features.norm(dim=-1, keepdim=True)
 
             text_features = text_features.view(n_class, -1)
@@ -349,7 +329,8 @@ class CLIP(nn.Module):
             query = text_features.clone().unsqueeze(0)
             attn_mask = self.get_attention_mask((query.shape[1], query.shape[1]), self.args.sess+1, text_features.shape[0])
             if self.args.use_vga:
-                vga_features_all = self.vga(query, context.unsqueeze(0), tgt_mask=attn_mask).squeeze(0)
+                with profiler.span('vga'):
+                    vga_features_all = self.vga(query, context.unsqueeze(0), tgt_mask=attn_mask).squeeze(0)
 
             per_sample_text_feats = []
             taskwise_means = []
@@ -451,15 +432,19 @@ class MaPLe_varSR(Evaluator):
     def __init__(self, args, n_ctx=16, use_float32=False, use_grad_checkpoint=False):
         super().__init__(args)
         self.args = args
-        clip_model, _ = load(args.ckpt_path, device=f"cuda:{args.default_gpu}", 
+        clip_model, _ = load(args.ckpt_path, device=args.device, 
                                 design_details={"trainer": 'MaPLe',
                                         "vision_depth": 0,
                                         "language_depth": 0, "vision_ctx": 0,
                                         "language_ctx": 0,
                                         "maple_length": 2})
         clip_model.eval()
+        # feature caches of this backbone are keyed on it
+        self.backbone = model_key(args.ckpt_path)
         if use_float32:
             clip_model.float()
+        # frozen backbone shared by the CLIP wrapper of every session
+        freeze_parameters(clip_model, requires_grad=False)
         self.clip_model = clip_model
         self.use_grad_checkpoint = use_grad_checkpoint
         ctx_dim = self.clip_model.ln_final.weight.shape[0]
@@ -470,7 +455,7 @@ class MaPLe_varSR(Evaluator):
         cfg_imsize = 224 
         self.compound_prompts_depth = 9
 
-        self.proj = nn.Linear(ctx_dim, 768).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)
+        self.proj = nn.Linear(ctx_dim, 768).to(self.args.device).type(self.clip_model.dtype)
 
         if ctx_init and (n_ctx) <= 4:
             # use given words to initialize context vectors
@@ -478,7 +463,7 @@ class MaPLe_varSR(Evaluator):
             n_ctx = n_ctx
             prompt = tokenize(ctx_init)
             with torch.no_grad():
-                embedding = clip_model.token_embedding(prompt.cuda(device=self.args.default_gpu)).type(dtype)
+                embedding = clip_model.token_embedding(prompt.to(self.args.device)).type(dtype)
             ctx_vectors = embedding[0, 1: 1 + n_ctx, :]
             prompt_prefix = ctx_init
         else:
@@ -495,12 +480,12 @@ class MaPLe_varSR(Evaluator):
         # Define the compound prompts for the deeper layers
         # Minimum can be 1, which defaults to shallow MaPLe
         # compound prompts
-        self.compound_prompts_text = nn.ParameterList([nn.Parameter(torch.empty(n_ctx, 512,  dtype=self.clip_model.dtype)).cuda(device=self.args.default_gpu)
+        self.compound_prompts_text = nn.ParameterList([nn.Parameter(torch.empty(n_ctx, 512,  dtype=self.clip_model.dtype)).to(self.args.device)
                                                       for _ in range(self.compound_prompts_depth - 1)])
         for single_para in self.compound_prompts_text:
             nn.init.normal_(single_para, std=0.02)
         # Also make corresponding projection layers, for each prompt
-        single_layer = nn.Linear(ctx_dim, 768).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)
+        single_layer = nn.Linear(ctx_dim, 768).to(self.args.device).type(self.clip_model.dtype)
         self.compound_prompt_projections = _get_clones(single_layer, self.compound_prompts_depth - 1)
 
         self.n_ctx = n_ctx # n_ctx 输入词数
@@ -514,7 +499,7 @@ class MaPLe_varSR(Evaluator):
         self.epochs = args.epochs
         self.train_batch = args.train_batch 
         self.current_class_names = []
-        decoder_layer = torch.nn.TransformerDecoderLayer(d_model=ctx_dim, nhead=ctx_dim//64, activation='gelu', batch_first=True).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)
+        decoder_layer = torch.nn.TransformerDecoderLayer(d_model=ctx_dim, nhead=ctx_dim//64, activation='gelu', batch_first=True).to(self.args.device).type(self.clip_model.dtype)
         self.vga = torch.nn.TransformerDecoder(decoder_layer, 1)
 
         self.get_variational_adapters(ctx_dim)
@@ -529,6 +514,17 @@ class MaPLe_varSR(Evaluator):
         self.previous_task_tokens = None
         self.previous_vga = None
 
+        self.text_feature_cache = None
+
+    def get_text_feature_cache(self):
+        # the MaPLe-design encoder consumes prompts, so priors come from a plain CLIP
+        # text encoder that is loaded once for the whole run instead of once per task
+        if self.text_feature_cache is None:
+            normal_clip_model, _ = load(self.args.ckpt_path, device=self.args.device)
+            normal_clip_model.eval()
+            self.text_feature_cache = TextFeatureCache.shared(normal_clip_model.encode_text, self.backbone, self.args.device, scope=self.args.db_name)
+        return self.text_feature_cache
+
     @staticmethod
     def get_div_logits(outputs, nb_old_classes, nb_new_classes):
         outputs_div = outputs[:, :, nb_old_classes:nb_old_classes+nb_new_classes] 
@@ -549,14 +545,14 @@ class MaPLe_varSR(Evaluator):
 
     def get_variational_adapters(self, ctx_dim, global_adapter=False):
         if not global_adapter:
-            self.mu_adapters = nn.ModuleList([Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)])
-            self.sigma_adapters = nn.ModuleList([Adapter(ctx_dim, ctx_dim, sigma=True).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)])
+            self.mu_adapters = nn.ModuleList([Adapter(ctx_dim, ctx_dim).to(self.args.device).type(self.clip_model.dtype)])
+            self.sigma_adapters = nn.ModuleList([Adapter(ctx_dim, ctx_dim, sigma=True).to(self.args.device).type(self.clip_model.dtype)])
             self.mu_adapter_deter = None
             if self.args.use_det_path:
-                self.mu_adapter_deter = nn.ModuleList([Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)])
+                self.mu_adapter_deter = nn.ModuleList([Adapter(ctx_dim, ctx_dim).to(self.args.device).type(self.clip_model.dtype)])
         else:
-            self.mu_global_adapter = Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)
-            self.sigma_global_adapter = Adapter(ctx_dim, ctx_dim, sigma=True).cuda(device=self.args.default_gpu).type(self.clip_model.dtype)
+            self.mu_global_adapter = Adapter(ctx_dim, ctx_dim).to(self.args.device).type(self.clip_model.dtype)
+            self.sigma_global_adapter = Adapter(ctx_dim, ctx_dim, sigma=True).to(self.args.device).type(self.clip_model.dtype)
 
     def post_training(self, finalize=False):
         self.model.eval()
@@ -584,15 +580,17 @@ class MaPLe_varSR(Evaluator):
         # self.model.eval()
         self.model.vga.train()
         if self.args.sess >= 0:
+            profiler = self.args.profiler
             for epoch in tqdm(range(self.epochs)):
-                for idx, (x, y, index) in tqdm(enumerate(train_loader), total=len(train_loader), desc = 'Training'):
+                for idx, (x, y, index) in tqdm(enumerate(profiler.iter(train_loader)), total=len(train_loader), desc = 'Training'):
 
                     cur_iter_idx = epoch*per_epoch_steps+idx
                     self.cur_iter_idx = cur_iter_idx
                     self.scheduler.step(cur_iter_idx)
 
-                    output, (kl_loss, prior_matching_loss, inter_adapter_distance) = self.model(x.cuda(device=self.args.default_gpu), y)
-                    y = y.cuda(device=self.args.default_gpu)
+                    with profiler.span('forward'):
+                        output, (kl_loss, prior_matching_loss, inter_adapter_distance) = self.model(x.to(self.args.device), y)
+                    y = y.to(self.args.device)
                     loss = 0.
                     # pdb.set_trace()
                     if self.args.variational:
@@ -602,10 +600,13 @@ class MaPLe_varSR(Evaluator):
                         output = output.view(-1, output.shape[-1])
                     else:
                         targets = y 
-                    loss = loss + F.cross_entropy(output, targets) + kl_loss + prior_matching_loss
+                    with profiler.span('loss'):
+                        loss = loss + F.cross_entropy(output, targets) + kl_loss + prior_matching_loss
                     self.optimizer.zero_grad()
-                    loss.backward()
-                    self.optimizer.step()
+                    with profiler.span('backward'):
+                        loss.backward()
+                    with profiler.span('optimizer_step'):
+                        self.optimizer.step()
                     
                     if inter_adapter_distance is not None and (epoch == self.epochs-1):
                         inter_adapter_distances.append(inter_adapter_distance)
@@ -621,6 +622,7 @@ class MaPLe_varSR(Evaluator):
         # pdb.set_trace()
             # print(self.model.prompt_learner.ctx)
             # print(self.model.image_encoder.layer1[0].conv1.weight[0])
+        self.args.profiler.log(self.metric_sinks, self.args.sess, 'train')
         self.model.eval()
         self.model.vga.train()
         return self.model
@@ -639,16 +641,18 @@ class MaPLe_varSR(Evaluator):
         inter_adapter_distances = []
         self.build_optimizer(per_epoch_steps=per_epoch_steps, lr=self.lr/10., warmup=False, finetune=True)
         self.model.vga.eval()
+        profiler = self.args.profiler
         for epoch in tqdm(range(self.args.finetune_epochs)):
-            for idx, (x, y, index) in tqdm(enumerate(memory_loader), total=len(memory_loader), desc = 'Finetuning'):
+            for idx, (x, y, index) in tqdm(enumerate(profiler.iter(memory_loader)), total=len(memory_loader), desc = 'Finetuning'):
 
                 cur_iter_idx = epoch*per_epoch_steps+idx
                 self.cur_iter_idx = cur_iter_idx
                 self.scheduler.step(cur_iter_idx)
 
-                output, (kl_loss, prior_matching_loss, inter_adapter_distance) = self.model(x.cuda(device=self.args.default_gpu), y, finetuning=True)
+                with profiler.span('forward'):
+                    output, (kl_loss, prior_matching_loss, inter_adapter_distance) = self.model(x.to(self.args.device), y, finetuning=True)
                 # pdb.set_trace()
-                y = y.cuda(device=self.args.default_gpu)
+                y = y.to(self.args.device)
                 # pdb.set_trace()
                 loss = 0.
                 if self.args.variational:
@@ -656,10 +660,13 @@ class MaPLe_varSR(Evaluator):
                     output = output.view(-1, output.shape[-1])
                 else:
                     targets = y 
-                loss = loss + F.cross_entropy(output, targets) + kl_loss + prior_matching_loss
+                with profiler.span('loss'):
+                    loss = loss + F.cross_entropy(output, targets) + kl_loss + prior_matching_loss
                 self.optimizer.zero_grad()
-                loss.backward()
-                self.optimizer.step()
+                with profiler.span('backward'):
+                    loss.backward()
+                with profiler.span('optimizer_step'):
+                    self.optimizer.step()
 
                 if inter_adapter_distance is not None and (epoch == self.epochs-1):
                         inter_adapter_distances.append(inter_adapter_distance)
@@ -671,6 +678,7 @@ class MaPLe_varSR(Evaluator):
 
         if self.args.sess > 0 and self.args.expandable_tokens:
             self.epoch_log()
+        self.args.profiler.log(self.metric_sinks, self.args.sess, 'finetune')
         
     @torch.no_grad()
     def preserve_copy_for_distillation(self):
@@ -679,8 +687,8 @@ class MaPLe_varSR(Evaluator):
     def expand_adapter(self):
         ctx_dim = self.clip_model.ln_final.weight.shape[0]
         dtype = self.clip_model.dtype
-        new_mu = Adapter(ctx_dim, ctx_dim).cuda(device=self.args.default_gpu).type(dtype)
-        new_sigma = Adapter(ctx_dim, ctx_dim, sigma=True).cuda(device=self.args.default_gpu).type(dtype)
+        new_mu = Adapter(ctx_dim, ctx_dim).to(self.args.device).type(dtype)
+        new_sigma = Adapter(ctx_dim, ctx_dim, sigma=True).to(self.args.device).type(dtype)
         self.mu_adapters.append(new_mu)
         self.sigma_adapters.append(new_sigma)
         self.mu_adapters[:-1].eval()
@@ -709,7 +717,7 @@ class MaPLe_varSR(Evaluator):
             if self.args.expandable_prompt:
                 self.expand_prompts()
         self.n_class = len(class_names)
-        clip_model = deepcopy(self.clip_model)
+        clip_model = self.clip_model
         print(f"Number of prompt vectors: {len(self.ctx)}")
 
         prev_model_components = (
@@ -725,7 +733,8 @@ class MaPLe_varSR(Evaluator):
                                         task_to_distribution=self.task_to_distribution,
                                         mu_global_adapter=self.mu_global_adapter if self.args.hierarchical else None, 
                                         sigma_global_adapter=self.sigma_global_adapter if self.args.hierarchical else None,
-                                        mu_adapter_deter=self.mu_adapter_deter, global_vga=self.vga_global)
+                                        mu_adapter_deter=self.mu_adapter_deter, global_vga=self.vga_global,
+                                        text_feature_cache=self.get_text_feature_cache())
         
         self.model.eval()
         # if torch.cuda.device_count() > 1:
@@ -0,0 +1,86 @@
+import time
+
+import torch
+
+
+class StreamingMetrics:
+    """Accumulates accuracy, calibration and timing statistics on the device.
+
+    ``update`` only issues device ops, so nothing is copied to the host until
+    ``compute`` is called once the loader has been consumed. Accuracy counters
+    are reset per loader with ``reset``; calibration bins span every loader so
+    ``compute_ece`` returns the L1 expected calibration error of the whole
+    evaluation (same binning as torchmetrics' ``MulticlassCalibrationError``).
+    Batches are timed with CUDA events on a GPU and the host clock on the CPU.
+    """
+    def __init__(self, device, n_bins=15, compute_ece=False):
+        self.device = device
+        self.cuda_timing = torch.device(device).type == 'cuda'
+        self.n_bins = n_bins
+        self.bin_boundaries = torch.linspace(0, 1, n_bins + 1, device=device)
+        self.bin_count = torch.zeros(n_bins, device=device)
+        self.bin_conf = torch.zeros(n_bins, device=device)
+        self.bin_acc = torch.zeros(n_bins, device=device)
+        self.compute_calibration = compute_ece
+        self.reset()
+
+    def reset(self):
+        self.correct = torch.zeros((), dtype=torch.long, device=self.device)
+        self.correct_taw = torch.zeros((), dtype=torch.long, device=self.device)
+        self.total = 0
+        self.timings = []
+
+    def start_batch(self):
+        if not self.cuda_timing:
+            self.timings.append([time.perf_counter(), None])
+            return
+        start = torch.cuda.Event(enable_timing=True)
+        start.record()
+        self.timings.append([start, None])
+
+    def end_batch(self):
+        if not self.cuda_timing:
+            self.timings[-1][1] = time.perf_counter()
+            return
+        end = torch.cuda.Event(enable_timing=True)
+        end.record()
+        self.timings[-1][1] = end
+
+    def update(self, probs, targets, taw_preds=None):
+        confidences, preds = probs.max(dim=-1)
+        hits = preds == targets
+        self.correct += hits.sum()
+        if taw_preds is not None:
+            self.correct_taw += (taw_preds.view(-1) == targets).sum()
+        self.total += targets.shape[0]
+        if self.compute_calibration:
+            confidences = confidences.float()
+            bins = (torch.bucketize(confidences, self.bin_boundaries, right=True) - 1).clamp_(0, self.n_bins - 1)
+            self.bin_count.scatter_add_(0, bins, torch.ones_like(confidences))
+            self.bin_conf.scatter_add_(0, bins, confidences)
+            self.bin_acc.scatter_add_(0, bins, hits.float())
+
+    def compute(self):
+        """Sync once and return ``(acc, taw_acc, batch_times)`` for the current loader."""
+        correct, correct_taw = torch.stack([self.correct, self.correct_taw]).tolist()
+        if not self.cuda_timing:
+            return correct / self.total, correct_taw / self.total, [end - start for start, end in self.timings]
+        if self.timings:
+            self.timings[-1][1].synchronize()
+        batch_times = [start.elapsed_time(end) / 1000. for start, end in self.timings]
+        return correct / self.total, correct_taw / self.total, batch_times
+
+    def compute_ece(self):
+        count = self.bin_count.clamp(min=1)
+        gaps = (self.bin_acc / count - self.bin_conf / count).abs()
+        return (gaps * self.bin_count / self.bin_count.sum()).sum().item()
+
+
+class SummaryWriterSink:
+    """Metric sink that logs every scalar of a metric dict to a tensorboard writer."""
+    def __init__(self, writer):
+        self.writer = writer
+
+    def __call__(self, step, metrics):
+        for k, v in metrics.items():
+            self.writer.add_scalar(k, v, step)
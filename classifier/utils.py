@@ -104,6 +104,19 @@ def freeze_parameters(m, requires_grad=False):
         for p in m.parameters():
             p.requires_grad = requires_grad
 
+def build_task_attention_mask(task_to_cls_num, nb_task_tokens, expandable_tokens=False):
+    """Block-diagonal VGA attention mask (True = blocked) over classes and task tokens.
+
+    Each query position is labelled with its task id (classes by repeating the task id
+    ``task_to_cls_num[i]`` times, task tokens by their own index) and may only attend
+    to positions carrying the same label.
+    """
+    cls_nums = torch.tensor([task_to_cls_num[i] for i in range(nb_task_tokens)])
+    task_ids = torch.repeat_interleave(torch.arange(nb_task_tokens), cls_nums)
+    if expandable_tokens:
+        task_ids = torch.cat([task_ids, torch.arange(nb_task_tokens)])
+    return task_ids.unsqueeze(1) != task_ids.unsqueeze(0)
+
 def cosine_schedule_warmup(total_step, value, final_value=0, warmup_step=0, warmup_value=0):
     if warmup_step > 0:
         warmup_schedule = np.linspace(warmup_value, value, warmup_step+2)[1:-1]
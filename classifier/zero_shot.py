@@ -3,7 +3,7 @@ import torch.nn as nn
 import numpy as np 
 from tqdm import tqdm
 
-from clip.clip import load, tokenize
+from clip.clip import load, tokenize_prompts
 from .evaluator import Evaluator
 
 # import open_clip
@@ -13,7 +13,7 @@ class ZeroshotCLIP(Evaluator):
     def __init__(self, args):
         super().__init__(args)
         self.args = args
-        self.clip_model, _ = load(args.ckpt_path, device=f"cuda:{args.default_gpu}")
+        self.clip_model, _ = load(args.ckpt_path, device=args.device)
         self.clip_model = self.clip_model.eval()
         self.current_class_names = []
 
@@ -22,11 +22,10 @@ class ZeroshotCLIP(Evaluator):
         self.current_class_names += data['class_names']
         print(f"Class names: {self.current_class_names}")
         self.n_class = len(self.current_class_names)
-        prompts = [[temp.format(c.replace("_", " ")) for temp in data['prompt_templates'] ] for c in self.current_class_names]
+        prompts = tokenize_prompts(self.current_class_names, data['prompt_templates']).to(self.args.device)
         self.text_features = []
         with torch.no_grad():
-            for per_cls_prompts in prompts:
-                per_cls_prompt_embs = tokenize(per_cls_prompts).cuda(device=self.args.default_gpu)
+            for per_cls_prompt_embs in prompts:
                 text_features = self.clip_model.encode_text(per_cls_prompt_embs)
                 text_features = text_features / text_features.norm(dim=-1, keepdim=True)
                 text_features = text_features.mean(dim=0)
@@ -1,11 +1,15 @@
 import os
+import copy
+import json
 import hashlib
 import urllib
 import warnings
+from functools import lru_cache
 from typing import Any, Union, List
 
 from PIL import Image
 import torch
+import torch.nn as nn
 from tqdm import tqdm
 from torchvision.transforms import Compose, Resize, CenterCrop, ToTensor, Normalize
 
@@ -21,7 +25,7 @@ except ImportError:
 if torch.__version__.split(".") < ["1","7","1"]:
     warnings.warn("PyTorch version 1.7.1 or higher is recommended")
 
-__all__ = ["available_models", "load", "tokenize"]
+__all__ = ["available_models", "load", "enable_model_cache", "model_key", "quantize_backbone", "restore_backbone", "tokenize", "tokenize_prompts"]
 _tokenizer = _Tokenizer()
 
 _MODELS = {
@@ -36,6 +40,45 @@ _MODELS = {
     "ViT-L/14@336px": "https://openaipublic.azureedge.net/clip/models/3035c92b350959924f9f00213499208652fc7ea050643e8b385c2dac08641f02/ViT-L-14-336px.pt",
     }
 
+# built models kept on the CPU by ``load`` once ``enable_model_cache`` is called
+_model_cache = None
+
+
+def enable_model_cache():
+    """Makes later ``load`` calls of an already built checkpoint copy it instead of rebuilding it."""
+    global _model_cache
+    if _model_cache is None:
+        _model_cache = {}
+
+
+def _sha256(path:str):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _is_verified(path:str, expected_sha256:str):
+    """Checks the file digest, re-hashing only if the file changed since the digest sidecar was written."""
+    sidecar = path + ".sha256"
+    stat = os.stat(path)
+    try:
+        with open(sidecar) as f:
+            record = json.load(f)
+        if record["size"] == stat.st_size and record["mtime_ns"] == stat.st_mtime_ns:
+            return record["sha256"] == expected_sha256
+    except (OSError, ValueError, KeyError):
+        pass
+    digest = _sha256(path)
+    if digest == expected_sha256:
+        tmp = f"{sidecar}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest}, f)
+        os.replace(tmp, sidecar)
+    return digest == expected_sha256
+
+
 def _download(url:str,root:str):
     os.makedirs(root,exist_ok=True)
     filename = os.path.basename(url)
@@ -47,7 +90,7 @@ def _download(url:str,root:str):
         raise RuntimeError(f"{download_target} exists and is not a regular file")
         
     if os.path.isfile(download_target):
-        if hashlib.sha256(open(download_target, "rb").read()).hexdigest() == expected_sha256:
+        if _is_verified(download_target, expected_sha256):
             return download_target
         else:
             warnings.warn(f"{download_target} exists, but the SHA256 checksum does not match; re-downloading the file")
@@ -62,7 +105,7 @@ def _download(url:str,root:str):
                 output.write(buffer)
                 loop.update(len(buffer))
 
-    if hashlib.sha256(open(download_target,"rb").read()).hexdigest()!= expected_sha256:
+    if not _is_verified(download_target, expected_sha256):
         raise RuntimeError(f"Model has been downloaded but the SHA256 checksum does not not match")
 
     return download_target
@@ -83,7 +126,83 @@ def available_models() -> List[str]:
     return list(_MODELS.keys())
 
 
-def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_available() else "cpu", jit: bool = False, download_root: str = None, design_details={"vision_depth":0, "trainer":"", "language_depth":0}):
+def model_key(name: str, download_root: str = None) -> str:
+    """Returns a stable key for the checkpoint ``load(name)`` reads, for caches of its frozen features.
+
+    A model name and the path of its downloaded file give the same key; any other
+    checkpoint is keyed on its file name and absolute path.
+    """
+    if name in _MODELS:
+        return name.replace("/", "-")
+    path = os.path.abspath(name)
+    download_root = os.path.abspath(download_root or os.path.expanduser("~/.cache/clip"))
+    for model_name, url in _MODELS.items():
+        if path == os.path.join(download_root, os.path.basename(url)):
+            return model_name.replace("/", "-")
+    return f"{os.path.splitext(os.path.basename(path))[0]}-{hashlib.sha256(path.encode()).hexdigest()[:8]}"
+
+
+def _load_state_dict(model_path:str, cache_root:str):
+    """Returns the CPU state dict of a checkpoint without going through TorchScript.
+
+    JIT archives are unpacked once into a plain state dict under ``cache_root``
+    (never next to a user checkpoint); later loads memory-map that file so tensors
+    are paged in lazily. If the cache can not be written, the unpacked state dict
+    is used directly.
+    """
+    path_key = hashlib.sha256(os.path.abspath(model_path).encode()).hexdigest()[:16]
+    state_dict_path = os.path.join(cache_root, f"{os.path.basename(model_path)}.{path_key}.state_dict.pt")
+    if not os.path.isfile(state_dict_path) or os.path.getmtime(state_dict_path) < os.path.getmtime(model_path):
+        try:
+            state_dict = torch.jit.load(model_path, map_location="cpu").state_dict()
+        except RuntimeError:
+            return _torch_load(model_path)
+        tmp = f"{state_dict_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(cache_root, exist_ok=True)
+            torch.save(state_dict, tmp)
+            os.replace(tmp, state_dict_path)
+        except OSError as e:
+            warnings.warn(f"Could not cache the unpacked state dict of {model_path} in {cache_root}: {e}")
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+            return state_dict
+    return _torch_load(state_dict_path)
+
+
+def _torch_load(path:str):
+    try:
+        return torch.load(path, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        # torch < 2.1 has no mmap, and mmap needs the zipfile serialization format
+        return torch.load(path, map_location="cpu")
+
+
+def quantize_backbone(model):
+    """Swap the ``nn.Linear`` layers of the visual and text transformers for dynamically quantized int8 ones, in place.
+
+    CPU and inference only: the quantized layers have no backward. The projections inside
+    ``nn.MultiheadAttention`` are not ``nn.Linear`` children and stay in fp32. Returns the
+    replaced layers so ``restore_backbone`` can put them back.
+    """
+    replaced = []
+    for module in (model.visual, model.transformer):
+        for parent in list(module.modules()):
+            for name, child in list(parent.named_children()):
+                if type(child) is nn.Linear:
+                    child.qconfig = torch.ao.quantization.default_dynamic_qconfig
+                    setattr(parent, name, torch.ao.nn.quantized.dynamic.Linear.from_float(child))
+                    del child.qconfig
+                    replaced.append((parent, name, child))
+    return replaced
+
+
+def restore_backbone(replaced):
+    for parent, name, child in replaced:
+        setattr(parent, name, child)
+
+
+def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_available() else "cpu", jit: bool = False, download_root: str = None, design_details={"vision_depth":0, "trainer":"", "language_depth":0}, quantize: bool = False):
     """Load a CLIP model
 
     Parameters
@@ -100,6 +219,9 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
     download_root: str
         path to download the model files; by default, it uses "~/.cache/clip"
 
+    quantize: bool
+        Whether to dynamically quantize the linear layers of the frozen backbone to int8 (non-JIT, CPU only, inference only)
+
     Returns
     -------
     model: torch.nn.Module
@@ -108,28 +230,49 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
     preprocess : Callable[[PIL.Image], torch.Tensor]
         A torchvision transform that converts a PIL image into a tensor that the returned model can take as its input
     """
+    download_root = download_root or os.path.expanduser("~/.cache/clip")
     if name in _MODELS:
-        model_path = _download(_MODELS[name], download_root or os.path.expanduser("~/.cache/clip"))
+        model_path = _download(_MODELS[name], download_root)
     elif os.path.isfile(name):
         model_path = name 
     else:
         raise RuntimeError(f"Model {name} not found; available models = {available_models()}")
+
+    if quantize and (jit or str(device) != "cpu"):
+        raise ValueError("Dynamic int8 quantization needs a non-JIT model on the cpu")
         
+    if not jit:
+        cache_key = (model_path, repr(design_details))
+        if _model_cache is not None and cache_key in _model_cache:
+            model = copy.deepcopy(_model_cache[cache_key])
+        else:
+            model = build_model(_load_state_dict(model_path, download_root), design_details=design_details)
+            if _model_cache is not None:
+                _model_cache[cache_key] = model
+                model = copy.deepcopy(model)
+        model = model.to(device)
+        if str(device) == "cpu":
+            model.float()
+        if quantize:
+            quantize_backbone(model)
+        return model, _transform(model.visual.input_resolution)
+
     try:
         # loading JIT archive
-        model = torch.jit.load(model_path, map_location=device if jit else "cpu").eval()
+        model = torch.jit.load(model_path, map_location=device).eval()
         state_dict = None
     except RuntimeError:
         # loading saved state dict
-        if jit:
-            warnings.warn(f"File {model_path} is not a JIT archive. Loading as a state dict instead")
-            jit = False
-        state_dict = torch.load(model_path, map_location="cpu")
+        warnings.warn(f"File {model_path} is not a JIT archive. Loading as a state dict instead")
+        jit = False
+        state_dict = _torch_load(model_path)
 
     if not jit:
-        model = build_model(state_dict or model.state_dict(), design_details=design_details).to(device)
+        model = build_model(state_dict, design_details=design_details).to(device)
         if str(device) == "cpu":
             model.float()
+        if quantize:
+            quantize_backbone(model)
         return model, _transform(model.visual.input_resolution)
 
     # patch the device names
@@ -185,6 +328,20 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
 
     return model, _transform(model.input_resolution.item())
 
+@lru_cache(maxsize=65536)
+def _tokenize_text(text: str, context_length: int = 77, truncate: bool = False) -> tuple:
+    sot_token = _tokenizer.encoder["<|startoftext|>"]
+    eot_token = _tokenizer.encoder["<|endoftext|>"]
+    tokens = [sot_token] + _tokenizer.encode(text) + [eot_token]
+    if len(tokens) > context_length:
+        if truncate:
+            tokens = tokens[:context_length]
+            tokens[-1] = eot_token
+        else:
+            raise RuntimeError(f"Input {text} is too long for context length {context_length}")
+    return tuple(tokens)
+
+
 def tokenize(texts: Union[str, List[str]], context_length: int = 77, truncate: bool = False) -> torch.LongTensor:
     """
     Returns the tokenized representation of given input string(s)
@@ -208,18 +365,16 @@ def tokenize(texts: Union[str, List[str]], context_length: int = 77, truncate: b
     if isinstance(texts, str):
         texts = [texts]
 
-    sot_token = _tokenizer.encoder["<|startoftext|>"]
-    eot_token = _tokenizer.encoder["<|endoftext|>"]
-    all_tokens = [[sot_token] + _tokenizer.encode(text) + [eot_token] for text in texts]
-    result = torch.zeros(len(all_tokens), context_length, dtype=torch.long)
-
-    for i, tokens in enumerate(all_tokens):
-        if len(tokens) > context_length:
-            if truncate:
-                tokens = tokens[:context_length]
-                tokens[-1] = eot_token
-            else:
-                raise RuntimeError(f"Input {texts[i]} is too long for context length {context_length}")
-        result[i, :len(tokens)] = torch.tensor(tokens)
-
-    return result
\ No newline at end of file
+    # token ids are cached per string, so prompts repeated across sessions are not re-encoded
+    all_tokens = [_tokenize_text(text, context_length, truncate) for text in texts]
+    result = torch.tensor([tokens + (0,) * (context_length - len(tokens)) for tokens in all_tokens], dtype=torch.long)
+
+    return result.view(len(all_tokens), context_length)
+
+
+def tokenize_prompts(class_names: List[str], templates: List[str], context_length: int = 77, truncate: bool = False) -> torch.LongTensor:
+    """
+    Tokenizes every template filled with every class name, shape = [len(class_names), len(templates), context_length]
+    """
+    texts = [temp.format(c.replace("_", " ")) for c in class_names for temp in templates]
+    return tokenize(texts, context_length, truncate).view(len(class_names), len(templates), context_length)
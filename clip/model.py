@@ -164,6 +164,43 @@ class QuickGELU(nn.Module):
         return x * torch.sigmoid(1.702 * x)
 
 
+DEFAULT_ATTENTION_BACKEND = "sdpa" if hasattr(F, "scaled_dot_product_attention") else "mha"
+_attention_backend = DEFAULT_ATTENTION_BACKEND
+
+
+def set_attention_backend(backend=None):
+    """Select the self-attention of every ResidualAttentionBlock variant: "sdpa" for the fused
+    ``F.scaled_dot_product_attention`` kernels, or "mha" for ``nn.MultiheadAttention``.
+    ``None`` selects the default, sdpa where available."""
+    global _attention_backend
+    backend = backend or DEFAULT_ATTENTION_BACKEND
+    if backend not in ("sdpa", "mha"):
+        raise ValueError(f"Unknown attention backend: '{backend}'")
+    if backend == "sdpa" and not hasattr(F, "scaled_dot_product_attention"):
+        raise RuntimeError("The sdpa attention backend needs PyTorch 2.0 or higher")
+    _attention_backend = backend
+
+
+def residual_attention(block, x: torch.Tensor):
+    """Self-attention of ``block.attn`` on LND ``x``. The additive mask is cast once per device and dtype."""
+    attn_mask = block.attn_mask
+    if attn_mask is not None:
+        key = (x.device, x.dtype)
+        if key not in block.attn_mask_cache:
+            block.attn_mask_cache[key] = attn_mask.to(dtype=x.dtype, device=x.device)
+        attn_mask = block.attn_mask_cache[key]
+    if _attention_backend == "mha":
+        return block.attn(x, x, x, need_weights=False, attn_mask=attn_mask)[0]
+
+    # same weights as nn.MultiheadAttention: one packed qkv projection, heads batch-first as [N, H, L, D/H]
+    attn = block.attn
+    L, N, D = x.shape
+    q, k, v = F.linear(x, attn.in_proj_weight, attn.in_proj_bias).view(L, N, 3, attn.num_heads, D // attn.num_heads).permute(2, 1, 3, 0, 4)
+    x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+    x = x.permute(2, 0, 1, 3).reshape(L, N, D)
+    return F.linear(x, attn.out_proj.weight, attn.out_proj.bias)
+
+
 class ResidualAttentionBlock(nn.Module):
     def __init__(self, d_model: int, n_head: int, attn_mask: torch.Tensor = None):
         super().__init__()
@@ -177,10 +214,10 @@ class ResidualAttentionBlock(nn.Module):
         ]))
         self.ln_2 = LayerNorm(d_model)
         self.attn_mask = attn_mask
+        self.attn_mask_cache = {}
 
     def attention(self, x: torch.Tensor):
-        self.attn_mask = self.attn_mask.to(dtype=x.dtype, device=x.device) if self.attn_mask is not None else None
-        return self.attn(x, x, x, need_weights=False, attn_mask=self.attn_mask)[0]
+        return residual_attention(self, x)
 
     def forward(self, x: torch.Tensor):
         x = x + self.attention(self.ln_1(x))
@@ -207,6 +244,7 @@ class ResidualAttentionBlock_IVLP(nn.Module):
         # and the visual branch
         self.text_layer = text_layer
         self.attn_mask = attn_mask
+        self.attn_mask_cache = {}
         if i != 0:
             self.add_prompt = add_prompt
             if self.add_prompt:
@@ -223,8 +261,7 @@ class ResidualAttentionBlock_IVLP(nn.Module):
             self.add_prompt = False
 
     def attention(self, x: torch.Tensor):
-        self.attn_mask = self.attn_mask.to(dtype=x.dtype, device=x.device) if self.attn_mask is not None else None
-        return self.attn(x, x, x, need_weights=False, attn_mask=self.attn_mask)[0]
+        return residual_attention(self, x)
 
     def forward(self, x: torch.Tensor):
         # Will need to append the learnable tokens for this layer here
@@ -235,7 +272,7 @@ class ResidualAttentionBlock_IVLP(nn.Module):
                 # Remove the outputs produced by learnable tokens of previous layer
                 prefix = x[0:x.shape[0] - self.n_ctx_visual, :, :]
                 # Create/configure learnable tokens of this layer
-                visual_context = self.VPT_shallow.expand(x.shape[1], -1, -1).permute(1, 0, 2).half()
+                visual_context = self.VPT_shallow.expand(x.shape[1], -1, -1).permute(1, 0, 2).type(x.dtype)
                 # Add the learnable tokens of this layer with the input, by replacing the previous
                 # layer learnable tokens
                 x = torch.cat([prefix, visual_context], dim=0)
@@ -246,7 +283,7 @@ class ResidualAttentionBlock_IVLP(nn.Module):
                 prefix = x[:1, :, :]
                 suffix = x[1 + self.n_ctx_text:, :, :]
                 # Create/configure learnable tokens of this layer
-                textual_context = self.VPT_shallow.expand(x.shape[1], -1, -1).permute(1, 0, 2).half()
+                textual_context = self.VPT_shallow.expand(x.shape[1], -1, -1).permute(1, 0, 2).type(x.dtype)
                 # Add the learnable tokens of this layer with the input, replaced by previous
                 # layer learnable tokens
                 x = torch.cat([prefix, textual_context, suffix], dim=0)
@@ -273,6 +310,7 @@ class ResidualAttentionBlock_MaPLe(nn.Module):
         # as it will be added in the beginning, for both text and the vision branch
         self.text_layer = text_layer
         self.attn_mask = attn_mask
+        self.attn_mask_cache = {}
         # This must be consistent with the config file prompt
         self.compound_prompt_nctx = design_details['maple_length']
         if i == 0:
@@ -281,8 +319,7 @@ class ResidualAttentionBlock_MaPLe(nn.Module):
             self.first_layer = False
 
     def attention(self, x: torch.Tensor):
-        self.attn_mask = self.attn_mask.to(dtype=x.dtype, device=x.device) if self.attn_mask is not None else None
-        return self.attn(x, x, x, need_weights=False, attn_mask=self.attn_mask)[0]
+        return residual_attention(self, x)
 
     def forward(self, inputs):
         # For the first layer, we do not need to add any duplicate, as it is already added
@@ -303,7 +340,7 @@ class ResidualAttentionBlock_MaPLe(nn.Module):
                         prefix = x[0:x.shape[0] - self.compound_prompt_nctx, :, :]
                         # Create/configure learnable tokens of this layer
                         visual_context = compound_prompts_deeper[counter]  # extract the correct index
-                        visual_context = visual_context.expand(x.shape[1], -1, -1).permute(1, 0, 2).half()
+                        visual_context = visual_context.expand(x.shape[1], -1, -1).permute(1, 0, 2).type(x.dtype)
                         # Add the learnable tokens of this layer with the input, by replacing previous
                         # layer learnable tokens
                         x = torch.cat([prefix, visual_context], dim=0)
@@ -321,7 +358,7 @@ class ResidualAttentionBlock_MaPLe(nn.Module):
                         suffix = x[1 + self.compound_prompt_nctx:, :, :]
                         # Create/configure learnable tokens of this layer
                         textual_context = compound_prompts_deeper[counter]
-                        textual_context = textual_context.expand(x.shape[1], -1, -1).permute(1, 0, 2).half()
+                        textual_context = textual_context.expand(x.shape[1], -1, -1).permute(1, 0, 2).type(x.dtype)
                         # Add the learnable tokens of this layer with the input, replaced by previous
                         # layer learnable tokens
                         x = torch.cat([prefix, textual_context, suffix], dim=0)
@@ -401,7 +438,7 @@ class VisionTransformer(nn.Module):
         # After positional embeddings, we will attach prompts with the model, remember only those
         # are trainable parameters here in whole image encoder.
         if self.VPT_shallow:
-            visual_ctx = self.VPT.expand(x.shape[0], -1, -1).half()
+            visual_ctx = self.VPT.expand(x.shape[0], -1, -1).type(x.dtype)
             x = torch.cat([x, visual_ctx], dim=1)
         else:
             assert self.prompt_till_layer_visual == 0
@@ -453,7 +490,7 @@ class VisionTransformer_MaPLe(nn.Module):
         # After positional embeddings, we will attach prompts with the model, remember only those
         # are trainable parameters here in whole image encoder.
         if self.VPT_shallow:
-            visual_ctx = shared_ctx.expand(x.shape[0], -1, -1).half()
+            visual_ctx = shared_ctx.expand(x.shape[0], -1, -1).type(x.dtype)
             x = torch.cat([x, visual_ctx], dim=1)
         else:
             assert self.prompt_till_layer_visual == 0
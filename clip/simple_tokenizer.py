@@ -87,8 +87,10 @@ class SimpleTokenizer(object):
         if not pairs:
             return token+'</w>'
 
+        ranks = self.bpe_ranks
+        inf = float('inf')
         while True:
-            bigram = min(pairs, key = lambda pair: self.bpe_ranks.get(pair, float('inf')))
+            bigram = min(pairs, key = lambda pair: ranks.get(pair, inf))
             if bigram not in self.bpe_ranks:
                 break
             first, second = bigram
@@ -150,6 +150,8 @@ class cifar100(Dataset):
         self.root = root
         self.train = train
         self.transform = transform
+        # set to a TensorBatchTransform to skip PIL and transform whole batches in the collate_fn
+        self.batch_transform = None
         self.base_folder = 'cifar-100-python'
 
         if self.train:
@@ -182,6 +184,8 @@ class cifar100(Dataset):
 
     def __getitem__(self, index):
         img, target = self.data[index], self.targets[index]
+        if self.batch_transform is not None:
+            return torch.from_numpy(np.ascontiguousarray(img)), target, int(index)
         img = Image.fromarray(img)
 
         if self.transform is not None:
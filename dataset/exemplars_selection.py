@@ -14,10 +14,87 @@ from scipy.stats.mstats import gmean
 class ExemplarSelector():
     def __init__(self, args) -> None:
         self.args = args
+        self.loader_pool = None
 
-    def set_dataset_and_transform(self, dataset, transform):
+    def set_dataset_and_transform(self, dataset, transform, loader_pool=None):
         self.train_dataset = dataset
         self.val_transform = transform
+        self.loader_pool = loader_pool
+
+    @staticmethod
+    def collect_outputs(batches, forward_times):
+        """Gather the selector inputs from ``(logits, targets, idx)`` batches, one batch at a time.
+
+        ``logits`` are the raw test-time outputs, ``[S, B, C]`` or ``[B, C]``. Every input is
+        built as the per-selector loops used to build it: ``logits`` is the per-batch mean
+        over samples and ``normed_logits`` its row-normalised copy (herding). ``mc_logits``
+        is ``[N, forward_times, C]`` with row ``i`` holding the MC samples of image ``i``;
+        the old loops reshaped the flat sample-major concatenation, which mixed samples of
+        different images into one row.
+        """
+        mean_logits, normed_logits, mc_logits = [], [], []
+        extracted_targets, extracted_indices = [], []
+        for logits, targets, idx in batches:
+            logits = logits.detach()
+            mean = logits.mean(0) if logits.dim() == 3 else logits
+            mean_logits.append(mean.cpu())
+            normed_logits.append((mean / mean.norm(dim=1).view(-1, 1)).cpu())  # Feature normalization
+            mc_logits.append((logits.permute(1, 0, 2) if logits.dim() == 3 else logits.unsqueeze(1)).cpu())
+            extracted_targets.append(torch.as_tensor(targets))
+            extracted_indices.append(torch.as_tensor(idx))
+        extracted_targets = torch.cat(extracted_targets).numpy()
+        return {'logits': torch.cat(mean_logits),
+                'normed_logits': torch.cat(normed_logits),
+                'mc_logits': torch.cat(mc_logits),
+                'targets': extracted_targets,
+                'indices': torch.cat(extracted_indices).numpy()}
+
+    @torch.no_grad()
+    def extract_outputs(self, model, all_memory_indices):
+        """Single inference pass over the candidate pool shared by every selector.
+
+        Models that keep an image feature store get the sample indices so frozen image
+        features are reused instead of re-encoded.
+        """
+        if self.loader_pool is not None:
+            sel_loader = self.loader_pool.get_loader("train", all_memory_indices, self.args.train_batch, shuffle=False)
+        else:
+            sel_loader =  torch.utils.data.DataLoader(self.train_dataset, 
+                                                      batch_size=self.args.train_batch, 
+                                                      shuffle=False, 
+                                                      num_workers=4, 
+                                                      sampler=SubsetRandomSampler(all_memory_indices, False))
+        use_store = getattr(model, 'feature_store', None) is not None
+        model.eval()
+
+        def batches():
+            for _, (images, targets, idx) in tqdm(enumerate(sel_loader), total=len(sel_loader), desc = 'Extracting exemplar features..'):
+                kwargs = {'indices': idx} if use_store else {}
+                logits, _ = model(images.to(self.args.device), test=True, return_mean=False, **kwargs)
+                yield logits, targets, idx
+        return self.collect_outputs(batches(), self.args.forward_times)
+
+    def select(self, outputs, cls_ind, curr_cls, exemplars_per_class):
+        """Return positions within ``cls_ind`` of the exemplars to keep for ``curr_cls``."""
+        raise NotImplementedError
+
+    def select_from_outputs(self, outputs, exemplars_per_class):
+        extracted_targets, extracted_indices = outputs['targets'], outputs['indices']
+        result = []
+        # iterate through all classes
+        for curr_cls in np.unique(extracted_targets):
+            # get all indices from current class
+            cls_ind = np.where(extracted_targets == curr_cls)[0]
+            assert (len(cls_ind) > 0), "No samples to choose from for class {:d}".format(curr_cls)
+            assert (exemplars_per_class <= len(cls_ind)), "Not enough samples to store"
+            result.extend(cls_ind[self.select(outputs, cls_ind, curr_cls, exemplars_per_class)])
+        return extracted_indices[result], extracted_targets[result]
+
+    @torch.no_grad()
+    def select_indices(self, model, exemplars_per_class: int, memory, for_memory) -> Tuple:
+        all_memory_indices = np.concatenate([np.tile(memory[0], (1,)), for_memory[0]]) if memory is not None else for_memory[0]
+        outputs = self.extract_outputs(model, all_memory_indices)
+        return self.select_from_outputs(outputs, exemplars_per_class)
 
 class RandomExemplarsSelector(ExemplarSelector):
     """Selection of new samples. This is based on random selection, which produces a random list of samples."""
@@ -68,66 +145,35 @@ class HerdingExemplarsSelector(ExemplarSelector):
     def __init__(self, args):
         super().__init__(args)
 
-    @torch.no_grad()
-    def select_indices(self, model, exemplars_per_class: int, memory, for_memory) -> Tuple:
-        all_memory_indices = np.concatenate([np.tile(memory[0], (1,)), for_memory[0]]) if memory is not None else for_memory[0]
-        sel_loader =  torch.utils.data.DataLoader(self.train_dataset, 
-                                                  batch_size=self.args.train_batch, 
-                                                  shuffle=False, 
-                                                  num_workers=4, 
-                                                  sampler=SubsetRandomSampler(all_memory_indices, False))
-
-        # extract outputs from the model for all train samples
-        extracted_features = []
-        extracted_targets = []
-        extracted_indices = []
-        with torch.no_grad():
-            model.eval()
-            for _, (images, targets, idx) in tqdm(enumerate(sel_loader), total=len(sel_loader), desc = 'Extracting exemplar features..'):
-                feats, _ = model(images.cuda(device=self.args.default_gpu), test=True, )
-                feats = feats / feats.norm(dim=1).view(-1, 1)  # Feature normalization
-                extracted_features.append(feats)
-                extracted_targets.extend(targets)
-                extracted_indices.extend(idx)
-       
-        extracted_features = (torch.cat(extracted_features)).cpu()
-        extracted_targets = np.array(extracted_targets)
-        extracted_indices = np.array(extracted_indices)
-        result = []
-        # iterate through all classes
-        for curr_cls in np.unique(extracted_targets):
-            # get all indices from current class
-            cls_ind = np.where(extracted_targets == curr_cls)[0]
-            assert (len(cls_ind) > 0), "No samples to choose from for class {:d}".format(curr_cls)
-            assert (exemplars_per_class <= len(cls_ind)), "Not enough samples to store"
-            # get all extracted features for current class
-            cls_feats = extracted_features[cls_ind]
-            # calculate the mean
-            cls_mu = cls_feats.mean(0)
-            # select the exemplars closer to the mean of each class
-            selected = []
-            selected_feat = []
-            for k in range(exemplars_per_class):
-                # fix this to the dimension of the model features
-                sum_others = torch.zeros(cls_feats.shape[1])
-                for j in selected_feat:
-                    sum_others += j / (k + 1)
-                dist_min = np.inf
-                # choose the closest to the mean of the current class
-                for item in cls_ind:
-                    if item not in selected:
-                        feat = extracted_features[item]
-                        dist = torch.norm(cls_mu - feat / (k + 1) - sum_others)
-                        if dist < dist_min:
-                            dist_min = dist
-                            newone = item
-                            newonefeat = feat
-                selected_feat.append(newonefeat)
-                selected.append(newone)
-            result.extend(selected)
-        data_memory_, targets_memory_ = extracted_indices[result], extracted_targets[result]
-
-        return data_memory_, targets_memory_
+    @staticmethod
+    def herding(cls_feats, exemplars_per_class):
+        """Return the positions of the herded exemplars of one class, in selection order.
+
+        At step k the next exemplar minimises ||mu - (sum_selected + x) / (k + 1)||. The
+        running sum is kept as a tensor and the distance to every candidate comes from a
+        single matmul, ||a - x/(k+1)||^2 = ||a||^2 - 2 a.x/(k+1) + ||x||^2/(k+1)^2; ties go
+        to the first candidate, as in the original per-item loop.
+        """
+        cls_mu = cls_feats.mean(0).double()
+        cls_feats = cls_feats.double()
+        sq_norms = (cls_feats * cls_feats).sum(1)
+        running_sum = torch.zeros_like(cls_mu)
+        available = torch.ones(cls_feats.shape[0], dtype=torch.bool)
+        selected = []
+        for k in range(exemplars_per_class):
+            target = cls_mu - running_sum / (k + 1)
+            dist = (target @ target) - 2 * (cls_feats @ target) / (k + 1) + sq_norms / (k + 1) ** 2
+            dist[~available] = float('inf')
+            newone = int(torch.argmin(dist))
+            available[newone] = False
+            running_sum += cls_feats[newone]
+            selected.append(newone)
+        return np.array(selected, dtype=np.int64)
+
+    def select(self, outputs, cls_ind, curr_cls, exemplars_per_class):
+        feats = outputs['normed_logits'][cls_ind]
+        # select the exemplars closer to the mean of each class
+        return self.herding(feats, exemplars_per_class)
 
 
 class EntropyExemplarsSelector(ExemplarSelector):
@@ -137,47 +183,13 @@ class EntropyExemplarsSelector(ExemplarSelector):
     def __init__(self, args):
         super().__init__(args)
 
-    @torch.no_grad()
-    def select_indices(self, model, exemplars_per_class: int, memory, for_memory) -> Tuple:
-        all_memory_indices = np.concatenate([np.tile(memory[0], (1,)), for_memory[0]]) if memory is not None else for_memory[0]
-        sel_loader =  torch.utils.data.DataLoader(self.train_dataset, 
-                                                  batch_size=self.args.train_batch, 
-                                                  shuffle=False, 
-                                                  num_workers=4, 
-                                                  sampler=SubsetRandomSampler(all_memory_indices, False))
-
-        # extract outputs from the model for all train samples
-        extracted_logits = []
-        extracted_targets = []
-        extracted_indices = []
-        with torch.no_grad():
-            model.eval()
-            for _, (images, targets, idx) in tqdm(enumerate(sel_loader), total=len(sel_loader), desc = 'Extracting exemplar features..'):
-                logits, _ = model(images.cuda(device=self.args.default_gpu), test=True)
-                extracted_logits.append(logits.detach())
-                extracted_targets.extend(targets)
-                extracted_indices.extend(idx)
-        extracted_logits = (torch.cat(extracted_logits)).cpu()
-        extracted_targets = np.array(extracted_targets)
-        extracted_indices = np.array(extracted_indices)
-        result = []
-        # iterate through all classes
-        for curr_cls in np.unique(extracted_targets):
-            # get all indices from current class
-            cls_ind = np.where(extracted_targets == curr_cls)[0]
-            assert (len(cls_ind) > 0), "No samples to choose from for class {:d}".format(curr_cls)
-            assert (exemplars_per_class <= len(cls_ind)), "Not enough samples to store"
-            # get all extracted features for current class
-            cls_logits = extracted_logits[cls_ind]
-            # select the exemplars with higher entropy (lower: -entropy)
-            probs = torch.softmax(cls_logits.float(), dim=1)
-            log_probs = torch.log(probs)
-            minus_entropy =  (probs * log_probs).sum(1)  # change sign of this variable for inverse order
-            selected = cls_ind[minus_entropy.sort()[1][:exemplars_per_class]]
-            result.extend(selected)
-
-        data_memory_, targets_memory_ = extracted_indices[result], extracted_targets[result]
-        return data_memory_, targets_memory_
+    def select(self, outputs, cls_ind, curr_cls, exemplars_per_class):
+        cls_logits = outputs['logits'][cls_ind]
+        # select the exemplars with higher entropy (lower: -entropy)
+        probs = torch.softmax(cls_logits.float(), dim=1)
+        log_probs = torch.log(probs)
+        minus_entropy =  (probs * log_probs).sum(1)  # change sign of this variable for inverse order
+        return minus_entropy.sort()[1][:exemplars_per_class].numpy()
 
 class EnergyExemplarsSelector(ExemplarSelector):
     """Selection of new samples. This is based on entropy selection, which produces a sorted list of samples of one
@@ -186,53 +198,10 @@ class EnergyExemplarsSelector(ExemplarSelector):
     def __init__(self, args):
         super().__init__(args)
 
-    @torch.no_grad()
-    def select_indices(self, model, exemplars_per_class: int, memory, for_memory) -> Tuple:
-        all_memory_indices = np.concatenate([np.tile(memory[0], (1,)), for_memory[0]]) if memory is not None else for_memory[0]
-        sel_loader =  torch.utils.data.DataLoader(self.train_dataset, 
-                                                  batch_size=self.args.train_batch, 
-                                                  shuffle=False, 
-                                                  num_workers=4, 
-                                                  sampler=SubsetRandomSampler(all_memory_indices, False))
-
-        # extract outputs from the model for all train samples
-        extracted_logits = []
-        extracted_targets = []
-        extracted_indices = []
-        with torch.no_grad():
-            model.eval()
-            for _, (images, targets, idx) in tqdm(enumerate(sel_loader), total=len(sel_loader), desc = 'Extracting exemplar features..'):
-                logits, _ = model(images.cuda(device=self.args.default_gpu), test=True, return_mean=False)
-                extracted_logits.extend(logits.detach())
-                extracted_targets.extend(targets)
-                extracted_indices.extend(idx)
-        extracted_logits = (torch.cat(extracted_logits)).cpu()
-        extracted_logits = extracted_logits.reshape(len(extracted_targets), self.args.forward_times,  -1)
-        extracted_targets = np.array(extracted_targets)
-        extracted_indices = np.array(extracted_indices)
-        result = []
-        # iterate through all classes
-        for curr_cls in np.unique(extracted_targets):
-            # get all indices from current class
-            cls_ind = np.where(extracted_targets == curr_cls)[0]
-            assert (len(cls_ind) > 0), "No samples to choose from for class {:d}".format(curr_cls)
-            assert (exemplars_per_class <= len(cls_ind)), "Not enough samples to store"
-            # get all extracted features for current class
-            cls_logits = extracted_logits[cls_ind]
-            energy_scores = torch.logsumexp(cls_logits.float(), dim=-1).mean(1)
-            selected = cls_ind[energy_scores.sort()[1][:exemplars_per_class]]
-
-            # probs = probs.mean(1)
-            # log_probs = torch.log(probs)
-            # minus_entropy = (probs * log_probs).sum(1)  # try with reverse symbol with both comibation of variance symbols
-
-            # total = torch.stack([vars, minus_entropy], 0).numpy()
-            # geo_mean = gmean(total)
-            # selected = cls_ind[geo_mean.argsort()[:exemplars_per_class]]
-            result.extend(selected)
-
-        data_memory_, targets_memory_ = extracted_indices[result], extracted_targets[result]
-        return data_memory_, targets_memory_
+    def select(self, outputs, cls_ind, curr_cls, exemplars_per_class):
+        cls_logits = outputs['mc_logits'][cls_ind]
+        energy_scores = torch.logsumexp(cls_logits.float(), dim=-1).mean(1)
+        return energy_scores.sort()[1][:exemplars_per_class].numpy()
 
 
 class VarianceExemplarsSelector(ExemplarSelector):
@@ -242,55 +211,11 @@ class VarianceExemplarsSelector(ExemplarSelector):
     def __init__(self, args):
         super().__init__(args)
 
-    @torch.no_grad()
-    def select_indices(self, model, exemplars_per_class: int, memory, for_memory) -> Tuple:
-        all_memory_indices = np.concatenate([np.tile(memory[0], (1,)), for_memory[0]]) if memory is not None else for_memory[0]
-        sel_loader =  torch.utils.data.DataLoader(self.train_dataset, 
-                                                  batch_size=self.args.train_batch, 
-                                                  shuffle=False, 
-                                                  num_workers=4, 
-                                                  sampler=SubsetRandomSampler(all_memory_indices, False))
-
-        # extract outputs from the model for all train samples
-        extracted_logits = []
-        extracted_targets = []
-        extracted_indices = []
-        with torch.no_grad():
-            model.eval()
-            for _, (images, targets, idx) in tqdm(enumerate(sel_loader), total=len(sel_loader), desc = 'Extracting exemplar features..'):
-                logits, _ = model(images.cuda(device=self.args.default_gpu), test=True, return_mean=False)
-                extracted_logits.extend(logits.detach())
-                extracted_targets.extend(targets)
-                extracted_indices.extend(idx)
-        extracted_logits = (torch.cat(extracted_logits)).cpu()
-        extracted_logits = extracted_logits.reshape(len(extracted_targets), self.args.forward_times,  -1)
-        extracted_targets = np.array(extracted_targets)
-        extracted_indices = np.array(extracted_indices)
-        result = []
-        # iterate through all classes
-        for curr_cls in np.unique(extracted_targets):
-            # get all indices from current class
-            cls_ind = np.where(extracted_targets == curr_cls)[0]
-            assert (len(cls_ind) > 0), "No samples to choose from for class {:d}".format(curr_cls)
-            assert (exemplars_per_class <= len(cls_ind)), "Not enough samples to store"
-            # get all extracted features for current class
-            cls_logits = extracted_logits[cls_ind]
-            probs = torch.softmax(cls_logits.float(), dim=-1)
-            vars = probs.var(1).sum(1)
-
-            selected = cls_ind[vars.sort()[1][:exemplars_per_class]]
-
-            # probs = probs.mean(1)
-            # log_probs = torch.log(probs)
-            # minus_entropy = (probs * log_probs).sum(1)  # try with reverse symbol with both comibation of variance symbols
-
-            # total = torch.stack([vars, minus_entropy], 0).numpy()
-            # geo_mean = gmean(total)
-            # selected = cls_ind[geo_mean.argsort()[:exemplars_per_class]]
-            result.extend(selected)
-
-        data_memory_, targets_memory_ = extracted_indices[result], extracted_targets[result]
-        return data_memory_, targets_memory_
+    def select(self, outputs, cls_ind, curr_cls, exemplars_per_class):
+        cls_logits = outputs['mc_logits'][cls_ind]
+        probs = torch.softmax(cls_logits.float(), dim=-1)
+        vars = probs.var(1).sum(1)
+        return vars.sort()[1][:exemplars_per_class].numpy()
     
 class VarianceEntropyExemplarsSelector(ExemplarSelector):
     """Selection of new samples. This is based on entropy selection, which produces a sorted list of samples of one
@@ -299,53 +224,18 @@ class VarianceEntropyExemplarsSelector(ExemplarSelector):
     def __init__(self, args):
         super().__init__(args)
 
-    @torch.no_grad()
-    def select_indices(self, model, exemplars_per_class: int, memory, for_memory) -> Tuple:
-        all_memory_indices = np.concatenate([np.tile(memory[0], (1,)), for_memory[0]]) if memory is not None else for_memory[0]
-        sel_loader =  torch.utils.data.DataLoader(self.train_dataset, 
-                                                  batch_size=self.args.train_batch, 
-                                                  shuffle=False, 
-                                                  num_workers=4, 
-                                                  sampler=SubsetRandomSampler(all_memory_indices, False))
-
-        # extract outputs from the model for all train samples
-        extracted_logits = []
-        extracted_targets = []
-        extracted_indices = []
-        with torch.no_grad():
-            model.eval()
-            for _, (images, targets, idx) in tqdm(enumerate(sel_loader), total=len(sel_loader), desc = 'Extracting exemplar features..'):
-                logits, _ = model(images.cuda(device=self.args.default_gpu), test=True, return_mean=False)
-                extracted_logits.extend(logits.detach())
-                extracted_targets.extend(targets)
-                extracted_indices.extend(idx)
-        extracted_logits = (torch.cat(extracted_logits)).cpu()
-        extracted_logits = extracted_logits.reshape(len(extracted_targets), self.args.forward_times,  -1)
-        extracted_targets = np.array(extracted_targets)
-        extracted_indices = np.array(extracted_indices)
-        result = []
-        # iterate through all classes
-        for curr_cls in np.unique(extracted_targets):
-            # get all indices from current class
-            cls_ind = np.where(extracted_targets == curr_cls)[0]
-            assert (len(cls_ind) > 0), "No samples to choose from for class {:d}".format(curr_cls)
-            assert (exemplars_per_class <= len(cls_ind)), "Not enough samples to store"
-            # get all extracted features for current class
-            cls_logits = extracted_logits[cls_ind]
-            probs = torch.softmax(cls_logits.float(), dim=-1)
-            vars = probs.var(1).sum(1)
-
-            probs = probs.mean(1)
-            log_probs = torch.log(probs)
-            minus_entropy = (probs * log_probs).sum(1)  # try with reverse symbol with both comibation of variance symbols
+    def select(self, outputs, cls_ind, curr_cls, exemplars_per_class):
+        cls_logits = outputs['mc_logits'][cls_ind]
+        probs = torch.softmax(cls_logits.float(), dim=-1)
+        vars = probs.var(1).sum(1)
 
-            total = torch.stack([vars, minus_entropy], 0).numpy()
-            geo_mean = gmean(total)
-            selected = cls_ind[geo_mean.argsort()[:exemplars_per_class]]
-            result.extend(selected)
+        probs = probs.mean(1)
+        log_probs = torch.log(probs)
+        minus_entropy = (probs * log_probs).sum(1)  # try with reverse symbol with both comibation of variance symbols
 
-        data_memory_, targets_memory_ = extracted_indices[result], extracted_targets[result]
-        return data_memory_, targets_memory_
+        total = torch.stack([vars, minus_entropy], 0).numpy()
+        geo_mean = gmean(total)
+        return geo_mean.argsort()[:exemplars_per_class]
 
 class DistanceExemplarsSelector(ExemplarSelector):
     """Selection of new samples. This is based on distance-based selection, which produces a sorted list of samples of
@@ -355,42 +245,8 @@ class DistanceExemplarsSelector(ExemplarSelector):
     def __init__(self, args):
         super().__init__(args)
 
-
-    @torch.no_grad()
-    def select_indices(self, model, exemplars_per_class: int, memory, for_memory) -> Tuple:
-        all_memory_indices = np.concatenate([np.tile(memory[0], (1,)), for_memory[0]]) if memory is not None else for_memory[0]
-        sel_loader =  torch.utils.data.DataLoader(self.train_dataset, 
-                                                  batch_size=self.args.train_batch, 
-                                                  shuffle=False, 
-                                                  num_workers=4, 
-                                                  sampler=SubsetRandomSampler(all_memory_indices, False))
-
-        # extract outputs from the model for all train samples
-        extracted_logits = []
-        extracted_targets = []
-        extracted_indices = []
-        with torch.no_grad():
-            model.eval()
-            for _, (images, targets, idx) in tqdm(enumerate(sel_loader), total=len(sel_loader), desc = 'Extracting exemplar features..'):
-                logits, _ = model(images.cuda(device=self.args.default_gpu), test=True)
-                extracted_logits.append(logits.detach())
-                extracted_targets.extend(targets)
-                extracted_indices.extend(idx)
-        extracted_logits = (torch.cat(extracted_logits)).cpu()
-        extracted_targets = np.array(extracted_targets)
-        extracted_indices = np.array(extracted_indices)
-        result = []
-        # iterate through all classes
-        for curr_cls in np.unique(extracted_targets):
-            # get all indices from current class
-            cls_ind = np.where(extracted_targets == curr_cls)[0]
-            assert (len(cls_ind) > 0), "No samples to choose from for class {:d}".format(curr_cls)
-            assert (exemplars_per_class <= len(cls_ind)), "Not enough samples to store"
-            # get all extracted features for current class
-            cls_logits = extracted_logits[cls_ind]
-            # select the exemplars closer to boundary
-            distance = cls_logits[:, curr_cls]  # change sign of this variable for inverse order
-            selected = cls_ind[distance.sort()[1][:exemplars_per_class]]
-            result.extend(selected)
-        data_memory_, targets_memory_ = extracted_indices[result], extracted_targets[result]
-        return data_memory_, targets_memory_
\ No newline at end of file
+    def select(self, outputs, cls_ind, curr_cls, exemplars_per_class):
+        cls_logits = outputs['logits'][cls_ind]
+        # select the exemplars closer to boundary
+        distance = cls_logits[:, curr_cls]  # change sign of this variable for inverse order
+        return distance.sort()[1][:exemplars_per_class].numpy()
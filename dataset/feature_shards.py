@@ -0,0 +1,79 @@
+import os
+import json
+import glob
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+
+SHARD_SIZE = 65536
+
+
+def get_shard_dir(root, db_name, arch, split):
+    return os.path.join(root, f"{db_name}_{arch.replace('/', '-')}_{split}_shards")
+
+
+def has_feature_shards(shard_dir):
+    return os.path.isfile(os.path.join(shard_dir, 'meta.json'))
+
+
+@torch.no_grad()
+def extract_feature_shards(encode_fn, dataset, shard_dir, batch_size=256, workers=8, shard_size=SHARD_SIZE):
+    """Encode every sample of ``dataset`` once and write ``[N, D]`` rows as ``.npy`` shards.
+
+    ``encode_fn`` maps an image batch to L2-normalised features. Rows are
+    written in dataset index order, so row ``i`` belongs to sample ``i``.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    num_samples = len(dataset)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=workers)
+    shards, dim = [], None
+    for x, _, index in loader:
+        features = encode_fn(x).cpu().numpy()
+        if dim is None:
+            dim = features.shape[-1]
+            for i, start in enumerate(range(0, num_samples, shard_size)):
+                shards.append(np.lib.format.open_memmap(os.path.join(shard_dir, f"shard_{i:05d}.npy"), mode='w+',
+                                                        dtype=features.dtype, shape=(min(shard_size, num_samples - start), dim)))
+        index = index.numpy()
+        for shard_id in np.unique(index // shard_size):
+            rows = (index // shard_size) == shard_id
+            shards[shard_id][index[rows] % shard_size] = features[rows]
+    for shard in shards:
+        shard.flush()
+    with open(os.path.join(shard_dir, 'meta.json'), 'w') as f:
+        json.dump({'num_samples': num_samples, 'dim': dim, 'shard_size': shard_size}, f)
+
+
+class FeatureShardDataset(Dataset):
+    """Serves precomputed image features by sample index from memory-mapped shards.
+
+    Shards are opened copy-on-write, so rows are views of the page cache that
+    every worker and sweep process shares, and are never unpickled or copied
+    before collation.
+    """
+    def __init__(self, shard_dir, targets):
+        with open(os.path.join(shard_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.shard_paths = sorted(glob.glob(os.path.join(shard_dir, 'shard_*.npy')))
+        self.shard_size = meta['shard_size']
+        self.num_samples = meta['num_samples']
+        self.dim = meta['dim']
+        self.targets = targets
+        self._shards = None
+
+    def __getstate__(self):
+        # workers reopen the memmaps instead of receiving a pickled copy
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        return state
+
+    def __getitem__(self, index):
+        if self._shards is None:
+            self._shards = [np.load(path, mmap_mode='c') for path in self.shard_paths]
+        shard_id, row = divmod(int(index), self.shard_size)
+        return torch.from_numpy(self._shards[shard_id][row]), self.targets[index], int(index)
+
+    def __len__(self):
+        return self.num_samples
@@ -0,0 +1,105 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader
+import torchvision.transforms as transforms
+
+
+CACHED_TRANSFORMS = (transforms.Resize, transforms.CenterCrop)
+
+
+def split_cached_transforms(transform_list):
+    """Split a transform list into the leading Resize/CenterCrop ops baked into the cache and the per-access rest."""
+    n = 0
+    while n < len(transform_list) and isinstance(transform_list[n], CACHED_TRANSFORMS):
+        n += 1
+    baked = list(transform_list[:n])
+    if not baked or not isinstance(baked[-1], transforms.CenterCrop):
+        raise ValueError("The image cache needs the transforms to start with Resize/CenterCrop ops ending in a CenterCrop")
+    return baked, list(transform_list[n:])
+
+
+def cached_transforms(transform_list):
+    """Keep only the per-access part of a transform pipeline (RGB conversion, flip, ToTensor, Normalize, ...).
+
+    Only the leading Resize and CenterCrop were applied when the cache was written.
+    """
+    return transforms.Compose(split_cached_transforms(transform_list)[1])
+
+
+def get_image_cache_path(root, db_name, split, transform_list, paths):
+    """Cache file for one split, keyed on the baked transform config and the dataset's image list."""
+    baked, _ = split_cached_transforms(transform_list)
+    key = hashlib.sha256()
+    key.update(repr(baked).encode())
+    key.update(str(len(paths)).encode())
+    for path in paths:
+        key.update(str(path).encode() + b"\0")
+    return os.path.join(root, f"{db_name}_{split}_{key.hexdigest()[:16]}.npy")
+
+
+class _DecodeDataset(Dataset):
+    def __init__(self, paths, transform_list):
+        self.paths = paths
+        self.transform = transforms.Compose(transform_list)
+
+    def __getitem__(self, index):
+        img = self.transform(Image.open(self.paths[index]))
+        return torch.from_numpy(np.asarray(img.convert("RGB"), dtype=np.uint8).copy())
+
+    def __len__(self):
+        return len(self.paths)
+
+
+@torch.no_grad()
+def build_image_cache(paths, cache_path, transform_list, batch_size=256, workers=8):
+    """Decode every image once through the leading Resize/CenterCrop ops into a ``[N, H, W, 3]`` uint8 ``.npy`` file."""
+    baked, _ = split_cached_transforms(transform_list)
+    height, width = baked[-1].size
+    os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(paths), height, width, 3))
+    loader = DataLoader(_DecodeDataset(paths, baked), batch_size=batch_size, shuffle=False, num_workers=workers)
+    start = 0
+    for batch in loader:
+        images[start:start + len(batch)] = batch.numpy()
+        start += len(batch)
+    images.flush()
+    del images
+    os.replace(tmp_path, cache_path)
+
+
+class PreDecodedImageMixin:
+    """Lets a path-based image dataset read pre-decoded images from a memory-mapped cache."""
+    image_cache_path = None
+    _image_cache = None
+
+    def image_paths(self):
+        raise NotImplementedError
+
+    def use_image_cache(self, cache_root, db_name, split, transform_list, workers=8):
+        """Read images through a cache of the leading Resize/CenterCrop of ``transform_list``; the rest stays per access."""
+        paths = self.image_paths()
+        cache_path = get_image_cache_path(cache_root, db_name, split, transform_list, paths)
+        if not os.path.isfile(cache_path):
+            print(f"Decoding {len(self)} images to {cache_path}")
+            build_image_cache(paths, cache_path, transform_list, workers=workers)
+        self.image_cache_path = cache_path
+        self._image_cache = None
+        self.transform = cached_transforms(transform_list)
+
+    def __getstate__(self):
+        # workers reopen the memmap instead of receiving a pickled copy
+        state = self.__dict__.copy()
+        state['_image_cache'] = None
+        return state
+
+    def load_image(self, index, path):
+        if self.image_cache_path is None:
+            return Image.open(path).convert("RGB")
+        if self._image_cache is None:
+            self._image_cache = np.load(self.image_cache_path, mmap_mode='r')
+        return Image.fromarray(self._image_cache[index])
@@ -1,8 +1,9 @@
 from torchvision.datasets import ImageFolder, ImageNet
 import os
 import numpy as np
+from .image_cache import PreDecodedImageMixin
 
-class imagenet(ImageNet):
+class imagenet(PreDecodedImageMixin, ImageNet):
 
     imagenet_templates = [
         'a photo of a {}.',
@@ -220,6 +221,18 @@ class imagenet(ImageNet):
         super(imagenet, self).__init__(os.path.join(root), split=split,transform=transform)
         self.classes = self.new_classes
 
+    def image_paths(self):
+        return [path for path, _ in self.samples]
+
+    def __getitem__(self, index):
+        path, target = self.samples[index][0], self.targets[index]
+        img = self.load_image(index, path)
+
+        if self.transform is not None:
+            img = self.transform(img)
+
+        return img, target, int(index)
+
     def prompts(self,mode='single'):
         if mode == 'single':
             prompts = [[self.imagenet_templates[0].format(label)] for label in self.new_classes]
@@ -5,6 +5,7 @@ from PIL import Image
 from torchvision import datasets
 import torch
 from shutil import move, rmtree
+from .image_cache import PreDecodedImageMixin
 
 def prepare_imagenet_r(fpath="/home/srv/Documents/mammoth_datasets/imagenet-r/"):
     if not os.path.exists(fpath + '/train') and not os.path.exists(fpath + '/test'):
@@ -54,7 +55,7 @@ def prepare_imagenet_r(fpath="/home/srv/Documents/mammoth_datasets/imagenet-r/")
             path = os.path.join(fpath, c)
             rmtree(path)
 
-class imagenetR(Dataset):
+class imagenetR(PreDecodedImageMixin, Dataset):
 
     templates = [
         'a photo of a {}.',
@@ -207,9 +208,12 @@ class imagenetR(Dataset):
         self.data = np.array(self.data)
 
 
+    def image_paths(self):
+        return self.data
+
     def __getitem__(self, index):
         img, target = self.data[index], self.targets[index]
-        img = Image.open(img).convert("RGB")
+        img = self.load_image(index, img)
 
         if self.transform is not None:
             img = self.transform(img)
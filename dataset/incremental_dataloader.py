@@ -11,6 +11,9 @@ from classifier.utils import SubsetRandomSampler
 from .imagenet import imagenet
 from .imagenetr import imagenetR
 from .cifar import *
+from .feature_shards import FeatureShardDataset, extract_feature_shards, get_shard_dir, has_feature_shards
+from .loader_pool import LoaderPool
+from .tensor_transforms import TensorBatchTransform, TensorBatchCollate
 import torchvision.transforms as transforms
 try:
     from torchvision.transforms import InterpolationMode
@@ -34,6 +37,34 @@ def seed_worker(worker_id):
 
 g = torch.Generator()
 g.manual_seed(0)
+
+# loaded base datasets shared by every IncrementalDataset once ``enable_dataset_cache`` is called
+_base_dataset_cache = None
+
+
+def enable_dataset_cache():
+    global _base_dataset_cache
+    if _base_dataset_cache is None:
+        _base_dataset_cache = {}
+
+
+def _build_base_dataset(dataset, **kwargs):
+    """Builds ``dataset.base_dataset``, or a copy of the already loaded one when the cache is on.
+
+    The copy gets its own ``data``/``targets``/``samples`` containers and transform,
+    so a run that edits them in place leaves the cached dataset untouched.
+    """
+    if _base_dataset_cache is None:
+        return dataset.base_dataset(**kwargs)
+    key = (dataset.base_dataset, tuple(sorted((k, v) for k, v in kwargs.items() if k != 'transform')))
+    if key not in _base_dataset_cache:
+        _base_dataset_cache[key] = dataset.base_dataset(**kwargs)
+    base_dataset = copy.copy(_base_dataset_cache[key])
+    for attr in ('data', 'targets', 'samples'):
+        if hasattr(base_dataset, attr):
+            setattr(base_dataset, attr, copy.copy(getattr(base_dataset, attr)))
+    base_dataset.transform = kwargs.get('transform')
+    return base_dataset
     
 
 class IncrementalDataset:
@@ -85,8 +116,48 @@ class IncrementalDataset:
         self.test_data_loaders = []
         self.test_indices_len = []
         self.past_memory_dataset = None 
+        self.train_feature_dataset = None
+        self.test_feature_dataset = None
+        # persistent workers per split; loaders below only bring their own sampler
+        self.loader_pool = LoaderPool(self.get_loader_dataset, num_workers=8, worker_init_fn=seed_worker, generator=g,
+                                      get_collate_fn=self.get_collate_fn)
     # import pdb;pdb.set_trace()
 
+    def use_feature_shards(self, root, arch, encode_fn):
+        """Serve precomputed image features instead of images from every loader.
+
+        Missing shards are written once with the deterministic common transforms,
+        so train-time flip augmentation is not applied to the cached features.
+        """
+        for split, dataset in [('train', self.train_dataset), ('test', self.test_dataset)]:
+            shard_dir = get_shard_dir(root, self.dataset_names[-1], arch, split)
+            if not has_feature_shards(shard_dir):
+                print(f"Extracting {split} image features to {shard_dir}")
+                dataset = copy.copy(dataset)
+                dataset.transform = transforms.Compose(self.common_transforms)
+                if getattr(dataset, 'batch_transform', None) is not None:
+                    dataset.batch_transform = None
+                extract_feature_shards(encode_fn, dataset, shard_dir, batch_size=self._batch_size, workers=self._workers)
+            if split == 'train':
+                self.train_feature_dataset = FeatureShardDataset(shard_dir, self.train_dataset.targets)
+            else:
+                self.test_feature_dataset = FeatureShardDataset(shard_dir, self.test_dataset.targets)
+        # workers forked before the switch would keep serving images
+        self.loader_pool.reset()
+
+    def get_collate_fn(self, mode="train"):
+        if self.get_loader_dataset(mode) is not self.get_image_dataset(mode):
+            return None
+        return self.collate_fns.get(mode)
+
+    def get_image_dataset(self, mode="train"):
+        return self.train_dataset if mode == "train" else self.test_dataset
+
+    def get_loader_dataset(self, mode="train"):
+        if mode == "train":
+            return self.train_feature_dataset if self.train_feature_dataset is not None else self.train_dataset
+        return self.test_feature_dataset if self.test_feature_dataset is not None else self.test_dataset
+
     @staticmethod
     def get_prompts(datasets):
         prompt_templates = [each for dataset in datasets for each in dataset.base_dataset.templates]
@@ -96,6 +167,24 @@ class IncrementalDataset:
     def n_tasks(self):
         return len(self.increments)
     
+    @staticmethod
+    def build_class_index(target):
+        """Sample indices grouped by class: those of class ``c`` are ``order[offsets[c]:offsets[c+1]]``,
+        in ascending dataset order."""
+        np_target = np.asarray(target, dtype=np.int64)
+        order = np.argsort(np_target, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(np_target))])
+        return order, offsets
+
+    def get_class_indices(self, target, label, mode="train"):
+        order, offsets = self.class_index.get(mode, (None, None))
+        if order is None or len(order) != len(target):
+            order, offsets = self.build_class_index(target)
+        label = [c for c in np.atleast_1d(label) if 0 <= c < len(offsets) - 1]
+        if len(label) == 0:
+            return np.array([], dtype=np.int64)
+        return np.concatenate([order[offsets[c]:offsets[c + 1]] for c in label])
+
     def get_same_index(self, target, label, mode="train", memory=None):
         label_indices = []
         label_targets = []
@@ -112,16 +201,16 @@ class IncrementalDataset:
             np.random.seed(0)
             label = np.random.choice(label,size=len(label),replace=False)
             for cls_id in label:
-                ind = list(np.where(target==cls_id)[0])
+                ind = list(self.get_class_indices(target, [cls_id], mode))
                 np.random.seed(1)
                 random_ind = np.random.choice(ind,self.args.k_shot,replace=False)
                 label_indices.extend(random_ind)
                 label_targets.extend([cls_id]*len(random_ind))
         else:
-            for i in range(len(target)):
-                if int(target[i]) in label:
-                    label_indices.append(i)
-                    label_targets.append(target[i])
+            # sorting the per-class slices restores the original dataset order
+            label_indices = np.sort(self.get_class_indices(target, label, mode))
+            label_targets = list(np_target[label_indices])
+            label_indices = list(label_indices)
 
         for_memory = (label_indices.copy(),label_targets.copy()) 
        
@@ -141,12 +230,8 @@ class IncrementalDataset:
         # import pdb;pdb.set_trace()
 
         np_target = np.array(target, dtype="uint32")   # label of all inputs  ; label: max_class
-        np_indices = np.array(list(range(len(target))), dtype="uint32") #0:9999
-        task_idx = []
-        for class_id in label:
-            idx = np.where(np_target==class_id)[0]
-            task_idx.extend(list(idx.ravel()))
-        task_idx = np.array(task_idx, dtype="uint32")
+        np_indices = np.arange(len(target), dtype="uint32") #0:9999
+        task_idx = self.get_class_indices(target, label, mode).astype("uint32")
         task_idx.ravel()
         random.shuffle(task_idx)
 
@@ -198,11 +283,7 @@ class IncrementalDataset:
             min_class = sum(self.increments[:i+1]) + self.offset # min class is the next task's min
             max_class = sum(self.increments) + self.offset # max class possible
             test_indices, _ = self.get_same_index_test_chunk(self.test_dataset.targets, list(range(min_class, max_class)), mode="test")
-            future_test_loader = torch.utils.data.DataLoader(self.test_dataset, batch_size=self.args.test_batch,
-                                                                shuffle=False,num_workers=8, 
-                                                                sampler=SubsetRandomSampler(test_indices, False),
-                                                                worker_init_fn=seed_worker,
-                                                                generator=g,)
+            future_test_loader = self.loader_pool.get_loader("test", test_indices, self.args.test_batch, shuffle=False)
         return future_test_loader
                 
     def new_task(self, memory=None, past_dataset_memory=None):
@@ -221,11 +302,7 @@ class IncrementalDataset:
         
         
         
-        self.test_data_loaders.append(torch.utils.data.DataLoader(self.test_dataset, batch_size=self.args.test_batch,
-                                                                  shuffle=False,num_workers=8, 
-                                                                  sampler=SubsetRandomSampler(test_indices, False),
-                                                                  worker_init_fn=seed_worker,
-                                                                    generator=g,))
+        self.test_data_loaders.append(self.loader_pool.get_loader("test", test_indices, self.args.test_batch, shuffle=False))
         ood_test_loader = self.get_future_tasks_test_loader()
         if past_dataset_memory is not None:
             if self.past_memory_dataset is None:
@@ -248,15 +325,12 @@ class IncrementalDataset:
             total_train_dataset = torch.utils.data.ConcatDataset([curr_train_dataset, self.past_memory_dataset])
             self.train_data_loader = torch.utils.data.DataLoader(total_train_dataset, batch_size=self._batch_size,
                                                              shuffle=True,num_workers=8, 
+                                                             collate_fn=self.get_collate_fn("train"),
                                                              worker_init_fn=seed_worker,
                                                              generator=g)
             n_train_data = len(train_indices) + len(self.past_memory_dataset)
         else:
-            self.train_data_loader = torch.utils.data.DataLoader(self.train_dataset, batch_size=self._batch_size,
-                                                             shuffle=False,num_workers=8, 
-                                                             sampler=SubsetRandomSampler(train_indices, True), 
-                                                             worker_init_fn=seed_worker,
-                                                             generator=g)
+            self.train_data_loader = self.loader_pool.get_loader("train", train_indices, self._batch_size, shuffle=True)
             n_train_data = len(train_indices)
         self.test_indices_len.append(len(test_indices))
         task_info = {
@@ -280,15 +354,12 @@ class IncrementalDataset:
             print(f"Class-balanced finetuning dataset size: {len(total_train_dataset) // (self.args.sess + 1)} per task over {(self.args.sess + 1)} tasks")
             memory_loader = torch.utils.data.DataLoader(total_train_dataset, batch_size=self._batch_size,
                                                              shuffle=True,num_workers=8, 
+                                                             collate_fn=self.get_collate_fn("train"),
                                                              worker_init_fn=seed_worker,
                                                              generator=g)
         else:
             print(f"Class-balanced finetuning dataset size: {len(memory_indices) // (self.args.sess + 1)} per task over {(self.args.sess + 1)} tasks")
-            memory_loader = torch.utils.data.DataLoader(self.train_dataset, batch_size=self._batch_size,
-                                                        shuffle=False,num_workers=8, 
-                                                        sampler=SubsetRandomSampler(memory_indices, True), 
-                                                        worker_init_fn=seed_worker,
-                                                        generator=g,)
+            memory_loader = self.loader_pool.get_loader("train", memory_indices, self._batch_size, shuffle=True)
         return memory_loader
 
     # for verification   
@@ -307,6 +378,7 @@ class IncrementalDataset:
             
         data_loader = torch.utils.data.DataLoader(self.train_dataset, batch_size=batch_size, shuffle=False, 
                                                   num_workers=4, sampler=SubsetRandomSampler(indexes, False), 
+                                                  collate_fn=self.collate_fns.get("train"),
                                                   worker_init_fn=seed_worker,
                                                              generator=g)
     
@@ -316,10 +388,10 @@ class IncrementalDataset:
     def get_custom_loader_idx(self, indexes, mode="train", batch_size=10, shuffle=True):
      
         if(mode=="train"):
-            data_loader = torch.utils.data.DataLoader(self.train_dataset, batch_size=batch_size, shuffle=False, num_workers=4, sampler=SubsetRandomSampler(indexes, True), worker_init_fn=seed_worker,
+            data_loader = torch.utils.data.DataLoader(self.train_dataset, batch_size=batch_size, shuffle=False, num_workers=4, sampler=SubsetRandomSampler(indexes, True), collate_fn=self.collate_fns.get("train"), worker_init_fn=seed_worker,
                                                              generator=g)
         else: 
-            data_loader = torch.utils.data.DataLoader(self.test_dataset, batch_size=batch_size, shuffle=False, num_workers=4, sampler=SubsetRandomSampler(indexes, False), worker_init_fn=seed_worker,
+            data_loader = torch.utils.data.DataLoader(self.test_dataset, batch_size=batch_size, shuffle=False, num_workers=4, sampler=SubsetRandomSampler(indexes, False), collate_fn=self.collate_fns.get("test"), worker_init_fn=seed_worker,
                                                              generator=g)
     
         return data_loader
@@ -329,10 +401,10 @@ class IncrementalDataset:
         
         if(mode=="train"):
             train_indices, for_memory = self.get_same_index(self.train_dataset.targets, class_id, mode="train", memory=None)
-            data_loader = torch.utils.data.DataLoader(self.train_dataset, batch_size=batch_size, shuffle=False, num_workers=4, sampler=SubsetRandomSampler(train_indices, True))
+            data_loader = torch.utils.data.DataLoader(self.train_dataset, batch_size=batch_size, shuffle=False, num_workers=4, sampler=SubsetRandomSampler(train_indices, True), collate_fn=self.collate_fns.get("train"))
         else: 
             test_indices, _ = self.get_same_index(self.test_dataset.targets, class_id, mode="test")
-            data_loader = torch.utils.data.DataLoader(self.test_dataset, batch_size=batch_size, shuffle=False, num_workers=4, sampler=SubsetRandomSampler(test_indices, False))
+            data_loader = torch.utils.data.DataLoader(self.test_dataset, batch_size=batch_size, shuffle=False, num_workers=4, sampler=SubsetRandomSampler(test_indices, False), collate_fn=self.collate_fns.get("test"))
             
         return data_loader
 
@@ -358,8 +430,12 @@ class IncrementalDataset:
         current_class_idx = 0  # When using multiple datasets
         for i, dataset in enumerate(datasets):
             if(self.dataset_names[i]=="imagenet"or self.dataset_names[i]=="imagenet100" or self.dataset_names[i]=="imagenet-r"):
-                train_dataset = dataset.base_dataset(root=path, train=True, transform=trsf_train)
-                test_dataset = dataset.base_dataset(root=path, train=False, transform=trsf_test)
+                train_dataset = _build_base_dataset(dataset, root=path, train=True, transform=trsf_train)
+                test_dataset = _build_base_dataset(dataset, root=path, train=False, transform=trsf_test)
+                if self.args.image_cache_dir is not None:
+                    # decode + resize + center-crop once, later accesses only flip and normalize
+                    train_dataset.use_image_cache(self.args.image_cache_dir, self.dataset_names[i], 'train', self.train_transforms)
+                    test_dataset.use_image_cache(self.args.image_cache_dir, self.dataset_names[i], 'test', self.common_transforms)
                 # traindir = os.path.join(path, 'imagenet100/train')
                 # validdir = os.path.join(path, 'imagenet100/val')
                 # train_dataset = dset.ImageFolder(traindir, transform=trsf_train)
@@ -370,13 +446,13 @@ class IncrementalDataset:
                         or self.dataset_names[i]=="mnist"  or self.dataset_names[i]=="caltech101"  
                         or self.dataset_names[i]=="omniglot"  or self.dataset_names[i]=="celeb"):
                 # pdb.set_trace()
-                train_dataset = dataset.base_dataset(root=path, train=True, transform=trsf_train)
-                test_dataset = dataset.base_dataset(root=path, train=False, transform=trsf_test)
+                train_dataset = _build_base_dataset(dataset, root=path, train=True, transform=trsf_train)
+                test_dataset = _build_base_dataset(dataset, root=path, train=False, transform=trsf_test)
 
 
             elif(self.dataset_names[i]=="svhn"):
-                train_dataset = dataset.base_dataset(root=path, split='train', transform=trsf_train)
-                test_dataset = dataset.base_dataset(root=path, split='test', transform=trsf_test)
+                train_dataset = _build_base_dataset(dataset, root=path, split='train', transform=trsf_train)
+                test_dataset = _build_base_dataset(dataset, root=path, split='test', transform=trsf_test)
                 train_dataset.targets = train_dataset.labels
                 test_dataset.targets = test_dataset.labels
 
@@ -407,6 +483,15 @@ class IncrementalDataset:
 
         self.train_dataset = train_dataset
         self.test_dataset = test_dataset
+        self.collate_fns = {}
+        if self.args.tensor_transforms and len(datasets) == 1 and hasattr(train_dataset, 'batch_transform'):
+            # uint8 rows are upsampled and normalized per batch instead of per sample through PIL
+            for mode, dset, trsf in [('train', train_dataset, self.train_transforms), ('test', test_dataset, self.common_transforms)]:
+                dset.batch_transform = TensorBatchTransform.from_transforms(trsf)
+                self.collate_fns[mode] = TensorBatchCollate(dset.batch_transform)
+        # class -> sample indices, so task splits are slices instead of O(N*C) scans
+        self.class_index = {'train': self.build_class_index(train_dataset.targets),
+                            'test': self.build_class_index(test_dataset.targets)}
 
     @staticmethod
     def get_variable_increment_num():
@@ -438,7 +523,7 @@ class IncrementalDataset:
         elif self.args.memory_type == 'fix_per_cls':
             memory_per_cls = 20 
         
-        self.exemplar_selector.set_dataset_and_transform(self.train_dataset, self.common_transforms)
+        self.exemplar_selector.set_dataset_and_transform(self.get_loader_dataset("train"), self.common_transforms, loader_pool=self.loader_pool)
 
         self._data_memory, self._targets_memory = self.exemplar_selector.select_indices(model, memory_per_cls, 
                                                                                         memory, for_memory)
@@ -0,0 +1,108 @@
+import math
+
+from torch.utils.data import DataLoader, Sampler
+from classifier.utils import SubsetRandomSampler
+
+
+class SwitchSampler(Sampler):
+    """Sampler of a pooled loader; iterates whichever view's own sampler is current."""
+    def __init__(self):
+        self.current = SubsetRandomSampler([], False)
+        self.owner = None
+
+    def __iter__(self):
+        return iter(self.current)
+
+    def __len__(self):
+        return len(self.current)
+
+
+class PooledLoader:
+    """A DataLoader-like view over a pooled loader with its own sampler.
+
+    The pooled loader is looked up when iteration starts, so a view handed out
+    before the pool was rebuilt still reads the current dataset. If another view
+    of the same split is mid-iteration, this one gets a one-off loader instead of
+    sharing the busy workers.
+    """
+    def __init__(self, pool, split, indices, batch_size, shuffle):
+        self.pool = pool
+        self.split = split
+        self.sampler = SubsetRandomSampler(indices, shuffle)
+        self.batch_size = batch_size
+
+    @property
+    def indices(self):
+        return self.sampler.indices
+
+    @property
+    def dataset(self):
+        return self.pool.get_dataset(self.split)
+
+    def __iter__(self):
+        loader = self.pool.get_pooled(self.split, self.batch_size)
+        switch = loader.sampler
+        if switch.owner is not None:
+            yield from self.pool.build_loader(self.split, self.batch_size, self.sampler, persistent=False)
+            return
+        switch.current, switch.owner = self.sampler, self
+        try:
+            yield from loader
+        finally:
+            switch.owner = None
+
+    def __len__(self):
+        return math.ceil(len(self.sampler) / self.batch_size)
+
+
+class LoaderPool:
+    """Keeps one persistent-worker DataLoader per (split, batch size).
+
+    Workers are forked and receive the dataset once; every later loader for the
+    same split only brings its own sampler. Persistent workers keep the dataset
+    they were forked with, so the pool is rebuilt when ``get_dataset`` returns a
+    different dataset, and ``reset`` must be called after a dataset or its
+    transforms are changed in place.
+    """
+    def __init__(self, get_dataset, num_workers=8, worker_init_fn=None, generator=None, get_collate_fn=None):
+        self.get_dataset = get_dataset
+        self.get_collate_fn = get_collate_fn
+        self.num_workers = num_workers
+        self.worker_init_fn = worker_init_fn
+        self.generator = generator
+        self.loaders = {}
+
+    def build_loader(self, split, batch_size, sampler, persistent=True):
+        return DataLoader(self.get_dataset(split), batch_size=batch_size,
+                          shuffle=False, num_workers=self.num_workers,
+                          sampler=sampler,
+                          collate_fn=self.get_collate_fn(split) if self.get_collate_fn is not None else None,
+                          persistent_workers=persistent and self.num_workers > 0,
+                          worker_init_fn=self.worker_init_fn,
+                          generator=self.generator)
+
+    def get_pooled(self, split, batch_size):
+        key = (split, batch_size)
+        loader = self.loaders.get(key)
+        if loader is not None and loader.dataset is not self.get_dataset(split):
+            self.shutdown(key)
+            loader = None
+        if loader is None:
+            loader = self.loaders[key] = self.build_loader(split, batch_size, SwitchSampler())
+        return loader
+
+    def get_loader(self, split, indices, batch_size, shuffle=False):
+        return PooledLoader(self, split, indices, batch_size, shuffle)
+
+    def shutdown(self, key):
+        loader = self.loaders.pop(key)
+        if loader.sampler.owner is not None:
+            raise RuntimeError(f"Loader pool for {key} changed while one of its loaders is being iterated")
+        iterator = getattr(loader, '_iterator', None)
+        if iterator is not None and hasattr(iterator, '_shutdown_workers'):
+            iterator._shutdown_workers()
+
+    def reset(self):
+        """Drop all pooled loaders and their workers; the next iteration forks fresh ones."""
+        for key in list(self.loaders):
+            self.shutdown(key)
@@ -0,0 +1,50 @@
+import torch
+import torch.nn.functional as F
+from torch.utils.data.dataloader import default_collate
+import torchvision.transforms as transforms
+
+
+class TensorBatchTransform:
+    """Batched replacement for the PIL ``Resize -> CenterCrop -> [flip] -> ToTensor -> Normalize`` pipeline.
+
+    Takes a ``[B, H, W, 3]`` uint8 batch on any device and returns normalised
+    ``[B, 3, size, size]`` floats. Upsampled pixels are rounded back to 8 bits as
+    PIL does; torch's bicubic kernel (a=-0.75) differs slightly from PIL's (a=-0.5).
+    """
+    def __init__(self, size, mean, std, flip=False):
+        self.size = size
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+        self.flip = flip
+
+    @classmethod
+    def from_transforms(cls, transform_list):
+        size, mean, std, flip = None, (0., 0., 0.), (1., 1., 1.), False
+        for t in transform_list:
+            if isinstance(t, transforms.Resize):
+                size = t.size if isinstance(t.size, int) else t.size[0]
+            elif isinstance(t, transforms.Normalize):
+                mean, std = t.mean, t.std
+            elif isinstance(t, transforms.RandomHorizontalFlip):
+                flip = True
+        return cls(size, mean, std, flip=flip)
+
+    def __call__(self, images):
+        x = images.permute(0, 3, 1, 2).float()
+        if self.size is not None and x.shape[-1] != self.size:
+            x = F.interpolate(x, size=(self.size, self.size), mode='bicubic', align_corners=False).round_().clamp_(0, 255)
+        if self.flip:
+            flip = torch.rand(x.shape[0], device=x.device) < 0.5
+            x = torch.where(flip.view(-1, 1, 1, 1), x.flip(-1), x)
+        x = x / 255.
+        return (x - self.mean.to(x.device)) / self.std.to(x.device)
+
+
+class TensorBatchCollate:
+    """``collate_fn`` that stacks raw uint8 images and transforms the whole batch at once."""
+    def __init__(self, transform):
+        self.transform = transform
+
+    def __call__(self, batch):
+        images, targets, indices = default_collate(batch)
+        return self.transform(images), targets, indices
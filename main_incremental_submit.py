@@ -19,9 +19,14 @@ import dataset.incremental_dataloader as incremental_dataloader
 from utils import mkdir_p
 from dataset.exemplars_selection import *
 from utils.rotation_angle_matrix import RotationAngleMatrix
+from utils.profiler import StageProfiler
+from clip.model import set_attention_backend
+from utils.checkpoint import save_session_checkpoint, load_latest_checkpoint, get_rng_state, set_rng_state
+from utils.run_registry import RunRegistry
 from torch.utils.tensorboard import SummaryWriter
+from classifier.metrics import SummaryWriterSink
 
-def parse_option():
+def parse_option(overrides=None):
     parser = argparse.ArgumentParser('Prompt Learning for CLIP', add_help=False)
 
     parser.add_argument("--root", type=str, default='/data1/imagenet100',help='root')
@@ -64,6 +69,13 @@ def parse_option():
     parser.add_argument("--multi-gpu", action='store_true', default=False, help="use multi-gpus")
     parser.add_argument("--gpus", default=[0], type=lambda x: list(map(int, x.split(','))), help="gpu id(s)")
     parser.add_argument("--default-gpu", default=0, type=int, help="default gpu to use")
+    parser.add_argument("--device", type=str, default=None, help='"cpu", "cuda" or "cuda:<id>"; defaults to the default gpu, or the cpu without CUDA')
+    parser.add_argument("--cpu-threads", type=int, default=None, help="torch intra-op threads on the cpu; defaults to the cores left over by the loader workers")
+    parser.add_argument("--cpu-interop-threads", type=int, default=None, help="torch inter-op threads on the cpu")
+    parser.add_argument("--cpu-processes", type=int, default=1, help="runs sharing the cpu cores; sweep_incremental.py sets it to --sweep-workers")
+    parser.add_argument("--attention-backend", type=str, default=None, choices=['sdpa', 'mha'], help="self-attention of the CLIP transformers: fused scaled_dot_product_attention or nn.MultiheadAttention; defaults to sdpa where available")
+    parser.add_argument("--quantize-eval", action="store_true", default=False, help="cpu only: after each session's evaluation, evaluate again with the frozen backbone dynamically quantized to int8 and report the accuracy delta")
+    parser.add_argument("--cpu-encode-threads", type=int, default=0, help="cpu evaluation: encode the next batch's images on a separate thread, overlapped with the adapters on the current batch, and leave this many cores out of torch's intra-op thread count for it; 0 disables")
     parser.add_argument("--method", type=str, default='no_replay')
     parser.add_argument("--finetuning", action='store_true', default=False, help="Use class-balanced finetuning")
     parser.add_argument("--finetune-epochs", type=int, default=1, help="Use class-balanced finetuning")
@@ -94,6 +106,7 @@ def parse_option():
     parser.add_argument("--distill-distribution", action='store_true', default=False, help="Distillation using recorded task distributions")
 
     parser.add_argument("--compute-ece", action='store_true', default=False, help="Compute Expected Calibration Error")
+    parser.add_argument("--incremental-eval", action='store_true', default=False, help="Reuse cached past-task logits at test time when their modules are frozen")
     parser.add_argument("--num-run", default=0, type=int, help="number of run decides the class order for cifar100 and seed for imagenet100" )
     parser.add_argument("--get-adapter-distances", action='store_true', default=False, help="average distance between samples of each adapter")
     parser.add_argument("--sr-beta", type=float, default=1, help="SR beta")
@@ -110,9 +123,19 @@ def parse_option():
     parser.add_argument("--fscil", action="store_true", default=False, help="enable few-shot CIL setting")
     parser.add_argument("--base-task-cls", type=int, default=60, help='num of classes in base task')
     parser.add_argument("--k-shot", type=int, default=5, help='num of training images per class')
+    parser.add_argument("--feature-cache-dir", type=str, default=None, help="dir for cached frozen train image features (clclip_var_sr, coop_variational_sr)")
+    parser.add_argument("--feature-loader", action="store_true", default=False, help="feed memory-mapped image feature shards from --feature-cache-dir instead of images")
+    parser.add_argument("--image-cache-dir", type=str, default=None, help="dir for pre-decoded, resized and center-cropped uint8 images (imagenet, imagenet100, imagenet-r)")
+    parser.add_argument("--run-registry", type=str, default='./runs/registry.db', help="SQLite file recording the finished sessions of every configuration")
+    parser.add_argument("--resume", action="store_true", default=False, help="checkpoint the full classifier state after every session and resume from the latest checkpoint")
+    parser.add_argument("--profile-stages", action="store_true", default=False, help="time named training/inference stages (synchronized) and log p50/p95 per session")
+    parser.add_argument("--tensor-transforms", action="store_true", default=False, help="upsample and normalize cifar100 batches as tensors instead of per-sample PIL transforms")
 
 
     args, unparsed = parser.parse_known_args()
+    # per-run values from a sweep grid, applied before the derived paths below
+    for k, v in (overrides or {}).items():
+        setattr(args, k, v)
     args.mean_per_class = False
 
     if args.ckpt_path is None:
@@ -120,6 +143,10 @@ def parse_option():
 
     args.save_path = args.save_path + '/' + args.db_name
     args.seed = args.num_run
+    # CLIP runs in fp16 on a GPU and fp32 on the CPU (see clip.load)
+    args.device = torch.device(args.device or (f"cuda:{args.default_gpu}" if torch.cuda.is_available() else "cpu"))
+    if args.quantize_eval and args.device.type != 'cpu':
+        raise ValueError("--quantize-eval needs --device cpu")
 
     return args
 
@@ -132,12 +159,36 @@ def setup_seed(seed):
     torch.backends.cudnn.deterministic = True
 
 
+def setup_cpu_threads(args, loader_workers):
+    """Split this run's share of the cores between the loader workers, the image encoder thread and torch's own compute threads.
+
+    ``loader_workers`` is the worker count of one pooled loader: only the split being
+    iterated has busy workers, the other split's persistent workers sleep.
+    """
+    if args.device.type != 'cpu':
+        return
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    cores = max(1, cores // max(1, args.cpu_processes))
+    threads = args.cpu_threads or max(1, cores - loader_workers - args.cpu_encode_threads)
+    torch.set_num_threads(threads)
+    if args.cpu_interop_threads:
+        try:
+            torch.set_num_interop_threads(args.cpu_interop_threads)
+        except RuntimeError:
+            # can only be set once per process, e.g. not again for the next run of a sweep
+            pass
+    print(f"CPU threads: {threads} intra-op, {torch.get_num_interop_threads()} inter-op, {args.cpu_encode_threads} cores left for image encoding")
+
+
 def main(args):
     setup_seed(args.seed)
+    # module-wide, so set on every run: a sweep worker must not inherit the previous configuration's backend
+    set_attention_backend(args.attention_backend)
     args.test_batch = args.train_batch 
 
     if args.compute_ram:
         args.ram_computer = RotationAngleMatrix(args)
+    args.profiler = StageProfiler(enabled=args.profile_stages, device=args.device)
 
     if args.model == 'clclip':
         args.method = "no_replay"
@@ -189,8 +240,6 @@ def main(args):
 
     if not os.path.isdir(args.ckpt_path):
         mkdir_p(args.checkpoint)
-    if not os.path.isdir(args.save_path):
-        mkdir_p(args.save_path)
     np.save(args.checkpoint + "/seed.npy", args.seed)
     try:
         shutil.copy2('main_incremental_submit.py', args.checkpoint)
@@ -209,24 +258,61 @@ def main(args):
                         increment=args.class_per_task,
                         exemplar_selector = selector
                     )
+    setup_cpu_threads(args, inc_dataset.loader_pool.num_workers)
+    if args.feature_loader:
+        if args.feature_cache_dir is None or not hasattr(model, 'encode_images'):
+            raise ValueError("--feature-loader needs --feature-cache-dir and a model with a frozen image encoder")
+        inc_dataset.use_feature_shards(args.feature_cache_dir, model.backbone, model.encode_images)
     start_sess = args.start_sess
     memory = None
+    metrics = None
     ctx_vec = None
     print(args)
-    folder_path = f"./runs/log_{args.model}_{args.db_name}_{args.sr_beta}_{args.gamma}_{args.forward_times}"
-    if os.path.exists(folder_path):
-        return
+    # runs are keyed on all result-affecting arguments; only fully finished ones are skipped
+    registry = RunRegistry(args.run_registry)
+    run_id = registry.register(args)
+    first_sess = registry.first_incomplete_session(run_id)
+    if first_sess >= args.num_task:
+        print(f"Run {run_id} already finished all {args.num_task} sessions, skipping")
+        return None
+    folder_path = f"./runs/log_{args.model}_{args.db_name}_{args.sr_beta}_{args.gamma}_{args.forward_times}_{run_id}"
+    # per-run memory and accuracy pickles, so concurrent sweep configurations never reload each other's memory
+    args.save_path = os.path.join(args.save_path, run_id)
+    if not os.path.isdir(args.save_path):
+        mkdir_p(args.save_path)
+    ckpt_dir = os.path.join(args.checkpoint, "sessions", run_id)
+    resume_state = None
+    if args.resume and first_sess > 0:
+        resume_state = load_latest_checkpoint(ckpt_dir, device=args.device, sess=first_sess - 1)
+    if first_sess > 0 and resume_state is None:
+        print(f"Run {run_id} stopped after session {first_sess - 1} without a checkpoint to resume from, restarting")
+        registry.clear_sessions(run_id)
+    if resume_state is not None:
+        start_sess = resume_state['sess'] + 1
+        model.load_checkpoint_state(resume_state['classifier'])
+        memory = resume_state['memory']
+        # replay the task splits with the memory each session was given, so the test
+        # loaders of the finished tasks and the rehearsal dataset state exist again
+        replay_memory = None
+        for ses in range(start_sess):
+            if ses > 0 and "er" in args.method:
+                replay_memory = pickle.load(open(args.save_path + "/memory_"+str(ses-1)+".pickle", 'rb'))
+            inc_dataset.new_task(replay_memory, resume_state.get('past_dataset_memory'))
+            args.sess = ses
+        inc_dataset.sample_per_task_testing = resume_state['sample_per_task_testing']
+        set_rng_state(resume_state['rng'], {'loader': incremental_dataloader.g})
     writer = SummaryWriter(folder_path)
+    model.add_metric_sink(SummaryWriterSink(writer))
     #writer = SummaryWriter(f"./runs/log_{args.db_name}_original_model")
     for ses in range(start_sess,  args.num_task):
-        if ses > args.start_sess:
+        if ses > start_sess:
             if "er" in args.method:
                 memory = pickle.load(open(args.save_path + "/memory_"+str(args.sess)+".pickle", 'rb'))
         task_info, train_loader, class_name, test_class, test_loader, for_memory, ood_test_loader = inc_dataset.new_task(memory) 
         
         args.sess=ses   
       
-        if(start_sess==ses and start_sess!=0): 
+        if(start_sess==ses and start_sess!=0 and resume_state is None): 
             inc_dataset._current_task = ses
             with open(args.save_path + "/sample_per_task_testing_"+str(args.sess-1)+".pickle", 'rb') as handle:
                 sample_per_task_testing = pickle.load(handle)
@@ -258,8 +344,8 @@ def main(args):
         print('finish fit')
         
         metrics = model.accuracy(test_loader, args.num_test, test_class, mean_per_class=args.mean_per_class, ood_test_loader=ood_test_loader)
-        for k,v in metrics.items():
-            writer.add_scalar(k, v, ses)
+        if args.quantize_eval:
+            metrics.update(model.quantized_accuracy_delta(test_loader, metrics, args.num_test, test_class))
         with open(args.save_path + "/memory_"+str(args.sess)+".pickle", 'wb') as handle:
             pickle.dump(memory, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
@@ -269,11 +355,22 @@ def main(args):
         with open(args.save_path + "/sample_per_task_testing_"+str(args.sess)+".pickle", 'wb') as handle:
             pickle.dump(args.sample_per_task_testing, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
+        if args.resume:
+            save_session_checkpoint(ckpt_dir, ses, {'sess': ses,
+                                                    'classifier': model.checkpoint_state(),
+                                                    'memory': memory,
+                                                    'past_dataset_memory': (inc_dataset.past_memory_dataset.indices, None) if inc_dataset.past_memory_dataset is not None else None,
+                                                    'sample_per_task_testing': args.sample_per_task_testing,
+                                                    'rng': get_rng_state({'loader': incremental_dataloader.g})})
+        registry.mark_session(run_id, ses, metrics)
+
     if args.viz_module_selection:
         with open(args.save_path + "/module_selection_trend.pickle", 'wb') as handle:
             pickle.dump(model.time_step_to_test_id_to_module_id, handle, protocol=pickle.HIGHEST_PROTOCOL)
             
     writer.flush()
+    writer.close()
+    return metrics
 
 if __name__ == '__main__':
     args = parse_option()
@@ -0,0 +1,147 @@
+"""Check that the shared-extraction exemplar selectors pick the same samples as the
+original per-selector loops on fixed logits.
+
+Energy and variance now score each image on its own MC samples; the original loops
+reshaped the flat sample-major logits and mixed images, so those two are checked
+against the original loops fed the per-image layout, and the mixed layout is
+reported for reference.
+
+    python scripts/check_exemplar_selection.py
+"""
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataset.exemplars_selection import (HerdingExemplarsSelector, EntropyExemplarsSelector,
+                                         EnergyExemplarsSelector, VarianceExemplarsSelector)
+
+
+def make_batches(n_samples=96, n_classes=6, forward_times=5, batch_size=20, seed=0):
+    """Fixed ``(logits [S, B, C], targets, idx)`` batches as the variational models return them."""
+    g = torch.Generator().manual_seed(seed)
+    targets = torch.arange(n_samples) % n_classes
+    indices = torch.randperm(10 * n_samples, generator=g)[:n_samples]
+    logits = torch.randn(forward_times, n_samples, n_classes, generator=g) * 3
+    return [(logits[:, i:i + batch_size], targets[i:i + batch_size], indices[i:i + batch_size])
+            for i in range(0, n_samples, batch_size)]
+
+
+def _mean_inputs(batches):
+    """Baseline herding/entropy/distance inputs: ``model(images, test=True)`` per batch."""
+    extracted_logits, extracted_targets, extracted_indices = [], [], []
+    for logits, targets, idx in batches:
+        extracted_logits.append(logits.mean(0).detach())
+        extracted_targets.extend(targets)
+        extracted_indices.extend(idx)
+    return extracted_logits, np.array(extracted_targets), np.array(extracted_indices)
+
+
+def _mc_inputs(batches, forward_times, per_image=True):
+    """Baseline energy/variance inputs: ``model(images, test=True, return_mean=False)`` per batch.
+
+    ``per_image=False`` reproduces the original flat reshape that mixed images.
+    """
+    extracted_logits, extracted_targets, extracted_indices = [], [], []
+    for logits, targets, idx in batches:
+        if per_image:
+            extracted_logits.append(logits.detach().permute(1, 0, 2))
+        else:
+            extracted_logits.extend(logits.detach())
+        extracted_targets.extend(targets)
+        extracted_indices.extend(idx)
+    extracted_logits = (torch.cat(extracted_logits)).cpu()
+    if not per_image:
+        extracted_logits = extracted_logits.reshape(len(extracted_targets), forward_times, -1)
+    return extracted_logits, np.array(extracted_targets), np.array(extracted_indices)
+
+
+def baseline_herding(batches, exemplars_per_class):
+    feats, extracted_targets, extracted_indices = _mean_inputs(batches)
+    extracted_features = torch.cat([f / f.norm(dim=1).view(-1, 1) for f in feats]).cpu()
+    result = []
+    for curr_cls in np.unique(extracted_targets):
+        cls_ind = np.where(extracted_targets == curr_cls)[0]
+        cls_feats = extracted_features[cls_ind]
+        cls_mu = cls_feats.mean(0)
+        selected = []
+        selected_feat = []
+        for k in range(exemplars_per_class):
+            sum_others = torch.zeros(cls_feats.shape[1])
+            for j in selected_feat:
+                sum_others += j / (k + 1)
+            dist_min = np.inf
+            for item in cls_ind:
+                if item not in selected:
+                    feat = extracted_features[item]
+                    dist = torch.norm(cls_mu - feat / (k + 1) - sum_others)
+                    if dist < dist_min:
+                        dist_min = dist
+                        newone = item
+                        newonefeat = feat
+            selected_feat.append(newonefeat)
+            selected.append(newone)
+        result.extend(selected)
+    return extracted_indices[result], extracted_targets[result]
+
+
+def baseline_entropy(batches, exemplars_per_class):
+    extracted_logits, extracted_targets, extracted_indices = _mean_inputs(batches)
+    extracted_logits = (torch.cat(extracted_logits)).cpu()
+    result = []
+    for curr_cls in np.unique(extracted_targets):
+        cls_ind = np.where(extracted_targets == curr_cls)[0]
+        probs = torch.softmax(extracted_logits[cls_ind].float(), dim=1)
+        minus_entropy = (probs * torch.log(probs)).sum(1)
+        result.extend(cls_ind[minus_entropy.sort()[1][:exemplars_per_class]])
+    return extracted_indices[result], extracted_targets[result]
+
+
+def baseline_energy(batches, exemplars_per_class, forward_times, per_image=True):
+    extracted_logits, extracted_targets, extracted_indices = _mc_inputs(batches, forward_times, per_image)
+    result = []
+    for curr_cls in np.unique(extracted_targets):
+        cls_ind = np.where(extracted_targets == curr_cls)[0]
+        energy_scores = torch.logsumexp(extracted_logits[cls_ind].float(), dim=-1).mean(1)
+        result.extend(cls_ind[energy_scores.sort()[1][:exemplars_per_class]])
+    return extracted_indices[result], extracted_targets[result]
+
+
+def baseline_variance(batches, exemplars_per_class, forward_times, per_image=True):
+    extracted_logits, extracted_targets, extracted_indices = _mc_inputs(batches, forward_times, per_image)
+    result = []
+    for curr_cls in np.unique(extracted_targets):
+        cls_ind = np.where(extracted_targets == curr_cls)[0]
+        probs = torch.softmax(extracted_logits[cls_ind].float(), dim=-1)
+        vars = probs.var(1).sum(1)
+        result.extend(cls_ind[vars.sort()[1][:exemplars_per_class]])
+    return extracted_indices[result], extracted_targets[result]
+
+
+def main():
+    forward_times, exemplars_per_class = 5, 4
+    args = SimpleNamespace(forward_times=forward_times)
+    batches = make_batches(forward_times=forward_times)
+    checks = [
+        (HerdingExemplarsSelector, baseline_herding(batches, exemplars_per_class)),
+        (EntropyExemplarsSelector, baseline_entropy(batches, exemplars_per_class)),
+        (EnergyExemplarsSelector, baseline_energy(batches, exemplars_per_class, forward_times)),
+        (VarianceExemplarsSelector, baseline_variance(batches, exemplars_per_class, forward_times)),
+    ]
+    outputs = HerdingExemplarsSelector.collect_outputs(batches, forward_times)
+    for selector_cls, (expected_indices, expected_targets) in checks:
+        indices, targets = selector_cls(args).select_from_outputs(outputs, exemplars_per_class)
+        assert np.array_equal(indices, expected_indices), f"{selector_cls.__name__} picked {indices}, baseline {expected_indices}"
+        assert np.array_equal(targets, expected_targets), f"{selector_cls.__name__} targets differ from the baseline"
+        print(f"{selector_cls.__name__}: OK")
+    for selector_cls, baseline in [(EnergyExemplarsSelector, baseline_energy), (VarianceExemplarsSelector, baseline_variance)]:
+        mixed_indices, _ = baseline(batches, exemplars_per_class, forward_times, per_image=False)
+        indices, _ = selector_cls(args).select_from_outputs(outputs, exemplars_per_class)
+        print(f"{selector_cls.__name__}: {np.mean(indices != mixed_indices):.0%} of picks differ from the mixed-image layout")
+
+
+if __name__ == '__main__':
+    main()
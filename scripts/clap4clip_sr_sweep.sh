@@ -0,0 +1,2 @@
+# same grid as clap4clip_sr.sh, run in one process that loads CLIP and the datasets once
+python3 sweep_incremental.py --grid '{"sr_beta": [0.005], "db_name": ["cifar100", "imagenet-r"], "forward_times": [120], "gamma": [0.1], "model": ["coop_variational_sr", "maple_variational_sr", "clclip_var_sr"]}' --sweep-dir ./sweeps/clap4clip_sr/ --lasp --beta 15 --use-vga --expandable-adapter --finetuning --finetune-epochs 2 --num-run 10 --compute-ece --compute-bwt --train_batch 20 --root ./mammoth_datasets/ --multi-gpu --gpus 0 --default-gpu 0 --exemplar-selector random --arch ViT-B/16 --epochs 5 --method er --variational --get-adapter-distances
@@ -0,0 +1,111 @@
+import os
+import json
+import argparse
+import functools
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import main_incremental_submit as runner
+import dataset.incremental_dataloader as incremental_dataloader
+from clip.clip import load, enable_model_cache
+
+
+def parse_sweep_option():
+    parser = argparse.ArgumentParser('Grid sweep over main_incremental_submit', add_help=False)
+    parser.add_argument("--grid", type=str, required=True, help='JSON file or string mapping argument names (e.g. sr_beta) to lists of values')
+    parser.add_argument("--sweep-workers", type=int, default=0, help='forked worker processes, cpu-only sweeps (--device cpu); 0 runs the configurations one after another in this process')
+    parser.add_argument("--sweep-dir", type=str, default='sweeps/', help='dir for the per-configuration results')
+    # every other flag is a base value for all configurations, as in main_incremental_submit.py
+    sweep_args, unparsed = parser.parse_known_args()
+    return sweep_args
+
+
+def load_grid(grid):
+    if os.path.isfile(grid):
+        with open(grid) as f:
+            grid = f.read()
+    grid = json.loads(grid)
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def config_key(config):
+    return ",".join(f"{k}={v}" for k, v in config.items())
+
+
+def load_shared_assets(configs):
+    """Load the datasets and CLIP checkpoints every configuration shares, once, before forking.
+
+    Only CPU-side assets are loaded here; forked sweeps are refused unless every
+    configuration runs on the cpu. Text features are cached per worker and reused
+    by its later configurations.
+    """
+    enable_model_cache()
+    incremental_dataloader.enable_dataset_cache()
+    seen_datasets, seen_models = set(), set()
+    for config in configs:
+        args = runner.parse_option(overrides=config)
+        if args.db_name not in seen_datasets:
+            seen_datasets.add(args.db_name)
+            print(f"Loading {args.db_name}")
+            incremental_dataloader.IncrementalDataset(dataset_name=args.db_name, args=args, random_order=False,
+                                                      shuffle=True, seed=args.seed, batch_size=args.train_batch, workers=8,
+                                                      validation_split=0, increment=args.class_per_task)
+        for name in (args.arch, args.ckpt_path):
+            if name not in seen_models:
+                seen_models.add(name)
+                print(f"Loading {name}")
+                load(name, device="cpu")
+
+
+def run_config(config, sweep_dir, sweep_workers=0):
+    key = config_key(config)
+    print(f"Sweep configuration: {key}")
+    args = runner.parse_option(overrides=config)
+    # concurrent workers split the cpu cores between them
+    args.cpu_processes = max(1, sweep_workers)
+    # same loader shuffling as a fresh process
+    incremental_dataloader.g.manual_seed(0)
+    metrics = runner.main(args)
+    if metrics is None:
+        print(f"Skipping {key}: already run")
+        return key, None
+    result = {k: float(v) for k, v in metrics.items()}
+    path = os.path.join(sweep_dir, key.replace("/", "-") + ".json")
+    with open(path + ".tmp", "w") as f:
+        json.dump({"config": config, "metrics": result}, f, indent=2)
+    os.replace(path + ".tmp", path)
+    return key, result
+
+
+def main(sweep_args):
+    configs = load_grid(sweep_args.grid)
+    if sweep_args.sweep_workers > 0:
+        # CUDA can not be used in a forked child once the parent has initialised torch
+        not_cpu = [config_key(config) for config in configs if runner.parse_option(overrides=config).device.type != 'cpu']
+        if not_cpu:
+            raise ValueError(f"--sweep-workers > 0 forks the sweep process and needs --device cpu for every configuration; "
+                             f"not on cpu: {not_cpu}")
+    os.makedirs(sweep_args.sweep_dir, exist_ok=True)
+    load_shared_assets(configs)
+    run = functools.partial(run_config, sweep_dir=sweep_args.sweep_dir, sweep_workers=sweep_args.sweep_workers)
+    if sweep_args.sweep_workers > 0:
+        # forked workers share the loaded datasets and checkpoints copy-on-write
+        with ProcessPoolExecutor(sweep_args.sweep_workers, mp_context=multiprocessing.get_context("fork")) as pool:
+            results = dict(pool.map(run, configs))
+    else:
+        results = dict(map(run, configs))
+
+    results_path = os.path.join(sweep_args.sweep_dir, "results.json")
+    if os.path.isfile(results_path):
+        with open(results_path) as f:
+            results = {**json.load(f), **{k: v for k, v in results.items() if v is not None}}
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    sweep_args = parse_sweep_option()
+    main(sweep_args)
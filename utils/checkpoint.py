@@ -0,0 +1,56 @@
+import os
+import re
+import random
+
+import numpy as np
+import torch
+
+
+def get_rng_state(generators=None):
+    return {"python": random.getstate(),
+            "numpy": np.random.get_state(),
+            "torch": torch.get_rng_state(),
+            "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+            "generators": {name: gen.get_state() for name, gen in (generators or {}).items()}}
+
+
+def set_rng_state(state, generators=None):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"]:
+        torch.cuda.set_rng_state_all(state["cuda"])
+    for name, gen in (generators or {}).items():
+        if name in state["generators"]:
+            gen.set_state(state["generators"][name])
+
+
+def save_session_checkpoint(ckpt_dir, sess, state):
+    """Write ``session_<sess>.pt`` atomically, so a crash mid-write never leaves a truncated checkpoint behind."""
+    os.makedirs(ckpt_dir, exist_ok=True)
+    path = os.path.join(ckpt_dir, f"session_{sess}.pt")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_latest_checkpoint(ckpt_dir, device=None, sess=None):
+    """Return the checkpoint of session ``sess`` (default: the last one saved) in ``ckpt_dir``, or None.
+
+    GPU tensors are loaded onto ``device``; CPU ones such as the RNG states stay on the CPU.
+    """
+    if not os.path.isdir(ckpt_dir):
+        return None
+    sessions = [int(m.group(1)) for m in (re.fullmatch(r"session_(\d+)\.pt", f) for f in os.listdir(ckpt_dir)) if m]
+    if sess is None and sessions:
+        sess = max(sessions)
+    if sess not in sessions:
+        return None
+    path = os.path.join(ckpt_dir, f"session_{sess}.pt")
+    print(f"Resuming from {path}")
+    if device is not None and torch.device(device).type == "cpu":
+        map_location = "cpu"
+    else:
+        map_location = lambda storage, loc: storage if loc == "cpu" or device is None else storage.cuda(device)
+    return torch.load(path, map_location=map_location, weights_only=False)
@@ -0,0 +1,93 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+import torch
+
+
+class StageProfiler:
+    """Named timing spans aggregated to p50/p95 per span.
+
+    Device spans are bracketed by CUDA events on the current stream, so they time
+    the GPU work queued inside the span without a sync per step; all events are
+    resolved by a single synchronize in ``summary``. ``iter`` times how long the
+    host waits on a loader for each batch. On a CPU ``device``, spans use the
+    host clock instead. A disabled profiler costs nothing.
+    """
+    def __init__(self, enabled=True, device=None):
+        self.enabled = enabled
+        device = device if device is not None else ("cuda" if torch.cuda.is_available() else "cpu")
+        self.cuda_timing = torch.device(device).type == 'cuda'
+        self.reset()
+
+    def reset(self):
+        self.events = defaultdict(list)
+        self.host_times = defaultdict(list)
+
+    def span(self, name):
+        return self._span(name) if self.enabled else nullcontext()
+
+    @contextmanager
+    def _span(self, name):
+        if not self.cuda_timing:
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.host_times[name].append(time.perf_counter() - start)
+            return
+        start = torch.cuda.Event(enable_timing=True)
+        end = torch.cuda.Event(enable_timing=True)
+        start.record()
+        try:
+            yield
+        finally:
+            end.record()
+            self.events[name].append((start, end))
+
+    def iter(self, loader, name='dataloader_wait'):
+        if not self.enabled:
+            yield from loader
+            return
+        batches = iter(loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            self.host_times[name].append(time.perf_counter() - start)
+            yield batch
+
+    def times(self):
+        if self.events:
+            torch.cuda.synchronize()
+        times = {name: [start.elapsed_time(end) / 1000. for start, end in events] for name, events in self.events.items()}
+        for name, host_times in self.host_times.items():
+            times[name] = times.get(name, []) + host_times
+        return times
+
+    def mean(self, name):
+        return np.mean(self.times().get(name, []))
+
+    def summary(self):
+        """Return ``{span: {"p50", "p95", "mean", "total", "count"}}``, times in seconds."""
+        return {name: {"p50": float(np.percentile(t, 50)),
+                       "p95": float(np.percentile(t, 95)),
+                       "mean": float(np.mean(t)),
+                       "total": float(np.sum(t)),
+                       "count": len(t)}
+                for name, t in self.times().items() if len(t)}
+
+    def log(self, sinks, step, phase):
+        """Print the spans recorded since the last ``log``, send them to the metric sinks as ``time/<phase>/<span>_<stat>`` and reset."""
+        summary = self.summary()
+        for name, stats in summary.items():
+            print(f"[{phase}] {name}: p50 {stats['p50'] * 1000:.2f}ms, p95 {stats['p95'] * 1000:.2f}ms, total {stats['total']:.2f}s over {stats['count']} calls")
+        scalars = {f"time/{phase}/{name}_{stat}": v for name, stats in summary.items() for stat, v in stats.items() if stat != "count"}
+        if scalars:
+            for sink in sinks:
+                sink(step, scalars)
+        self.reset()
+        return summary
@@ -0,0 +1,68 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+
+# operational flags and runtime objects that do not change what a run computes
+NON_IDENTITY_ARGS = {'sess', 'start_sess', 'resume', 'profile_stages', 'gpus', 'default_gpu', 'multi_gpu', 'device',
+                     'checkpoint', 'run_registry', 'feature_cache_dir', 'image_cache_dir',
+                     'profiler', 'ram_computer', 'sample_per_task_testing',
+                     'cpu_threads', 'cpu_interop_threads', 'cpu_encode_threads', 'cpu_processes', 'quantize_eval',
+                     'attention_backend'}
+
+
+class RunRegistry:
+    """SQLite record of runs, keyed by a hash of every result-affecting argument, with per-session completion.
+
+    A run counts as done only when all of its sessions are recorded, so an
+    interrupted run is picked up again instead of being skipped.
+    """
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        with self.connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, args TEXT, created REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions (run_id TEXT, sess INTEGER, metrics TEXT, finished REAL, "
+                         "PRIMARY KEY (run_id, sess))")
+
+    def connect(self):
+        # concurrent sweep workers share the file
+        return sqlite3.connect(self.path, timeout=60)
+
+    @staticmethod
+    def run_args(args):
+        return {k: v for k, v in sorted(vars(args).items()) if k not in NON_IDENTITY_ARGS}
+
+    @classmethod
+    def get_run_id(cls, args):
+        return hashlib.sha256(json.dumps(cls.run_args(args), sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+    def register(self, args):
+        run_id = self.get_run_id(args)
+        with self.connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO runs VALUES (?, ?, ?)",
+                         (run_id, json.dumps(self.run_args(args), sort_keys=True, default=str), time.time()))
+        return run_id
+
+    def completed_sessions(self, run_id):
+        with self.connect() as conn:
+            return {sess for sess, in conn.execute("SELECT sess FROM sessions WHERE run_id = ?", (run_id,))}
+
+    def first_incomplete_session(self, run_id):
+        """Sessions run in order, so this is the number of consecutive finished sessions from 0."""
+        completed = self.completed_sessions(run_id)
+        sess = 0
+        while sess in completed:
+            sess += 1
+        return sess
+
+    def mark_session(self, run_id, sess, metrics=None):
+        metrics = {k: float(v) for k, v in (metrics or {}).items()}
+        with self.connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)", (run_id, sess, json.dumps(metrics), time.time()))
+
+    def clear_sessions(self, run_id):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE run_id = ?", (run_id,))